@@ -0,0 +1,190 @@
+from typing import Collection, Dict, List, Tuple
+from classes.color_position import ColorPosition
+from utils.board_functions import ALL_SQUARES, LETTER_TO_NUM, NUM_TO_LETTER, PIECE_MOVE_TYPE_DICT, SQUARE_SCOPES_MAP, \
+    INT_SQUARES_MAP, LINE_EXTEND_MAP
+from utils.piece_square_tables import PAWN_ATTACKED_SQUARES
+
+# THE EIGHT RAYS OUT OF EACH SQUARE AS (LINE TYPE, SQUARES IN ORDER OF DISTANCE)
+SLIDER_RAYS: Dict[str, List[Tuple[str, List[str]]]] = {}
+for square in ALL_SQUARES:
+    SLIDER_RAYS[square] = []
+    for file_step, rank_step in ((0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)):
+        line_type = 'f' if file_step == 0 else 'r' if rank_step == 0 else 'd'
+        ray = []
+        file_num, rank = LETTER_TO_NUM[square[0]] + file_step, int(square[1]) + rank_step
+        while 1 <= file_num <= 8 and 1 <= rank <= 8:
+            ray.append(f'{NUM_TO_LETTER[file_num]}{rank}')
+            file_num, rank = file_num + file_step, rank + rank_step
+        if ray:
+            SLIDER_RAYS[square].append((line_type, ray))
+
+LINE_TYPE_SLIDERS = {'f': ('R', 'Q'), 'r': ('R', 'Q'), 'd': ('B', 'Q')}
+
+
+def square_is_attacked(square: str, color: str, attacking_pieces: ColorPosition, defending_pieces: ColorPosition) -> bool:
+    """
+    :param square:
+    :param color: color of attacking_pieces.
+    :param attacking_pieces:
+    :param defending_pieces:
+    :return: True if a piece of attacking_pieces covers square.
+    """
+    return square_is_attacked_on_board(square, color, attacking_pieces.get_square_piece_symbol_dict(),
+                                       defending_pieces.get_occupied_squares())
+
+
+def square_is_attacked_on_board(square: str, color: str, attacker_dict: Dict[str, str],
+                                defender_squares: Collection[str]) -> bool:
+    """
+    Looks outwards from square for an attacking piece that covers it, without scanning every attacking piece.
+    :param square:
+    :param color: color of the attacking pieces.
+    :param attacker_dict: {square: piece symbol} of the attacking pieces, in uppercase.
+    :param defender_squares: squares occupied by the other color.
+    :return:
+    """
+    scopes = SQUARE_SCOPES_MAP[square]
+    for knight_square in scopes['N']:
+        if attacker_dict.get(knight_square) == 'N':
+            return True
+    for king_square in scopes['K']:
+        if attacker_dict.get(king_square) == 'K':
+            return True
+    # A PAWN ATTACKS square FROM THE SQUARES A PAWN OF THE OTHER COLOR ON square WOULD ATTACK
+    for pawn_square in PAWN_ATTACKED_SQUARES['b' if color == 'w' else 'w'][square]:
+        if attacker_dict.get(pawn_square) == 'P':
+            return True
+    for line_type, ray in SLIDER_RAYS[square]:
+        for ray_square in ray:
+            if ray_square in attacker_dict:
+                if attacker_dict[ray_square] in LINE_TYPE_SLIDERS[line_type]:
+                    return True
+                break
+            if ray_square in defender_squares:
+                break
+    return False
+
+
+class AttackMap:
+    """
+    Every square covered by every piece of both colors in one position. Built once per position (see
+    Position.get_attack_map) and read by check detection, castling, capture generation and the evaluation.
+    piece_scopes: {color: {pns: [squares covered]}}, the same as Position.get_piece_scope_dict used to give.
+    square_attackers: {color: {square: [pns covering it]}}, the inverse of piece_scopes.
+    x_rays: {color: {blocker square + square: pns}}, the slider that would cover square if the one piece on blocker
+    square were not there.
+    square_piece_dict: {square: piece symbol}, uppercase for white and lowercase for black.
+    The pins and checkers of each king are worked out from these on first use (see get_pins and get_checkers).
+    """
+
+    def __init__(self, white_pieces: ColorPosition, black_pieces: ColorPosition):
+        self.square_piece_dict = white_pieces.get_square_piece_symbol_dict() | \
+            black_pieces.get_square_piece_symbol_dict(lowercase=True)
+        self.piece_scopes: Dict[str, Dict[str, List[str]]] = {}
+        self.square_attackers: Dict[str, Dict[str, List[str]]] = {}
+        self.x_rays: Dict[str, Dict[str, str]] = {}
+        self.king_squares = {'w': white_pieces.get_king_square(), 'b': black_pieces.get_king_square()}
+        self.pins: Dict[str, Dict[str, Tuple[str, List[str]]]] = {}
+        for color, piece_positions in (('w', white_pieces), ('b', black_pieces)):
+            self.scan_color(color, piece_positions)
+
+    def scan_color(self, color: str, piece_positions: ColorPosition) -> None:
+        occupied_squares = self.square_piece_dict
+        piece_scopes = {}
+        square_attackers = {}
+        x_rays = {}
+        for piece in piece_positions.list_unique_piece_types():
+            for origin_sq in piece_positions.get_piece_type_squares(piece):
+                pns = f'{piece}{origin_sq}'
+                if piece == 'P':
+                    covered_squares = list(PAWN_ATTACKED_SQUARES[color][origin_sq])
+                else:
+                    covered_squares = []
+                    scopes = SQUARE_SCOPES_MAP[origin_sq]
+                    for move_type in PIECE_MOVE_TYPE_DICT[piece]:
+                        for dest_sq in scopes[move_type]:
+                            map_key = f'{origin_sq}{dest_sq}'
+                            if map_key not in INT_SQUARES_MAP:
+                                covered_squares.append(dest_sq)
+                                continue
+                            blockers = [int_sq for int_sq in INT_SQUARES_MAP[map_key]['int'] if int_sq in occupied_squares]
+                            if not blockers:
+                                covered_squares.append(dest_sq)
+                            elif len(blockers) == 1:
+                                x_rays[f'{blockers[0]}{dest_sq}'] = pns
+                piece_scopes[pns] = covered_squares
+                for covered_square in covered_squares:
+                    if covered_square not in square_attackers:
+                        square_attackers[covered_square] = [pns]
+                    else:
+                        square_attackers[covered_square].append(pns)
+        self.piece_scopes[color] = piece_scopes
+        self.square_attackers[color] = square_attackers
+        self.x_rays[color] = x_rays
+
+    def is_attacked_by(self, square: str, color: str) -> bool:
+        return square in self.square_attackers[color]
+
+    def get_x_ray_attacker(self, blocker_square: str, square: str, color: str) -> str:
+        """
+        :return: the pns of the color's slider behind the piece on blocker_square, in line with square, or None.
+        """
+        return self.x_rays[color].get(f'{blocker_square}{square}')
+
+    def get_checkers(self, color: str) -> List[str]:
+        """
+        :return: the pns of every piece giving check to the king of the color.
+        """
+        return self.square_attackers['b' if color == 'w' else 'w'].get(self.king_squares[color], [])
+
+    def get_pins(self, color: str) -> Dict[str, Tuple[str, List[str]]]:
+        """
+        Pieces of the color pinned to their king.
+        :return: {square of the pinned piece: (pns of the pinning piece, the squares on the line from the king through
+        the pinned piece to the edge of the board, off which the pinned piece may not move)}
+        """
+        if color not in self.pins:
+            pins = {}
+            for line_type, ray in SLIDER_RAYS[self.king_squares[color]]:
+                shielding_sq = None
+                for ray_square in ray:
+                    if ray_square not in self.square_piece_dict:
+                        continue
+                    piece = self.square_piece_dict[ray_square]
+                    own_piece = piece.isupper() if color == 'w' else piece.islower()
+                    if shielding_sq is None and own_piece:
+                        shielding_sq = ray_square
+                        continue
+                    if shielding_sq is not None and not own_piece and piece.upper() in LINE_TYPE_SLIDERS[line_type]:
+                        pins[shielding_sq] = (f'{piece.upper()}{ray_square}', ray)
+                    break
+            self.pins[color] = pins
+        return self.pins[color]
+
+    def king_can_move_to(self, color: str, square: str) -> bool:
+        """
+        Whether the king of the color can step to square, a square next to it. Besides the squares the other color
+        covers, the king cannot step back along the line of a checking slider.
+        """
+        if square in self.square_attackers['b' if color == 'w' else 'w']:
+            return False
+        piece = self.square_piece_dict.get(square)
+        if piece is not None and (piece.isupper() if color == 'w' else piece.islower()):
+            return False
+        king_sq = self.king_squares[color]
+        for checking_pns in self.get_checkers(color):
+            map_key = f'{checking_pns[1:]}{king_sq}'
+            if checking_pns[0] in ('Q', 'R', 'B') and map_key in LINE_EXTEND_MAP and \
+                    LINE_EXTEND_MAP[map_key][:1] == [square]:
+                return False
+        return True
+
+    def evasion_is_legal(self, color: str, pns: str, destination_square: str) -> bool:
+        """
+        For a color in check from one piece, whether moving pns to destination_square is legal, where
+        destination_square captures the checking piece or blocks the check. A pinned piece can do neither, as its pin
+        line and the check line only meet at the king.
+        """
+        if pns[0] == 'K':
+            return self.king_can_move_to(color, destination_square)
+        return pns[1:] not in self.get_pins(color)
@@ -1,22 +1,110 @@
 import json
-from typing import Callable, Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Any, Union
 from classes.position import Position
-from simple_bot.move_search import choose_best_move, choose_best_move_recursive
+from simple_bot.move_search import choose_best_move, choose_best_move_recursive, \
+    choose_best_move_recursive_stoppable, ExpansionCache, SearchBudget, EvaluationCache
+from simple_bot.parallel_search import choose_best_move_parallel, choose_best_move_recursive_parallel, \
+    choose_best_move_lazy_smp
+from simple_bot.transposition_table import SharedTranspositionTable, SharedStopFlag
+from simple_bot.mate_search import MateSearch, find_forced_mate
+from simple_bot.tablebase import Tablebases
+from simple_bot.bot1.evaluation import ProfiledEvaluation
+from simple_bot.binary_book import BinaryOpeningBook, BINARY_BOOK_FILE_EXTENSION, get_book_fen_hash
 from random import choice
+from threading import Thread, Event
 
 
 class Bot:
 
     def __init__(self, evaluation_func: Callable[[Position], Dict[str, float]], breadth: int = 3,
                  aggression: int = 1, fluctuation: float = 0, assumed_opp_aggresion: int = 1,
-                 ply_depth: int = 4, opening_book_path: str = None):
-        self.evaluation_func = evaluation_func
+                 ply_depth: int = 4, opening_book_path: str = None, workers: int = 1, parallel_mode: str = 'root',
+                 transposition_table_size: int = 2 ** 18, reuse_expansions: bool = True, max_nodes: int = None,
+                 max_memory_bytes: int = None, mate_search_depth: int = 2, mate_search_nodes: int = 2000,
+                 tablebase_path: str = None, evaluation_cache_size: int = 2 ** 18, lazy_leaf_evaluation: bool = False,
+                 threat_func: Callable[[Position], float] = None, prescreen_factor: int = None):
+        """
+        :param opening_book_path: a JSON book like simple_bot/opening_book/fen_uci.json, or a binary book (.bin) made
+        from one with simple_bot.binary_book.
+        :param workers: number of search processes. 1 searches in this process.
+        :param parallel_mode: how the recursive search uses the workers when workers > 1. 'root' spreads the root moves
+        over the workers. 'lazy_smp' has every worker search the whole root, sharing a transposition table.
+        :param transposition_table_size: number of entries in the shared transposition table used by 'lazy_smp'.
+        :param reuse_expansions: keep the positions expanded by one search for the next one, so that the subtree under
+        the moves actually played is not generated and evaluated again. Only the positions of the moves searched further
+        are kept, with the moves and scores of the rest (see ExpansionCache). Only used when searching in this process.
+        :param max_nodes: most nodes one search may expand. None for no limit.
+        :param max_memory_bytes: most memory one search may hold in positions, including the kept expansions. None for
+        no limit. When either limit is reached, the search stops expanding and returns the best move found with what it
+        has. Usage of the last search is kept in last_search_usage. Only supported with workers=1.
+        :param mate_search_depth: before the normal search, look for a forced mate in up to this many moves with checks
+        only. 0 to disable.
+        :param mate_search_nodes: node limit of the mate search, for each mate length tried.
+        :param tablebase_path: directory of endgame tables made with simple_bot.tablebase. Positions they cover are
+        played from the tables without searching.
+        :param evaluation_cache_size: number of evaluations kept (least recently used dropped first), so that positions
+        seen again in this search or a later one are not evaluated again. 0 to disable. Each worker process keeps its
+        own cache for the task it is running.
+        :param lazy_leaf_evaluation: at the last ply of the recursive search, evaluate each move against the best score
+        so far, so that evaluation stops early for moves that cannot beat it. The moves chosen are the same.
+        evaluation_func must take lower_bound and upper_bound like quick_evaluate. The last-ply positions are then not
+        kept in the expansion cache. Only used when searching in this process.
+        :param threat_func: for an evaluation_func that leaves out 'threat' (e.g. evaluate_score), the function giving
+        the threat score on its own (e.g. evaluate_threat). It is only called for moves whose threat score the search
+        needs, and cached apart from the evaluations. Needs the evaluation cache.
+        :param prescreen_factor: at every node, rank the legal moves with a cheap score first (see simple_bot.prescreen)
+        and only make and evaluate the best prescreen_factor * breadth of them. None evaluates every legal move.
+
+        To find which parts of the evaluation are slow, give a ProfiledEvaluation as evaluation_func and read
+        get_evaluation_profile after searching.
+        """
+        if parallel_mode not in ('root', 'lazy_smp'):
+            raise ValueError(f'Unrecognized parallel mode: {parallel_mode}. Must be \'root\' or \'lazy_smp\'.')
+        if workers > 1 and (max_nodes is not None or max_memory_bytes is not None):
+            raise ValueError('max_nodes and max_memory_bytes are only supported with workers=1.')
+        if threat_func is not None and evaluation_cache_size <= 0:
+            raise ValueError('threat_func needs the evaluation cache. evaluation_cache_size must be more than 0.')
+        if prescreen_factor is not None and prescreen_factor < 1:
+            raise ValueError(f'prescreen_factor must be at least 1 or None, not {prescreen_factor}.')
+        self.evaluation_cache = EvaluationCache(evaluation_func, evaluation_cache_size, threat_func=threat_func) \
+            if evaluation_cache_size > 0 else None
+        self.evaluation_func = self.evaluation_cache if self.evaluation_cache is not None else evaluation_func
+        self.profiled_evaluation = evaluation_func if isinstance(evaluation_func, ProfiledEvaluation) else None
         self.breadth = breadth
         self.aggression = aggression
         self.fluctuation = fluctuation
         self.assumed_opp_aggression = assumed_opp_aggresion
         self.ply_depth = ply_depth
-        if opening_book_path:
+        self.workers = workers
+        self.parallel_mode = parallel_mode
+        self.transposition_table_size = transposition_table_size
+        self.executor = None
+        self.shared_transposition_table = None
+        self.shared_stop_flag = None
+        self.expansion_cache = ExpansionCache() if reuse_expansions else None
+        self.max_nodes = max_nodes
+        self.max_memory_bytes = max_memory_bytes
+        self.last_search_usage = None
+        self.mate_search_depth = mate_search_depth
+        self.lazy_leaf_evaluation = lazy_leaf_evaluation
+        self.prescreen_factor = prescreen_factor
+        self.mate_search = MateSearch(max_nodes=mate_search_nodes)
+        self.tablebases = Tablebases(tablebase_path) if tablebase_path else None
+        self.ponder_thread = None
+        self.ponder_stop_event = None
+        self.ponder_prediction_event = None
+        self.ponder_position_hash = None
+        self.ponder_result = None
+        self.ponderhit_should_stop = None
+        self.binary_opening_book = None
+        if opening_book_path and opening_book_path.endswith(BINARY_BOOK_FILE_EXTENSION):
+            try:
+                self.binary_opening_book = BinaryOpeningBook(opening_book_path)
+            except Exception as e:
+                print(f'Error getting opening book: {str(e)}. Bot will play without opening book.')
+            opening_book = None
+        elif opening_book_path:
             try:
                 with open(opening_book_path, 'r') as readfile:
                     opening_book = json.load(readfile)
@@ -47,18 +135,186 @@ class Bot:
                     opening_book.pop(fen)
         self.opening_book = opening_book
 
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def get_shared_transposition_table(self) -> SharedTranspositionTable:
+        if self.shared_transposition_table is None:
+            self.shared_transposition_table = SharedTranspositionTable(self.transposition_table_size)
+        return self.shared_transposition_table
+
+    def get_shared_stop_flag(self) -> SharedStopFlag:
+        if self.shared_stop_flag is None:
+            self.shared_stop_flag = SharedStopFlag()
+        return self.shared_stop_flag
+
+    def close(self) -> None:
+        """
+        Stops pondering, closes the opening book and endgame tables, shuts down the worker processes and frees the shared transposition
+        table and stop flag, if they were created.
+        :return:
+        """
+        self.stop_pondering()
+        if self.binary_opening_book is not None:
+            self.binary_opening_book.close()
+            self.binary_opening_book = None
+        if self.tablebases is not None:
+            self.tablebases.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.shared_transposition_table is not None:
+            self.shared_transposition_table.close()
+            self.shared_transposition_table = None
+        if self.shared_stop_flag is not None:
+            self.shared_stop_flag.close()
+            self.shared_stop_flag = None
+
+    def get_evaluation_cache_stats(self) -> Dict[str, float]:
+        """
+        :return: hits, misses, hit rate and size of the evaluation cache over the game so far. Evaluations done in
+        worker processes are not counted.
+        """
+        if self.evaluation_cache is None:
+            return {'hits': 0, 'misses': 0, 'hit_rate': 0.0, 'entries': 0}
+        return self.evaluation_cache.get_stats()
+
+    def get_evaluation_profile(self, reset: bool = False) -> Union[Dict[str, Any], None]:
+        """
+        :param reset: start the profile again after reading it, e.g. to profile each search on its own.
+        :return: time, runs and mean score added by each block of the evaluation over the game so far (see
+        EvaluationProfile.get_stats), or None if evaluation_func is not a ProfiledEvaluation. Evaluations answered by
+        the evaluation cache or done in worker processes are not counted.
+        """
+        if self.profiled_evaluation is None:
+            return None
+        stats = self.profiled_evaluation.profile.get_stats()
+        if reset:
+            self.profiled_evaluation.reset()
+        return stats
+
+    def look_in_tablebases(self, position: Position) -> str:
+        """
+        :return: the table move if the position is covered by the endgame tables, otherwise '0000'.
+        """
+        if self.tablebases is None:
+            return '0000'
+        return self.tablebases.choose_move(position)
+
+    def look_for_forced_mate(self, position: Position) -> str:
+        """
+        Positions where the side to move has no check are given up on straight away, so the mate search only costs
+        anything in sharp positions.
+        :param position:
+        :return: UCI of the first move of the shortest forced mate found, '0000' if none.
+        """
+        if self.mate_search_depth <= 0:
+            return '0000'
+        forced_mate = find_forced_mate(position, max_moves=self.mate_search_depth, mate_search=self.mate_search)
+        if forced_mate is None:
+            return '0000'
+        return forced_mate[0]
+
     def choose_move(self, position: Position) -> str:
-        return choose_best_move(position=position, evaluate=self.evaluation_func, breadth=self.breadth,
-                                aggression=self.aggression, fluctuation=self.fluctuation,
-                                assumed_opp_aggression=self.assumed_opp_aggression, ply_depth=self.ply_depth)
+        tablebase_move = self.look_in_tablebases(position)
+        if tablebase_move != '0000':
+            return tablebase_move
+        mating_move = self.look_for_forced_mate(position)
+        if mating_move != '0000':
+            return mating_move
+        if self.workers > 1:
+            return choose_best_move_parallel(position=position, evaluate=self.evaluation_func,
+                                             executor=self.get_executor(), breadth=self.breadth,
+                                             aggression=self.aggression, fluctuation=self.fluctuation,
+                                             assumed_opp_aggression=self.assumed_opp_aggression,
+                                             ply_depth=self.ply_depth, prescreen_factor=self.prescreen_factor)
+        self.reroot_expansion_cache(position)
+        budget = self.create_search_budget()
+        best_move_uci = choose_best_move(position=position, evaluate=self.evaluation_func, breadth=self.breadth,
+                                         aggression=self.aggression, fluctuation=self.fluctuation,
+                                         assumed_opp_aggression=self.assumed_opp_aggression, ply_depth=self.ply_depth,
+                                         expansion_cache=self.expansion_cache, budget=budget,
+                                         prescreen_factor=self.prescreen_factor)
+        self.last_search_usage = budget.get_usage()
+        return best_move_uci
+
+    def choose_move_recursive(self, position: Position, should_stop: Callable[[], bool] = None) -> str:
+        """
+        Does not prune the expansion cache, so that pondering on a predicted position keeps the subtrees of the other
+        replies. make_move reroots it.
+        :param position:
+        :param should_stop: polled during the search. Once it returns True, the best move found so far is returned.
+        :return:
+        """
+        tablebase_move = self.look_in_tablebases(position)
+        if tablebase_move != '0000':
+            return tablebase_move
+        mating_move = self.look_for_forced_mate(position)
+        if mating_move != '0000':
+            return mating_move
+        if self.workers > 1 and self.parallel_mode == 'lazy_smp':
+            return choose_best_move_lazy_smp(position=position, evaluation_func=self.evaluation_func,
+                                             executor=self.get_executor(),
+                                             transposition_table=self.get_shared_transposition_table(),
+                                             workers=self.workers, breadth=self.breadth, aggression=self.aggression,
+                                             fluctuation=self.fluctuation,
+                                             assumed_opp_aggression=self.assumed_opp_aggression,
+                                             ply_depth=self.ply_depth, should_stop=should_stop,
+                                             prescreen_factor=self.prescreen_factor)[0]
+        if self.workers > 1:
+            return choose_best_move_recursive_parallel(position=position, evaluation_func=self.evaluation_func,
+                                                       executor=self.get_executor(), breadth=self.breadth,
+                                                       aggression=self.aggression, fluctuation=self.fluctuation,
+                                                       assumed_opp_aggression=self.assumed_opp_aggression,
+                                                       ply_depth=self.ply_depth, should_stop=should_stop,
+                                                       stop_flag=self.get_shared_stop_flag(),
+                                                       prescreen_factor=self.prescreen_factor)[0]
+        budget = self.create_search_budget()
+        if should_stop is not None:
+            best_move_uci = choose_best_move_recursive_stoppable(position=position,
+                                                                 evaluation_func=self.evaluation_func,
+                                                                 should_stop=should_stop, breadth=self.breadth,
+                                                                 aggression=self.aggression,
+                                                                 fluctuation=self.fluctuation,
+                                                                 assumed_opp_aggression=self.assumed_opp_aggression,
+                                                                 ply_depth=self.ply_depth,
+                                                                 expansion_cache=self.expansion_cache,
+                                                                 budget=budget,
+                                                                 lazy_leaves=self.lazy_leaf_evaluation,
+                                                                 prescreen_factor=self.prescreen_factor)[0]
+        else:
+            best_move_uci = choose_best_move_recursive(position=position, evaluation_func=self.evaluation_func,
+                                                       breadth=self.breadth, aggression=self.aggression,
+                                                       fluctuation=self.fluctuation,
+                                                       assumed_opp_aggression=self.assumed_opp_aggression,
+                                                       ply_depth=self.ply_depth, expansion_cache=self.expansion_cache,
+                                                       budget=budget, lazy_leaves=self.lazy_leaf_evaluation,
+                                                       prescreen_factor=self.prescreen_factor)[0]
+        self.last_search_usage = budget.get_usage()
+        return best_move_uci
 
-    def choose_move_recursive(self, position: Position) -> str:
-        return choose_best_move_recursive(position=position, evaluation_func=self.evaluation_func, breadth=self.breadth,
-                                          aggression=self.aggression, fluctuation=self.fluctuation,
-                                          assumed_opp_aggression=self.assumed_opp_aggression,
-                                          ply_depth=self.ply_depth)[0]
+    def create_search_budget(self) -> SearchBudget:
+        return SearchBudget(max_nodes=self.max_nodes, max_memory_bytes=self.max_memory_bytes,
+                            expansion_cache=self.expansion_cache)
+
+    def reroot_expansion_cache(self, position: Position) -> None:
+        """
+        Prunes the expansion cache to what is reachable from position. Clears it if what is left would already use up
+        the memory budget.
+        :param position:
+        :return:
+        """
+        if self.expansion_cache is not None:
+            self.expansion_cache.reroot(position)
+            if self.max_memory_bytes is not None and \
+                    self.create_search_budget().get_memory_estimate() >= self.max_memory_bytes:
+                self.expansion_cache.clear()
 
     def look_in_opening_book(self, position: Position) -> str:
+        if self.binary_opening_book is not None:
+            return self.binary_opening_book.choose_move(position)
         if not self.opening_book:
             return '0000'
         current_fen = position.generate_fen().rsplit(' ', maxsplit=2)[0]
@@ -71,14 +327,115 @@ class Bot:
                 self.opening_book.pop(current_fen)
                 return '0000'
 
-    def make_move(self, position: Position) -> str:
+    def start_pondering(self, position: Position) -> None:
+        """
+        Starts thinking on the opponent's time. A background thread predicts the opponent's reply and searches the
+        resulting position. If the next call to make_move is for that position (a ponderhit), it answers from this
+        search instead of starting again. Any other position discards the search.
+        :param position: the position after the bot's move, with the opponent to move.
+        :return:
+        """
+        self.stop_pondering()
+        self.reroot_expansion_cache(position)
+        self.ponder_stop_event = Event()
+        self.ponder_prediction_event = Event()
+        self.ponder_position_hash = None
+        self.ponder_result = None
+        self.ponderhit_should_stop = None
+        self.ponder_thread = Thread(target=self.ponder, args=(position.copy(), self.ponder_stop_event), daemon=True)
+        self.ponder_thread.start()
+
+    def ponder(self, position: Position, stop_event: Event) -> None:
+        """
+        Body of the pondering thread. The opponent's reply is predicted with a search two plies shallower than the
+        bot's own, and the hash of the predicted position is put in self.ponder_position_hash. The move the bot would
+        play there is put in self.ponder_result if the search finishes, or if it was cut short after a ponderhit.
+        :param position:
+        :param stop_event: set to abandon the search.
+        :return:
+        """
+        def should_stop() -> bool:
+            if stop_event.is_set():
+                return True
+            return self.ponderhit_should_stop is not None and self.ponderhit_should_stop()
+
+        try:
+            predicted_reply = choose_best_move_recursive_stoppable(position=position,
+                                                                   evaluation_func=self.evaluation_func,
+                                                                   should_stop=stop_event.is_set,
+                                                                   breadth=self.breadth,
+                                                                   aggression=self.assumed_opp_aggression,
+                                                                   fluctuation=self.fluctuation,
+                                                                   assumed_opp_aggression=self.aggression,
+                                                                   ply_depth=max(1, self.ply_depth - 2),
+                                                                   expansion_cache=self.expansion_cache,
+                                                                   prescreen_factor=self.prescreen_factor)[0]
+            if stop_event.is_set():
+                return
+            for move in position.get_all_legal_moves_for_side_to_move():
+                if move.generate_uci() == predicted_reply:
+                    position.process_legal_move(move)
+                    break
+            else:
+                return
+            self.ponder_position_hash = position.get_hash()
+        finally:
+            self.ponder_prediction_event.set()
+        best_move_uci = self.choose_move_recursive(position, should_stop=should_stop)
+        if not stop_event.is_set():
+            self.ponder_result = best_move_uci
+
+    def stop_pondering(self) -> None:
+        """
+        Abandons the pondering search, if there is one, and waits for its thread to finish.
+        :return:
+        """
+        if self.ponder_thread is not None:
+            self.ponder_stop_event.set()
+            self.ponder_thread.join()
+            self.ponder_thread = None
+            self.ponder_result = None
+
+    def take_ponder_result(self, position: Position, should_stop: Callable[[], bool] = None) -> str:
+        """
+        On a ponderhit, waits for the pondering search to finish and returns its move. should_stop can cut that wait
+        short. Otherwise stops pondering and returns '0000'. A reply that came before the opponent's move was
+        predicted counts as a miss.
+        :param position:
+        :param should_stop:
+        :return:
+        """
+        if self.ponder_thread is None:
+            return '0000'
+        if not self.ponder_prediction_event.is_set():
+            self.stop_pondering()
+            return '0000'
+        if self.ponder_position_hash is None or self.ponder_position_hash != position.get_hash():
+            self.stop_pondering()
+            return '0000'
+        self.ponderhit_should_stop = should_stop
+        self.ponder_thread.join()
+        ponder_move = self.ponder_result if self.ponder_result is not None else '0000'
+        self.ponder_thread = None
+        self.ponder_result = None
+        self.ponderhit_should_stop = None
+        return ponder_move
+
+    def make_move(self, position: Position, should_stop: Callable[[], bool] = None) -> str:
         opening_book_move = self.look_in_opening_book(position)
         if opening_book_move != '0000':
+            self.stop_pondering()
             return opening_book_move
-        else:
-            return self.choose_move_recursive(position)
+        ponder_move = self.take_ponder_result(position, should_stop=should_stop)
+        if ponder_move != '0000':
+            return ponder_move
+        self.reroot_expansion_cache(position)
+        return self.choose_move_recursive(position, should_stop=should_stop)
 
     def remove_bad_uci(self, fen: str, bad_uci: str):
+        if self.binary_opening_book is not None:
+            self.binary_opening_book.remove_move(get_book_fen_hash(fen), bad_uci)
+            return
         uci_list = self.opening_book[fen]
         for i in range(len(uci_list)):
             if uci_list[i] == bad_uci:
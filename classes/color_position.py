@@ -1,8 +1,20 @@
 from typing import Dict, List
 from copy import deepcopy
+from utils.piece_square_tables import MATERIAL_VALUES, PAWN_CONTROL_MILLIS, PAWN_ATTACKED_SQUARES
+from utils.zobrist import PIECE_SQUARE_KEYS
 
 
 class ColorPosition:
+    """
+    Keeps two running totals that are updated on every piece change instead of being recounted by the evaluation:
+    material (sum of MATERIAL_VALUES over the pieces) and pawn control score (for each square the pawns attack, its
+    pawn control score once for the first pawn and half of it for every further pawn). The pawn control score is kept
+    in integer thousandths so that it does not depend on the order of the updates. pawn_attack_counts holds the number
+    of pawns attacking each square, and pawn_hash the Zobrist hash of the pawns alone.
+    A learned evaluation can also have a first-layer accumulator kept here (see simple_bot.nnue): accumulator is then
+    the sum of accumulator_weights[piece][square] over the pieces, and is updated with every piece change. Both are
+    None otherwise.
+    """
 
     def __init__(self, color: str, all_piece_squares: Dict[str, List[str]],
                  short_castle: bool = True, long_castle: bool = True):
@@ -10,12 +22,72 @@ class ColorPosition:
         self.all_piece_squares = deepcopy(all_piece_squares)
         self.short_castle = short_castle
         self.long_castle = long_castle
+        self.material = 0
+        self.pawn_control_millis = 0
+        self.pawn_attack_counts: Dict[str, int] = {}
+        self.pawn_hash = 0
+        self.accumulator = None
+        self.accumulator_weights = None
+        for piece in self.all_piece_squares:
+            for square in self.all_piece_squares[piece]:
+                self.add_to_totals(piece, square)
 
-    def copy(self):
-        return ColorPosition(color=self.color,
-                             all_piece_squares=self.all_piece_squares,
-                             short_castle=self.short_castle,
-                             long_castle=self.long_castle)
+    def copy(self, with_accumulator: bool = True):
+        """
+        :param with_accumulator: False to leave out the accumulator, e.g. for the throwaway copies used to test moves
+        for legality.
+        """
+        color_position_copy = ColorPosition(color=self.color, all_piece_squares={},
+                                            short_castle=self.short_castle, long_castle=self.long_castle)
+        color_position_copy.all_piece_squares = {piece: list(squares)
+                                                 for piece, squares in self.all_piece_squares.items()}
+        color_position_copy.material = self.material
+        color_position_copy.pawn_control_millis = self.pawn_control_millis
+        color_position_copy.pawn_attack_counts = self.pawn_attack_counts.copy()
+        color_position_copy.pawn_hash = self.pawn_hash
+        if with_accumulator and self.accumulator is not None:
+            color_position_copy.accumulator = self.accumulator.copy()
+            color_position_copy.accumulator_weights = self.accumulator_weights
+        return color_position_copy
+
+    def get_material(self) -> int:
+        return self.material
+
+    def get_pawn_control_score(self) -> float:
+        return self.pawn_control_millis / 1000
+
+    def add_to_totals(self, piece: str, square: str) -> None:
+        if self.accumulator is not None:
+            self.accumulator += self.accumulator_weights[piece][square]
+        if piece == 'K':
+            return
+        self.material += MATERIAL_VALUES[piece]
+        if piece == 'P':
+            self.pawn_hash ^= PIECE_SQUARE_KEYS[(self.color, 'P', square)]
+            control_millis = PAWN_CONTROL_MILLIS[self.color]
+            for attacked_square in PAWN_ATTACKED_SQUARES[self.color][square]:
+                n_attacking_pawns = self.pawn_attack_counts.get(attacked_square, 0)
+                self.pawn_control_millis += control_millis[attacked_square] if n_attacking_pawns == 0 else \
+                    control_millis[attacked_square] // 2
+                self.pawn_attack_counts[attacked_square] = n_attacking_pawns + 1
+
+    def remove_from_totals(self, piece: str, square: str) -> None:
+        if self.accumulator is not None:
+            self.accumulator -= self.accumulator_weights[piece][square]
+        if piece == 'K':
+            return
+        self.material -= MATERIAL_VALUES[piece]
+        if piece == 'P':
+            self.pawn_hash ^= PIECE_SQUARE_KEYS[(self.color, 'P', square)]
+            control_millis = PAWN_CONTROL_MILLIS[self.color]
+            for attacked_square in PAWN_ATTACKED_SQUARES[self.color][square]:
+                n_attacking_pawns = self.pawn_attack_counts[attacked_square]
+                if n_attacking_pawns == 1:
+                    self.pawn_control_millis -= control_millis[attacked_square]
+                    self.pawn_attack_counts.pop(attacked_square)
+                else:
+                    self.pawn_control_millis -= control_millis[attacked_square] // 2
+                    self.pawn_attack_counts[attacked_square] = n_attacking_pawns - 1
 
     def disable_short_castling(self) -> None:
         self.short_castle = False
@@ -67,6 +139,7 @@ class ColorPosition:
             for i in range(len(squares)):
                 curr_square = squares[i]
                 if curr_square == square:
+                    self.remove_from_totals(piece, square)
                     self.all_piece_squares[piece].pop(i)
                     if len(self.all_piece_squares[piece]) == 0:
                         self.all_piece_squares.pop(piece)
@@ -81,6 +154,7 @@ class ColorPosition:
         :param square:
         :return:
         """
+        self.add_to_totals(piece, square)
         if piece not in self.all_piece_squares:
             self.all_piece_squares[piece] = [square]
         else:
@@ -106,6 +180,12 @@ class ColorPosition:
             if curr_piece_squares[i] == origin_square:
                 self.all_piece_squares[piece].pop(i)
                 self.all_piece_squares[piece].append(destination_square)
+                if piece == 'P':
+                    self.remove_from_totals(piece, origin_square)
+                    self.add_to_totals(piece, destination_square)
+                elif self.accumulator is not None:
+                    self.accumulator += self.accumulator_weights[piece][destination_square] - \
+                        self.accumulator_weights[piece][origin_square]
                 break
 
     def get_occupied_squares(self) -> List[str]:
@@ -275,9 +275,18 @@ class Game:
         else:
             return f'{last_move_played} taken back.'
 
-    def play_computer_move(self, bot: Bot, return_move_for_gui: bool = False) -> Union[str, Tuple[str, LegalMove]]:
+    def play_computer_move(self, bot: Bot, return_move_for_gui: bool = False,
+                           best_move_uci: str = None) -> Union[str, Tuple[str, LegalMove]]:
+        """
+        :param bot:
+        :param return_move_for_gui:
+        :param best_move_uci: a move the bot already chose for the current position (e.g. on a worker thread). If None,
+        the bot is asked for a move here.
+        :return:
+        """
         legal_moves = self.current_position.get_all_legal_moves_for_side_to_move()
-        best_move_uci = bot.make_move(self.current_position)
+        if best_move_uci is None:
+            best_move_uci = bot.make_move(self.current_position)
         try:
             origin_square, destination_square = best_move_uci[:2], best_move_uci[2:4]
         except Exception:
@@ -1,9 +1,11 @@
 from typing import List, Dict
+from classes.attack_map import AttackMap, square_is_attacked
 from classes.color_position import ColorPosition, generate_starting_position_for_color
 from classes.move import LegalMove, VirtualMove
 from utils.board_functions import get_intervening_squares, LETTER_TO_NUM, NUM_TO_LETTER, scan_qbr_scope, scan_kn_scope, \
     check_squares_in_line, is_knight_move, PIECE_MOVE_TYPE_DICT, SQUARE_SCOPES_MAP, INT_SQUARES_MAP
 from utils.parse_notation import piece_to_symbol
+from utils.zobrist import hash_pieces, hash_position_state
 
 
 def opposite_color(color: str) -> str:
@@ -71,19 +73,66 @@ class Position:
                  en_passant_square: str = '-',
                  half_move_clock: int = 0, move_number: int = 1, flipped: bool = False):
         self.white_pieces = white_pieces
-        self.virtual_white_pieces = white_pieces.copy()
+        self.virtual_white_pieces = white_pieces.copy(with_accumulator=False)
         self.black_pieces = black_pieces
-        self.virtual_black_pieces = black_pieces.copy()
+        self.virtual_black_pieces = black_pieces.copy(with_accumulator=False)
         self.en_passant_square = en_passant_square
         self.half_move_clock = half_move_clock
         self.move_number = move_number
         self.side_to_move = side_to_move.lower()
         self.flipped = flipped  # for rendering on the gui
+        self.position_hash = None
+        self.attack_map = None
 
     def copy(self):
-        return Position(white_pieces=self.white_pieces.copy(), black_pieces=self.black_pieces.copy(),
-                        side_to_move=self.to_move(), en_passant_square=self.get_en_passant_square(),
-                        half_move_clock=self.get_half_move_clock(), move_number=self.get_move_number())
+        position_copy = Position(white_pieces=self.white_pieces.copy(), black_pieces=self.black_pieces.copy(),
+                                 side_to_move=self.to_move(), en_passant_square=self.get_en_passant_square(),
+                                 half_move_clock=self.get_half_move_clock(), move_number=self.get_move_number())
+        position_copy.position_hash = self.position_hash
+        return position_copy
+
+    def get_hash(self) -> int:
+        """
+        64-bit Zobrist hash of the position. Covers the same information as the FEN without the half-move clock and
+        move number, so two positions with the same hash count as the same position for repetition and for the
+        opening book.
+        :return:
+        """
+        if self.position_hash is None:
+            self.position_hash = hash_pieces('w', self.white_pieces.all_piece_squares) ^ \
+                                 hash_pieces('b', self.black_pieces.all_piece_squares) ^ \
+                                 hash_position_state(self.to_move(), self.get_castling_rights(),
+                                                     self.get_en_passant_square())
+        return self.position_hash
+
+    def get_pawn_hash(self) -> int:
+        """
+        Zobrist hash of the pawns of both colors, kept up to date by ColorPosition as pawns move, so positions with the
+        same pawn structure share it.
+        :return:
+        """
+        return self.white_pieces.pawn_hash ^ self.black_pieces.pawn_hash
+
+    def get_attack_map(self) -> AttackMap:
+        """
+        The squares covered by every piece of both colors, built on first use and kept until the next move is played.
+        :return:
+        """
+        if self.attack_map is None:
+            self.attack_map = AttackMap(self.white_pieces, self.black_pieces)
+        return self.attack_map
+
+    def get_pins(self, color: str) -> Dict[str, tuple]:
+        """
+        :return: {square of a piece of the color pinned to its king: (pinning pns, squares on the line of the pin)}
+        """
+        return self.get_attack_map().get_pins(color)
+
+    def get_checkers(self, color: str) -> List[str]:
+        """
+        :return: the pns of every piece giving check to the king of the color, e.g. ['Bb5']
+        """
+        return self.get_attack_map().get_checkers(color)
 
     def to_move(self) -> str:
         return self.side_to_move
@@ -100,6 +149,7 @@ class Position:
 
     def change_side_to_move(self) -> None:
         self.side_to_move = opposite_color(self.to_move())
+        self.position_hash = None
 
     def get_castling_rights(self) -> str:
         castling_rights = ''
@@ -143,12 +193,14 @@ class Position:
 
     def set_en_passant_square(self, square: str) -> None:
         self.en_passant_square = square
+        self.position_hash = None
 
     def get_en_passant_square(self) -> str:
         return self.en_passant_square
 
     def remove_en_passant_square(self) -> None:
         self.en_passant_square = '-'
+        self.position_hash = None
 
     def get_pieces_by_color(self, color: str, virtual: bool = False) -> ColorPosition:
         if color == 'w':
@@ -228,52 +280,27 @@ class Position:
         """
         possible_captures = []
         to_move = self.to_move()
-        own_pieces = self.get_pieces_by_color(to_move)
-        occupied_squares = self.get_occupied_squares()
-        for piece in own_pieces.list_unique_piece_types():
-            if piece != 'P' and square != self.get_en_passant_square():
-                allowed_move_types = PIECE_MOVE_TYPE_DICT[piece]
-                origin_squares = own_pieces.get_piece_type_squares(piece)
-                for origin_sq in origin_squares:
-                    scopes = SQUARE_SCOPES_MAP[origin_sq]
-                    for move_type in allowed_move_types:
-                        destination_squares = scopes[move_type]
-                        if square not in destination_squares:
-                            continue
-                        if f'{origin_sq}{square}' in INT_SQUARES_MAP:
-                            intervening_squares = INT_SQUARES_MAP[f'{origin_sq}{square}']['int']
-                            blocked = any([int_sq in occupied_squares for int_sq in intervening_squares])
-                            if not blocked:
-                                virtual_move = VirtualMove(to_move, piece, origin_sq, square)
-                                is_legal = self.virtual_move_is_legal(virtual_move)
-                                if is_legal:
-                                    possible_captures.append(self.translate_virtual_move_to_legal(virtual_move))
-                        else:
-                            virtual_move = VirtualMove(to_move, piece, origin_sq, square)
-                            is_legal = self.virtual_move_is_legal(virtual_move)
-                            if is_legal:
-                                possible_captures.append(self.translate_virtual_move_to_legal(virtual_move))
-            elif piece == 'P':
-                pawn_squares = own_pieces.get_piece_type_squares('P')
-                for pawn_sq in pawn_squares:
-                    attacked_squares = self.scan_pawn_attacked_squares(to_move, pawn_sq)
-                    if square in attacked_squares:
-                        virtual_move = VirtualMove(to_move, piece, pawn_sq, square)
-                        is_legal = self.virtual_move_is_legal(virtual_move)
-                        promotion = virtual_move.results_in_promotion()
-                        if is_legal and promotion:
-                            for pp in ('Q', 'R', 'N', 'B'):
-                                possible_captures.append(self.translate_virtual_move_to_legal(virtual_move, pp))
-                        elif is_legal and not promotion:
-                            possible_captures.append(self.translate_virtual_move_to_legal(virtual_move))
+        for pns in self.get_attack_map().square_attackers[to_move].get(square, []):
+            piece = pns[0]
+            if piece != 'P' and square == self.get_en_passant_square():
+                continue
+            virtual_move = VirtualMove(to_move, piece, pns[1:], square)
+            if not self.virtual_move_is_legal(virtual_move):
+                continue
+            if piece == 'P' and virtual_move.results_in_promotion():
+                for pp in ('Q', 'R', 'N', 'B'):
+                    possible_captures.append(self.translate_virtual_move_to_legal(virtual_move, pp))
+            else:
+                possible_captures.append(self.translate_virtual_move_to_legal(virtual_move))
         return possible_captures
 
     def is_under_check(self, color: str, virtual: bool = False) -> bool:
-        own_pieces = self.get_pieces_by_color(color, virtual)
-        own_king_position = own_pieces.get_king_square()
+        own_king_position = self.get_pieces_by_color(color, virtual).get_king_square()
         opposing_side = opposite_color(color)
-        squares_attacked_by_opponent = self.scan_all_squares_attacked_by_color(opposing_side, virtual)
-        return own_king_position in squares_attacked_by_opponent
+        if not virtual:
+            return self.get_attack_map().is_attacked_by(own_king_position, opposing_side)
+        return square_is_attacked(own_king_position, opposing_side, self.get_pieces_by_color(opposing_side, True),
+                                  self.get_pieces_by_color(color, True))
 
     def check_for_disambiguation(self, color: str, piece: str, origin_square: str, destination_square: str) -> str:
         piece_positions = self.get_pieces_by_color(color)
@@ -299,11 +326,17 @@ class Position:
             return 'r'
         return 's'
 
-    def process_legal_move(self, move: LegalMove) -> str:
+    def process_legal_move(self, move: LegalMove, generate_notation: bool = True) -> str:
+        """
+        :param move:
+        :param generate_notation: if False, skips working out the notation (disambiguation, check and mate) and returns
+        ''. For searches that only need the resulting position.
+        :return: the move in standard algebraic notation, prefixed by the move number e.g. '12... Nxe4+'
+        """
         color_moved = move.get_color()
         opposing_color = opposite_color(color_moved)
         notation_move_number = self.get_move_number()
-        if move.piece_moved not in ('K', 'P'):
+        if move.piece_moved not in ('K', 'P') and generate_notation:
             disambiguation = self.check_for_disambiguation(color_moved, move.piece_moved,
                                                            move.origin_square, move.destination_square)
         else:
@@ -350,8 +383,13 @@ class Position:
 
         if move.pawn_promotion_required():
             self.get_pieces_by_color(color_moved).promote_pawn(move.destination_square, move.promotion_piece)
-        self.virtual_white_pieces = self.white_pieces.copy()
-        self.virtual_black_pieces = self.black_pieces.copy()
+        self.virtual_white_pieces = self.white_pieces.copy(with_accumulator=False)
+        self.virtual_black_pieces = self.black_pieces.copy(with_accumulator=False)
+        self.position_hash = None
+        self.attack_map = None
+        if not generate_notation:
+            self.change_side_to_move()
+            return ''
 
         # PRODUCE NOTATION
         notation_move_str = f'{notation_move_number}. ' if color_moved == 'w' else f'{notation_move_number}... '
@@ -446,12 +484,12 @@ class Position:
         squares_that_must_not_be_attacked = [f'f{back_rank}', f'g{back_rank}'] if side == 'k' \
             else [f'c{back_rank}', f'd{back_rank}']
 
-        squares_attacked_by_opponent = self.scan_all_squares_attacked_by_color(opposing_color)
+        attack_map = self.get_attack_map()
         occupied_squares = self.get_occupied_squares()
 
         if any([square in occupied_squares for square in squares_to_be_empty]):
             return False
-        if any([square in squares_attacked_by_opponent for square in squares_that_must_not_be_attacked]):
+        if any([attack_map.is_attacked_by(square, opposing_color) for square in squares_that_must_not_be_attacked]):
             return False
         return True
 
@@ -484,8 +522,8 @@ class Position:
             else:
                 opposing_piece_squares.remove_piece_on_square(f"{file}4")
         results_in_check = self.is_under_check(side_attempting_move, virtual=True)
-        self.virtual_white_pieces = self.white_pieces.copy()
-        self.virtual_black_pieces = self.black_pieces.copy()
+        self.virtual_white_pieces = self.white_pieces.copy(with_accumulator=False)
+        self.virtual_black_pieces = self.black_pieces.copy(with_accumulator=False)
         return not results_in_check
 
     def translate_virtual_move_to_legal(self, virtual_move: VirtualMove, promotion_piece: str = None) -> LegalMove:
@@ -567,32 +605,10 @@ class Position:
         return self.get_all_legal_moves_for_color(self.to_move())
 
     def get_piece_scope_dict(self, color: str) -> Dict[str, List[str]]:
-        piece_scope_dict = {}
-        piece_positions = self.get_pieces_by_color(color)
-        occupied_squares = self.get_occupied_squares()
-        for piece in piece_positions.list_unique_piece_types():
-            origin_squares = piece_positions.get_piece_type_squares(piece)
-            if piece != 'P':
-                allowed_move_types = PIECE_MOVE_TYPE_DICT[piece]
-                for origin_sq in origin_squares:
-                    dict_key = f'{piece}{origin_sq}'
-                    piece_scope_dict[dict_key] = []
-                    scopes = SQUARE_SCOPES_MAP[origin_sq]
-                    for move_type in allowed_move_types:
-                        destination_squares = scopes[move_type]
-                        for dest_sq in destination_squares:
-                            if f'{origin_sq}{dest_sq}' in INT_SQUARES_MAP:
-                                intervening_squares = INT_SQUARES_MAP[f'{origin_sq}{dest_sq}']['int']
-                                blocked = any([int_sq in occupied_squares for int_sq in intervening_squares])
-                                if not blocked:
-                                    piece_scope_dict[dict_key].append(dest_sq)
-                            else:
-                                piece_scope_dict[dict_key].append(dest_sq)
-            else:
-                for pawn_sq in origin_squares:
-                    dict_key = f'P{pawn_sq}'
-                    piece_scope_dict[dict_key] = self.scan_pawn_attacked_squares(color, pawn_sq)
-        return piece_scope_dict
+        """
+        :return: {pns: [squares covered]} for every piece of the color. Shared with the attack map, so not to be changed.
+        """
+        return self.get_attack_map().piece_scopes[color]
 
 
 def generate_starting_position() -> Position:
@@ -1,4 +1,5 @@
 from os import path
+from threading import Thread, Event
 from classes.move import LegalMove
 import PySimpleGUI as sg
 import PySimpleGUI.PySimpleGUI
@@ -21,7 +22,7 @@ FEN_SYMBOL_TO_PIECE = {'P': 'wpawn', 'K': 'wking', 'Q': 'wqueen', 'B': 'wbishop'
 intro_text = ('Enter moves in standard algebraic notation, or click on a piece and then a destination square to move it.\n'
               'If using notation, always use uppercase for non-pawn pieces.\n'
               'Give all files in lowercase. Do not include any spaces.\n ')
-# buttons: 'Flip board' 'Show moves' 'Show FEN' 'Restart game' 'Take back last move'
+# buttons: 'Flip board' 'Show moves' 'Show FEN' 'Restart game' 'Take back last move' 'Stop bot'
 
 ALL_SQUARE_KEYS = []
 for i in '01234567':
@@ -127,11 +128,29 @@ def get_path_to_image(filename: str) -> str:
 
 
 def get_opening_book_path() -> str:
+    """
+    :return: the binary opening book if it has been made from fen_uci.json (see simple_bot/binary_book.py), otherwise
+    fen_uci.json.
+    """
     try:
-        filepath = path.join(sys._MEIPASS, 'opening_book', 'fen_uci.json')
+        directory = path.join(sys._MEIPASS, 'opening_book')
     except Exception:
-        filepath = path.join('.', 'simple_bot', 'opening_book', 'fen_uci.json')
-    return filepath
+        directory = path.join('.', 'simple_bot', 'opening_book')
+    binary_filepath = path.join(directory, 'fen_uci.bin')
+    if path.isfile(binary_filepath):
+        return binary_filepath
+    return path.join(directory, 'fen_uci.json')
+
+
+def get_tablebase_path() -> Union[str, None]:
+    """
+    :return: the endgame table directory if there is one (see simple_bot/tablebase.py), otherwise None.
+    """
+    try:
+        directory = path.join(sys._MEIPASS, 'tablebases')
+    except Exception:
+        directory = path.join('.', 'simple_bot', 'tablebases')
+    return directory if path.isdir(directory) else None
 
 
 def get_image_path_from_square(position: Position, square: str, highlight: bool = False) -> str:
@@ -208,7 +227,8 @@ def generate_layout(game: Game, output_from_prev_input: str = '', game_end_text:
         - The chessboard showing the current position.
         - output_from_prev_input: Depending on the last action, it could be the last move played, the FEN of the current position, or an error message from an invalid input.
         - Field to input the move in standard algebraic notation, followed by the button 'Enter move'. If the game is over, this section is replaced by a text line showing game_end_text.
-        - The row of buttons: Flip board, Show moves, Show FEN, Restart game, Take back last move.
+        - The row of buttons: Flip board, Show moves, Show FEN, Restart game, Take back last move. A Stop bot button is
+        also in this row, hidden except while the bot is thinking.
 
     :param game:
     :param output_from_prev_input:
@@ -233,7 +253,7 @@ def generate_layout(game: Game, output_from_prev_input: str = '', game_end_text:
         layout += [
             [sg.Text('', key='-INPUTPROMPT-', visible=False), sg.InputText(key='-INPUT-', focus=True, visible=False),
              sg.Button('Enter move', bind_return_key=True, visible=False)]]
-    layout += [[sg.Button('Flip board'), sg.Button('Show moves'), sg.Button('Show FEN'), sg.Button('Restart game'), sg.Button('Take back last move')]]
+    layout += [[sg.Button('Flip board'), sg.Button('Show moves'), sg.Button('Show FEN'), sg.Button('Restart game'), sg.Button('Take back last move'), sg.Button('Stop bot', visible=False)]]
     return layout
 
 
@@ -284,13 +304,68 @@ def create_input_move_prompt(game):
     return prompt
 
 
+def search_for_bot_move(bot, position, stop_event, window_closed, window):
+    """
+    Runs on a worker thread. Posts the chosen move back to the window as a -BOTMOVE- event, or the exception as a
+    -BOTERROR- event. Posts nothing once window_closed is set.
+    """
+    try:
+        best_move_uci = bot.make_move(position, should_stop=stop_event.is_set)
+    except Exception as e:
+        if not window_closed.is_set():
+            window.write_event_value('-BOTERROR-', e)
+    else:
+        if not window_closed.is_set():
+            window.write_event_value('-BOTMOVE-', best_move_uci)
+
+
 def play_computer_move(bot, game, window):
+    """
+    Searches for the bot's move on a worker thread while keeping the window responsive. While the bot is thinking, the
+    board can be flipped, the moves and FEN can be shown, and the Stop bot button makes the bot play the best move it
+    has found so far. Other inputs are ignored until the bot has moved. Once the bot has moved and the game goes on,
+    the bot ponders on the opponent's time.
+    :return: True if the window was closed, i.e. the program should exit.
+    """
     window['-TEXT-'].update('Bot is thinking.')
+    window['Stop bot'].update(visible=True)
     bot_color = game.current_position.to_move()
-    res, move = game.play_computer_move(bot, True)
+    stop_event = Event()
+    window_closed = Event()
+    search_thread = Thread(target=search_for_bot_move,
+                           args=(bot, game.current_position.copy(), stop_event, window_closed, window), daemon=True)
+    search_thread.start()
+    while True:
+        event, values = window.read()
+        if event == sg.WIN_CLOSED:
+            window_closed.set()
+            stop_event.set()
+            search_thread.join()
+            return True
+        if event == 'Flip board':
+            game.current_position.flip_position()
+            input_text = values['-INPUT-']
+            update_layout(game, window, 'Bot is thinking.', input_text=input_text)
+        elif event == 'Show moves':
+            display_moves(game)
+        elif event == 'Show FEN':
+            window['-TEXT-'].update(game.current_position.generate_fen())
+        elif event == 'Stop bot':
+            stop_event.set()
+            window['-TEXT-'].update('Stopping bot.')
+        elif event == '-BOTERROR-':
+            window['Stop bot'].update(visible=False)
+            sg.popup_error(UNHANDLED_ERROR_MESSAGE, str(values[event]))
+            return True
+        elif event == '-BOTMOVE-':
+            best_move_uci = values[event]
+            break
+    window['Stop bot'].update(visible=False)
+    res, move = game.play_computer_move(bot, True, best_move_uci=best_move_uci)
     game_end_check = game.check_game_end_conditions()
     if game_end_check == 'N':
         update_window_layout_after_move_game_continues(game, move, res, window)
+        bot.start_pondering(game.current_position)
         return False
     else:
         update_layout(game, window, res, game_end_text=game_end_check)
@@ -312,7 +387,7 @@ def main(game):
     bot_color = main_menu_results['bot_color']
     playing_against_bot = main_menu_results['bot']
     if playing_against_bot:
-        bot = Bot(quick_evaluate, breadth=3, aggression=1, fluctuation=0.15, assumed_opp_aggresion=1, opening_book_path=main_menu_results['opening_book'])
+        bot = Bot(quick_evaluate, breadth=3, aggression=1, fluctuation=0.15, assumed_opp_aggresion=1, opening_book_path=main_menu_results['opening_book'], tablebase_path=get_tablebase_path(), lazy_leaf_evaluation=True)
     else:
         bot = None
     if playing_against_bot and bot_color == 'w':
@@ -480,6 +555,8 @@ def main(game):
             if exit_signal:
                 break
     window.close()
+    if bot is not None:
+        bot.close()
 
 
 def update_window_layout_after_move_game_continues(game, move, res, window):
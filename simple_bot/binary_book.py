@@ -0,0 +1,141 @@
+import json
+import mmap
+import struct
+import sys
+from random import choices
+from typing import Dict, Iterable, List, Set, Tuple
+from classes.position import Position
+from simple_bot.transposition_table import pack_uci, unpack_uci, PROMOTION_TO_CODE
+from utils.board_functions import SQUARE_TO_INDEX
+from utils.parse_fen import parse_full_fen
+
+BINARY_BOOK_FILE_EXTENSION = '.bin'
+RECORD = struct.Struct('<QHH')  # (POSITION HASH, PACKED MOVE, WEIGHT), SORTED BY HASH THEN MOVE
+HASH = struct.Struct('<Q')
+MAX_WEIGHT = 65535
+
+
+def get_book_fen_hash(book_fen: str) -> int:
+    """
+    :param book_fen: a FEN without the half-move clock and move number, as used for the keys of fen_uci.json.
+    :return: the hash of the position, as given by Position.get_hash.
+    """
+    return parse_full_fen(book_fen + ' 0 1').get_hash()
+
+
+def is_packable_uci(uci: str) -> bool:
+    return len(uci) in (4, 5) and uci[:2] in SQUARE_TO_INDEX and uci[2:4] in SQUARE_TO_INDEX and \
+        uci[4:] in PROMOTION_TO_CODE
+
+
+def write_binary_book(records: Iterable[Tuple[int, str, int]], file_path: str) -> int:
+    """
+    Sorts the records and writes them to a binary book. Records for the same position and move are added together.
+    :param records: (position hash, UCI, weight) tuples.
+    :param file_path:
+    :return: the number of records written.
+    """
+    weights: Dict[Tuple[int, int], int] = {}
+    for position_hash, uci, weight in records:
+        if not is_packable_uci(uci):
+            raise ValueError(f'Invalid UCI in opening book: {uci}')
+        key = (position_hash, pack_uci(uci))
+        weights[key] = weights.get(key, 0) + weight
+    with open(file_path, 'wb') as writefile:
+        for position_hash, packed_move in sorted(weights):
+            writefile.write(RECORD.pack(position_hash, packed_move,
+                                        min(weights[(position_hash, packed_move)], MAX_WEIGHT)))
+    return len(weights)
+
+
+def convert_json_book(json_path: str, binary_path: str) -> int:
+    """
+    Converts an opening book in the fen_uci.json format. Every move gets weight 1. Keys that are not valid FENs and
+    moves that are not UCI strings are skipped, like the checks in Bot.__init__.
+    :return: the number of records written.
+    """
+    with open(json_path, 'r') as readfile:
+        opening_book = json.load(readfile)
+    records = []
+    for fen, uci_list in opening_book.items():
+        if type(uci_list) != list:
+            continue
+        try:
+            position_hash = get_book_fen_hash(fen)
+        except ValueError:
+            continue
+        for uci in uci_list:
+            if type(uci) == str and is_packable_uci(uci):
+                records.append((position_hash, uci, 1))
+    return write_binary_book(records, binary_path)
+
+
+class BinaryOpeningBook:
+    """
+    Opening book of fixed-size records sorted by position hash, memory-mapped and probed by binary search, so opening
+    the book does not read it and a lookup costs only a few record reads however big the book is.
+    """
+
+    def __init__(self, file_path: str):
+        with open(file_path, 'rb') as readfile:
+            self.book = mmap.mmap(readfile.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.book) % RECORD.size != 0:
+            self.book.close()
+            raise ValueError(f'{file_path} is not a binary opening book.')
+        self.n_records = len(self.book) // RECORD.size
+        self.removed_moves: Set[Tuple[int, int]] = set()
+
+    def close(self) -> None:
+        self.book.close()
+
+    def find_first_record(self, position_hash: int) -> int:
+        """
+        :return: index of the first record for the position, or of the first record after it if there is none.
+        """
+        low, high = 0, self.n_records
+        while low < high:
+            middle = (low + high) // 2
+            if HASH.unpack_from(self.book, middle * RECORD.size)[0] < position_hash:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get_moves(self, position_hash: int) -> List[Tuple[str, int]]:
+        """
+        :return: (UCI, weight) of every book move for the position.
+        """
+        moves = []
+        index = self.find_first_record(position_hash)
+        while index < self.n_records:
+            record_hash, packed_move, weight = RECORD.unpack_from(self.book, index * RECORD.size)
+            if record_hash != position_hash:
+                break
+            if (position_hash, packed_move) not in self.removed_moves:
+                moves.append((unpack_uci(packed_move), weight))
+            index += 1
+        return moves
+
+    def choose_move(self, position: Position) -> str:
+        """
+        :return: a book move picked at random in proportion to its weight, or '0000' if the position is not in the book.
+        """
+        moves = self.get_moves(position.get_hash())
+        if not moves:
+            return '0000'
+        return choices([move[0] for move in moves], weights=[move[1] for move in moves])[0]
+
+    def remove_move(self, position_hash: int, uci: str) -> None:
+        """
+        Stops the move being played for this object. The file is not changed.
+        """
+        self.removed_moves.add((position_hash, pack_uci(uci)))
+
+
+if __name__ == '__main__':
+    # e.g. python -m simple_bot.binary_book simple_bot/opening_book/fen_uci.json simple_bot/opening_book/fen_uci.bin
+    if len(sys.argv) != 3:
+        print('Usage: python -m simple_bot.binary_book <JSON book> <binary book>')
+        sys.exit(1)
+    n_written = convert_json_book(sys.argv[1], sys.argv[2])
+    print(f'Wrote {n_written} moves to {sys.argv[2]}')
@@ -0,0 +1,360 @@
+import argparse
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from classes.position import Position
+
+# BIT i OF A BITBOARD IS THE SQUARE ON FILE i % 8 AND RANK i // 8 (a1 = 0, b1 = 1, ..., h8 = 63). A POSITION IS 12
+# BITBOARDS, ONE FOR EACH PIECE OF EACH COLOR IN THE ORDER OF PIECE_ORDER
+PIECE_ORDER = ['P', 'N', 'B', 'R', 'Q', 'K']
+COLOR_OFFSETS = {'w': 0, 'b': 6}
+SQUARE_BITS = {f'{f}{r}': 1 << ((r - 1) * 8 + i) for i, f in enumerate('abcdefgh') for r in range(1, 9)}
+
+FULL = np.uint64(0xFFFFFFFFFFFFFFFF)
+NOT_A_FILE = np.uint64(0xFEFEFEFEFEFEFEFE)
+NOT_H_FILE = np.uint64(0x7F7F7F7F7F7F7F7F)
+NOT_AB_FILES = np.uint64(0xFCFCFCFCFCFCFCFC)
+NOT_GH_FILES = np.uint64(0x3F3F3F3F3F3F3F3F)
+RANKS = [np.uint64(0xFF << (8 * i)) for i in range(8)]
+
+# (SHIFT, MASK OF THE SQUARES THAT CAN BE REACHED WITHOUT WRAPPING AROUND THE BOARD). A POSITIVE SHIFT IS TOWARDS h8
+ORTHOGONAL_DIRECTIONS = [(8, FULL), (-8, FULL), (1, NOT_A_FILE), (-1, NOT_H_FILE)]
+DIAGONAL_DIRECTIONS = [(9, NOT_A_FILE), (7, NOT_H_FILE), (-7, NOT_A_FILE), (-9, NOT_H_FILE)]
+KNIGHT_DIRECTIONS = [(17, NOT_A_FILE), (15, NOT_H_FILE), (10, NOT_AB_FILES), (6, NOT_GH_FILES),
+                     (-6, NOT_AB_FILES), (-10, NOT_GH_FILES), (-15, NOT_A_FILE), (-17, NOT_H_FILE)]
+# PAWN CAPTURE DIRECTIONS AND SINGLE PUSH SHIFT OF EACH COLOR
+PAWN_CAPTURE_DIRECTIONS = {'w': [(9, NOT_A_FILE), (7, NOT_H_FILE)], 'b': [(-7, NOT_A_FILE), (-9, NOT_H_FILE)]}
+PAWN_PUSHES = {'w': 8, 'b': -8}
+# RANK A PAWN LANDS ON AFTER ITS FIRST SINGLE PUSH, AND THE PROMOTION RANK
+PAWN_THIRD_RANKS = {'w': RANKS[2], 'b': RANKS[5]}
+PROMOTION_RANKS = {'w': RANKS[7], 'b': RANKS[0]}
+# (KING SQUARE, ROOK SQUARE, SQUARES THAT MUST BE EMPTY, SQUARES THAT MUST NOT BE ATTACKED) FOR SHORT, THEN LONG
+CASTLING_SQUARES = {color: [tuple(np.uint64(sum(SQUARE_BITS[f'{f}{rank}'] for f in files)) for files in squares)
+                            for squares in (('e', 'h', 'fg', 'fg'), ('e', 'a', 'bcd', 'cd'))]
+                    for color, rank in (('w', 1), ('b', 8))}
+
+
+def shift(bitboards: np.ndarray, direction: Tuple[int, np.uint64]) -> np.ndarray:
+    """
+    Moves every bit one step in direction, dropping bits that leave the board.
+    """
+    amount, mask = direction
+    if amount > 0:
+        return (bitboards << np.uint64(amount)) & mask
+    return (bitboards >> np.uint64(-amount)) & mask
+
+
+def slide(sliders: np.ndarray, empty: np.ndarray, direction: Tuple[int, np.uint64]) -> np.ndarray:
+    """
+    Squares covered in direction by the sliders, up to and including the first occupied square, with a Kogge-Stone
+    fill.
+    :param sliders: bitboards of sliders.
+    :param empty: bitboards of the empty squares.
+    """
+    amount, mask = direction
+    propagators = empty & mask
+    generators = sliders
+    for step in (amount, 2 * amount, 4 * amount):
+        generators = generators | (propagators & shift(generators, (step, FULL)))
+        propagators = propagators & shift(propagators, (step, FULL))
+    return shift(generators, direction)
+
+
+def popcount(bitboards: np.ndarray) -> np.ndarray:
+    return np.bitwise_count(bitboards).astype(np.int64)
+
+
+def encode_bitboards(positions: Sequence[Position]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :return: (N x 12 bitboards of the pieces, N booleans True where white is to move, N x 4 booleans of the castling
+    rights in the order KQkq, N bitboards of the en passant square or 0)
+    """
+    boards = np.zeros((len(positions), 12), dtype=np.uint64)
+    white_to_move = np.zeros(len(positions), dtype=bool)
+    castling_rights = np.zeros((len(positions), 4), dtype=bool)
+    en_passant = np.zeros(len(positions), dtype=np.uint64)
+    for i, position in enumerate(positions):
+        for color, offset in COLOR_OFFSETS.items():
+            all_piece_squares = position.get_pieces_by_color(color).all_piece_squares
+            for piece_symbol in all_piece_squares:
+                boards[i, offset + PIECE_ORDER.index(piece_symbol)] = \
+                    sum(SQUARE_BITS[square] for square in all_piece_squares[piece_symbol])
+        white_to_move[i] = position.to_move() == 'w'
+        castling_rights[i] = [right in position.get_castling_rights() for right in 'KQkq']
+        if position.get_en_passant_square() != '-':
+            en_passant[i] = SQUARE_BITS[position.get_en_passant_square()]
+    return boards, white_to_move, castling_rights, en_passant
+
+
+def get_attacks(boards: np.ndarray) -> np.ndarray:
+    """
+    :param boards: N x 12 bitboards as from encode_bitboards.
+    :return: N x 12 bitboards of the squares covered by the pieces of each bitboard, as in AttackMap.piece_scopes.
+    """
+    empty = ~np.bitwise_or.reduce(boards, axis=1)
+    attacks = np.zeros(boards.shape, dtype=np.uint64)
+    for color, offset in COLOR_OFFSETS.items():
+        for i, piece_symbol in enumerate(PIECE_ORDER):
+            pieces = boards[:, offset + i]
+            if piece_symbol == 'P':
+                directions, sliding = PAWN_CAPTURE_DIRECTIONS[color], False
+            elif piece_symbol == 'N':
+                directions, sliding = KNIGHT_DIRECTIONS, False
+            elif piece_symbol == 'K':
+                directions, sliding = ORTHOGONAL_DIRECTIONS + DIAGONAL_DIRECTIONS, False
+            else:
+                directions, sliding = get_slider_directions(piece_symbol), True
+            for direction in directions:
+                attacks[:, offset + i] |= slide(pieces, empty, direction) if sliding else shift(pieces, direction)
+    return attacks
+
+
+def get_slider_directions(piece_symbol: str) -> List[Tuple[int, np.uint64]]:
+    return {'B': DIAGONAL_DIRECTIONS, 'R': ORTHOGONAL_DIRECTIONS,
+            'Q': ORTHOGONAL_DIRECTIONS + DIAGONAL_DIRECTIONS}[piece_symbol]
+
+
+def get_pins(own: Dict[str, np.ndarray], enemy: Dict[str, np.ndarray], empty: np.ndarray) -> \
+        List[Tuple[Tuple[int, np.uint64], np.ndarray, np.ndarray]]:
+    """
+    :param own: {piece symbol: bitboards} of the color whose pins are wanted.
+    :param enemy: {piece symbol: bitboards} of the other color.
+    :param empty: bitboards of the empty squares.
+    :return: for each of the eight directions from the king, (direction, bitboards of the piece pinned along it or 0,
+    bitboards of the squares from the king to the pinning piece along it)
+    """
+    own_pieces = np.bitwise_or.reduce([own[piece_symbol] for piece_symbol in PIECE_ORDER])
+    pins = []
+    for directions, sliders in ((ORTHOGONAL_DIRECTIONS, enemy['R'] | enemy['Q']),
+                                (DIAGONAL_DIRECTIONS, enemy['B'] | enemy['Q'])):
+        for direction in directions:
+            first_piece = slide(own['K'], empty, direction) & own_pieces
+            pin_line = slide(own['K'], empty | first_piece, direction)
+            pinned = np.where(pin_line & sliders != 0, first_piece, np.uint64(0))
+            pins.append((direction, pinned, pin_line))
+    return pins
+
+
+def get_pinned_pieces(boards: np.ndarray, color: str) -> np.ndarray:
+    """
+    :return: N bitboards of the pieces of the color pinned to their king.
+    """
+    own, enemy = split_boards(boards, color)
+    empty = ~np.bitwise_or.reduce(boards, axis=1)
+    return np.bitwise_or.reduce([pinned for _, pinned, _ in get_pins(own, enemy, empty)])
+
+
+def split_boards(boards: np.ndarray, color: str) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    offset, enemy_offset = COLOR_OFFSETS[color], COLOR_OFFSETS['b' if color == 'w' else 'w']
+    return {piece_symbol: boards[:, offset + i] for i, piece_symbol in enumerate(PIECE_ORDER)}, \
+        {piece_symbol: boards[:, enemy_offset + i] for i, piece_symbol in enumerate(PIECE_ORDER)}
+
+
+def king_is_attacked(king: np.ndarray, enemy: Dict[str, np.ndarray], empty: np.ndarray, color: str) -> np.ndarray:
+    """
+    :return: N booleans, True where the king of the color is attacked by a piece of enemy.
+    """
+    attackers = np.zeros(king.shape, dtype=np.uint64)
+    for direction in KNIGHT_DIRECTIONS:
+        attackers |= shift(king, direction) & enemy['N']
+    for direction in PAWN_CAPTURE_DIRECTIONS[color]:
+        attackers |= shift(king, direction) & enemy['P']
+    for direction in ORTHOGONAL_DIRECTIONS:
+        attackers |= slide(king, empty, direction) & (enemy['R'] | enemy['Q'])
+    for direction in DIAGONAL_DIRECTIONS:
+        attackers |= slide(king, empty, direction) & (enemy['B'] | enemy['Q'])
+    return attackers != 0
+
+
+def count_pawn_moves(pawns: np.ndarray, color: str, empty: np.ndarray, enemy_pieces: np.ndarray,
+                     targets: np.ndarray, capture_line: np.ndarray = None) -> np.ndarray:
+    """
+    Pushes and captures (not en passant) of the pawns of the color onto targets, four for each promotion. Every pawn
+    reaches each square through at most one push or capture direction, so the bits of each can be counted.
+    :param capture_line: if given, captures are only counted onto these squares.
+    """
+    promotion_rank = PROMOTION_RANKS[color]
+    single_pushes = shift(pawns, (PAWN_PUSHES[color], FULL)) & empty
+    double_pushes = shift(single_pushes & PAWN_THIRD_RANKS[color], (PAWN_PUSHES[color], FULL)) & empty
+    destinations = [single_pushes & targets, double_pushes & targets]
+    for direction in PAWN_CAPTURE_DIRECTIONS[color]:
+        captures = shift(pawns, direction) & enemy_pieces & targets
+        destinations.append(captures if capture_line is None else captures & capture_line)
+    return sum(popcount(squares) + 3 * popcount(squares & promotion_rank) for squares in destinations)
+
+
+def count_legal_moves_for_color(boards: np.ndarray, color: str, castling_rights: np.ndarray,
+                                en_passant: np.ndarray) -> np.ndarray:
+    """
+    :param boards: N x 12 bitboards of positions with the color to move.
+    :param castling_rights: N x 2 booleans, short then long, of the color.
+    :param en_passant: N bitboards of the en passant square or 0.
+    :return: N legal move counts, counted as Position.get_all_legal_moves_for_color does.
+    """
+    own, enemy = split_boards(boards, color)
+    own_pieces = np.bitwise_or.reduce([own[piece_symbol] for piece_symbol in PIECE_ORDER])
+    enemy_pieces = np.bitwise_or.reduce([enemy[piece_symbol] for piece_symbol in PIECE_ORDER])
+    empty = ~(own_pieces | enemy_pieces)
+    king = own['K']
+    enemy_color = 'b' if color == 'w' else 'w'
+    # THE KING DOES NOT BLOCK THE LINES OF THE SLIDERS IT STEPS BACK FROM
+    enemy_attacks = get_color_attacks(enemy, enemy_color, empty | king)
+
+    # CHECKERS, AND THE SQUARES A MOVE OTHER THAN A KING MOVE MUST END ON: THE CHECKER OR A SQUARE BETWEEN IT AND THE
+    # KING IN SINGLE CHECK, NONE IN DOUBLE CHECK
+    checkers = np.zeros(len(boards), dtype=np.uint64)
+    check_lines = np.zeros(len(boards), dtype=np.uint64)
+    for direction in KNIGHT_DIRECTIONS:
+        checkers |= shift(king, direction) & enemy['N']
+    for direction in PAWN_CAPTURE_DIRECTIONS[color]:
+        checkers |= shift(king, direction) & enemy['P']
+    for directions, sliders in ((ORTHOGONAL_DIRECTIONS, enemy['R'] | enemy['Q']),
+                                (DIAGONAL_DIRECTIONS, enemy['B'] | enemy['Q'])):
+        for direction in directions:
+            line = slide(king, empty, direction)
+            checking_sliders = line & sliders
+            checkers |= checking_sliders
+            check_lines |= np.where(checking_sliders != 0, line, np.uint64(0))
+    n_checkers = popcount(checkers)
+    targets = np.where(n_checkers == 0, FULL, np.where(n_checkers == 1, checkers | check_lines, np.uint64(0))) & \
+        ~own_pieces
+
+    pins = get_pins(own, enemy, empty)
+    pinned = np.bitwise_or.reduce([pinned_piece for _, pinned_piece, _ in pins])
+    free = {piece_symbol: own[piece_symbol] & ~pinned for piece_symbol in PIECE_ORDER}
+
+    # EACH SQUARE IS REACHED BY AT MOST ONE KNIGHT IN A GIVEN DIRECTION, AND BY AT MOST ONE SLIDER ALONG A GIVEN RAY, AS
+    # THE RAY OF ONE SLIDER STOPS AT THE NEXT ONE. SO THE BITS REACHED IN EACH DIRECTION CAN BE COUNTED
+    counts = np.zeros(len(boards), dtype=np.int64)
+    for direction in KNIGHT_DIRECTIONS:
+        counts += popcount(shift(free['N'], direction) & targets)
+    for direction in ORTHOGONAL_DIRECTIONS:
+        counts += popcount(slide(free['R'] | free['Q'], empty, direction) & targets)
+    for direction in DIAGONAL_DIRECTIONS:
+        counts += popcount(slide(free['B'] | free['Q'], empty, direction) & targets)
+    counts += count_pawn_moves(free['P'], color, empty, enemy_pieces, targets)
+
+    # A PINNED PIECE CAN ONLY MOVE ALONG ITS PIN LINE: A SLIDER THAT MOVES ALONG THAT LINE TYPE ANYWHERE ON IT, A PAWN
+    # FORWARD IF PINNED ALONG ITS FILE OR ONTO THE PINNING PIECE IF PINNED DIAGONALLY, AND A KNIGHT NOWHERE
+    for direction, pinned_piece, pin_line in pins:
+        diagonal = direction in DIAGONAL_DIRECTIONS
+        line_sliders = own['Q'] | (own['B'] if diagonal else own['R'])
+        counts += np.where(pinned_piece & line_sliders != 0, popcount(pin_line & ~pinned_piece & targets), 0)
+        pinned_pawn = pinned_piece & own['P']
+        if abs(direction[0]) == 8:
+            counts += count_pawn_moves(pinned_pawn, color, empty, np.uint64(0), targets)
+        elif diagonal:
+            counts += count_pawn_moves(pinned_pawn, color, np.uint64(0), enemy_pieces, targets, capture_line=pin_line)
+
+    # EN PASSANT: EACH OF THE (AT MOST TWO) CAPTURES IS PLAYED OUT ON THE BITBOARDS AND KEPT IF THE KING IS NOT LEFT
+    # ATTACKED, WHICH COVERS PINS, CHECKS AND THE TWO PAWNS LEAVING THE SAME RANK AT ONCE
+    captured_pawn = shift(en_passant, (-PAWN_PUSHES[color], FULL)) & enemy['P']
+    enemy_color_directions = PAWN_CAPTURE_DIRECTIONS[enemy_color]
+    for direction in enemy_color_directions:
+        capturing_pawn = shift(en_passant, direction) & own['P']
+        empty_after = (empty | capturing_pawn | captured_pawn) & ~en_passant
+        enemy_after = enemy | {'P': enemy['P'] & ~captured_pawn}
+        legal = (capturing_pawn != 0) & (captured_pawn != 0) & \
+            ~king_is_attacked(king, enemy_after, empty_after, color)
+        counts += legal
+
+    counts += popcount(np.bitwise_or.reduce([shift(king, direction)
+                                             for direction in ORTHOGONAL_DIRECTIONS + DIAGONAL_DIRECTIONS]) &
+                       ~own_pieces & ~enemy_attacks)
+    for side, (king_square, rook_square, squares_to_be_empty, squares_not_attacked) in \
+            enumerate(CASTLING_SQUARES[color]):
+        counts += castling_rights[:, side] & (n_checkers == 0) & (king == king_square) & \
+            (own['R'] & rook_square != 0) & (~empty & squares_to_be_empty == 0) & \
+            (enemy_attacks & squares_not_attacked == 0)
+    return counts
+
+
+def get_color_attacks(pieces: Dict[str, np.ndarray], color: str, empty: np.ndarray) -> np.ndarray:
+    """
+    :return: N bitboards of the squares covered by any of the pieces of the color.
+    """
+    attacks = np.zeros(empty.shape, dtype=np.uint64)
+    for direction in PAWN_CAPTURE_DIRECTIONS[color]:
+        attacks |= shift(pieces['P'], direction)
+    for direction in KNIGHT_DIRECTIONS:
+        attacks |= shift(pieces['N'], direction)
+    for direction in ORTHOGONAL_DIRECTIONS + DIAGONAL_DIRECTIONS:
+        attacks |= shift(pieces['K'], direction)
+    for direction in ORTHOGONAL_DIRECTIONS:
+        attacks |= slide(pieces['R'] | pieces['Q'], empty, direction)
+    for direction in DIAGONAL_DIRECTIONS:
+        attacks |= slide(pieces['B'] | pieces['Q'], empty, direction)
+    return attacks
+
+
+def count_legal_moves(boards: np.ndarray, white_to_move: np.ndarray, castling_rights: np.ndarray,
+                      en_passant: np.ndarray) -> np.ndarray:
+    """
+    Legal move counts of the side to move in each position, from the arrays given by encode_bitboards.
+    :return: N legal move counts.
+    """
+    counts = np.zeros(len(boards), dtype=np.int64)
+    for color, rows, rights in (('w', white_to_move, castling_rights[:, :2]),
+                                ('b', ~white_to_move, castling_rights[:, 2:])):
+        if rows.any():
+            counts[rows] = count_legal_moves_for_color(boards[rows], color, rights[rows], en_passant[rows])
+    return counts
+
+
+def bitboard_to_squares(bitboard: int) -> List[str]:
+    return [square for square, bit in SQUARE_BITS.items() if bitboard & bit]
+
+
+def find_mismatches(positions: Sequence[Position]) -> List[Tuple[int, str]]:
+    """
+    Cross-checks the batch kernels against the single-position move generator and attack map.
+    :return: (index of the position, what differs) for every difference found.
+    """
+    boards, white_to_move, castling_rights, en_passant = encode_bitboards(positions)
+    attacks = get_attacks(boards)
+    legal_move_counts = count_legal_moves(boards, white_to_move, castling_rights, en_passant)
+    pinned_pieces = {color: get_pinned_pieces(boards, color) for color in COLOR_OFFSETS}
+    mismatches = []
+    for i, position in enumerate(positions):
+        attack_map = position.get_attack_map()
+        if legal_move_counts[i] != len(position.get_all_legal_moves_for_side_to_move()):
+            mismatches.append((i, 'legal move count'))
+        for color, offset in COLOR_OFFSETS.items():
+            if sorted(bitboard_to_squares(int(pinned_pieces[color][i]))) != sorted(attack_map.get_pins(color)):
+                mismatches.append((i, f'pins of {color}'))
+            for j, piece_symbol in enumerate(PIECE_ORDER):
+                covered_squares = set()
+                for pns, squares in attack_map.piece_scopes[color].items():
+                    if pns[0] == piece_symbol:
+                        covered_squares.update(squares)
+                if set(bitboard_to_squares(int(attacks[i, offset + j]))) != covered_squares:
+                    mismatches.append((i, f'attacks of {piece_symbol} of {color}'))
+    return mismatches
+
+
+if __name__ == '__main__':
+    # e.g. python -m simple_bot.bitboards --positions 2000
+    from simple_bot.prescreen import generate_benchmark_positions
+    parser = argparse.ArgumentParser(description='Cross-check and time the bitboard kernels against Position.')
+    parser.add_argument('--positions', type=int, default=1000, help='positions from random games to test on.')
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+    test_positions = generate_benchmark_positions(arguments.positions, seed=arguments.seed)
+    found_mismatches = find_mismatches(test_positions)
+    print(f'{len(found_mismatches)} mismatches in {len(test_positions)} positions')
+    for index, difference in found_mismatches[:20]:
+        print(test_positions[index].generate_fen(), difference)
+    start = time.perf_counter()
+    encoded = encode_bitboards(test_positions)
+    encoding_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    count_legal_moves(*encoded)
+    get_attacks(encoded[0])
+    kernel_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for test_position in test_positions:
+        test_position.copy().get_all_legal_moves_for_side_to_move()
+    print(f'encoding {encoding_seconds:.3f} s, counting moves and attacks {kernel_seconds:.3f} s, '
+          f'Position {time.perf_counter() - start:.3f} s')
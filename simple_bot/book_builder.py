@@ -0,0 +1,288 @@
+import argparse
+import heapq
+import json
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Iterator, List, Tuple
+from classes.game import Game
+from simple_bot.binary_book import RECORD, MAX_WEIGHT, BINARY_BOOK_FILE_EXTENSION
+from simple_bot.transposition_table import pack_uci
+from utils.parse_fen import parse_full_fen
+
+RESULT_INDEX = {'1-0': 0, '1/2-1/2': 1, '0-1': 2}  # INDEX OF THE WHITE WIN, DRAW AND BLACK WIN COUNTS
+COMMENT_OR_VARIATION = re.compile(r'\{[^}]*\}|;[^\n]*|\$\d+')
+MOVE_NUMBER = re.compile(r'^\d+\.+')
+GAMES_PER_TASK = 200
+
+MoveStats = Dict[Tuple[int, str], list]
+
+
+def strip_variations(movetext: str) -> str:
+    """
+    Removes comments, NAGs and (possibly nested) variations from PGN movetext.
+    """
+    movetext = COMMENT_OR_VARIATION.sub(' ', movetext)
+    main_line = []
+    depth = 0
+    for char in movetext:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth = max(0, depth - 1)
+        elif depth == 0:
+            main_line.append(char)
+    return ''.join(main_line)
+
+
+def get_san_moves(movetext: str) -> List[str]:
+    moves = []
+    for token in strip_variations(movetext).split():
+        token = MOVE_NUMBER.sub('', token).rstrip('+#!?')
+        if token and token not in ('1-0', '0-1', '1/2-1/2', '*'):
+            moves.append(token)
+    return moves
+
+
+def read_pgn_games(file_path: str) -> Iterator[Tuple[Dict[str, str], str]]:
+    """
+    Reads a PGN file one game at a time, so the file can be any size.
+    :return: (tag pairs, movetext) of each game.
+    """
+    tags: Dict[str, str] = {}
+    movetext_lines: List[str] = []
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as readfile:
+        for line in readfile:
+            line = line.strip()
+            if line.startswith('[') and line.endswith(']'):
+                if movetext_lines:
+                    yield tags, ' '.join(movetext_lines)
+                    tags, movetext_lines = {}, []
+                name, _, value = line[1:-1].partition(' ')
+                tags[name] = value.strip().strip('"')
+            elif line and not line.startswith('%'):
+                movetext_lines.append(line)
+    if movetext_lines:
+        yield tags, ' '.join(movetext_lines)
+
+
+def replay_games(games: List[Tuple[Dict[str, str], str]], max_plies: int) -> MoveStats:
+    """
+    Plays the first max_plies moves of each game and counts every (position, move) pair with the game results. A
+    game is cut short at the first move that cannot be read.
+    :return: {(position hash, UCI): [book FEN, games, white wins, draws, black wins]}
+    """
+    move_stats: MoveStats = {}
+    for tags, movetext in games:
+        try:
+            game = Game(parse_full_fen(tags['FEN'])) if 'FEN' in tags else Game()
+        except ValueError:
+            continue
+        result_index = RESULT_INDEX.get(tags.get('Result', '*'))
+        for san in get_san_moves(movetext)[:max_plies]:
+            position_hash = game.current_position.get_hash()
+            book_fen = game.current_position.generate_fen().rsplit(' ', maxsplit=2)[0]
+            try:
+                legal_move = game.process_input_notation(san, return_move_for_gui=True)[1]
+            except (ValueError, KeyError, IndexError):
+                break
+            key = (position_hash, legal_move.generate_uci())
+            if key not in move_stats:
+                move_stats[key] = [book_fen, 0, 0, 0, 0]
+            stats = move_stats[key]
+            stats[1] += 1
+            if result_index is not None:
+                stats[2 + result_index] += 1
+    return move_stats
+
+
+def format_stats_line(key: Tuple[int, str], stats: list) -> str:
+    """
+    One line of a spilled run: hash (16 hex digits, so the lines sort like the numbers), UCI, book FEN, games, white
+    wins, draws, black wins.
+    """
+    return f'{key[0]:016x}\t{key[1]}\t' + '\t'.join(str(value) for value in stats) + '\n'
+
+
+def parse_stats_line(line: str) -> Tuple[Tuple[int, str], list]:
+    hash_hex, uci, book_fen, *counts = line.rstrip('\n').split('\t')
+    return (int(hash_hex, 16), uci), [book_fen] + [int(count) for count in counts]
+
+
+def spill_run(move_stats: MoveStats, directory: str) -> str:
+    """
+    Writes the counts to a temporary file sorted by (position hash, UCI).
+    :return: the file path.
+    """
+    file_descriptor, file_path = tempfile.mkstemp(suffix='.run', dir=directory)
+    with os.fdopen(file_descriptor, 'w') as writefile:
+        for key in sorted(move_stats):
+            writefile.write(format_stats_line(key, move_stats[key]))
+    return file_path
+
+
+def read_run(file_path: str) -> Iterator[Tuple[Tuple[int, str], list]]:
+    with open(file_path, 'r') as readfile:
+        for line in readfile:
+            yield parse_stats_line(line)
+
+
+def merge_runs(run_paths: List[str]) -> Iterator[Tuple[Tuple[int, str], list]]:
+    """
+    Merges sorted runs, adding up the counts of the same (position hash, UCI) across runs.
+    """
+    current_key, current_stats = None, None
+    for key, stats in heapq.merge(*[read_run(run_path) for run_path in run_paths], key=lambda item: item[0]):
+        if key == current_key:
+            for i in range(1, len(stats)):
+                current_stats[i] += stats[i]
+        else:
+            if current_key is not None:
+                yield current_key, current_stats
+            current_key, current_stats = key, stats
+    if current_key is not None:
+        yield current_key, current_stats
+
+
+def get_mover_score(book_fen: str, stats: list) -> float:
+    """
+    :return: points per decided or drawn game for the side that played the move, or 0.5 if no result is known.
+    """
+    games_with_result = stats[2] + stats[3] + stats[4]
+    if games_with_result == 0:
+        return 0.5
+    wins = stats[2] if book_fen.split(' ')[1] == 'w' else stats[4]
+    return (wins + 0.5 * stats[3]) / games_with_result
+
+
+def group_by_position(merged: Iterator[Tuple[Tuple[int, str], list]]) -> \
+        Iterator[Tuple[int, str, List[Tuple[str, list]]]]:
+    """
+    :return: (position hash, book FEN, [(UCI, counts), ...]) for each position, in hash order.
+    """
+    current_hash, current_fen, current_moves = None, None, []
+    for (position_hash, uci), stats in merged:
+        if position_hash != current_hash:
+            if current_moves:
+                yield current_hash, current_fen, current_moves
+            current_hash, current_fen, current_moves = position_hash, stats[0], []
+        current_moves.append((uci, stats))
+    if current_moves:
+        yield current_hash, current_fen, current_moves
+
+
+def write_book(merged: Iterator[Tuple[Tuple[int, str], list]], output_path: str, min_count: int,
+               min_score: float) -> int:
+    """
+    Writes the merged counts as a binary book (weight = number of games) if output_path ends in .bin, otherwise as a
+    JSON book in the fen_uci.json format. Moves played in fewer than min_count games, or scoring below min_score for the
+    side that played them, are left out.
+    :return: the number of moves written.
+    """
+    n_written = 0
+    binary = output_path.endswith(BINARY_BOOK_FILE_EXTENSION)
+    with open(output_path, 'wb' if binary else 'w') as writefile:
+        separator = '\n'
+        if not binary:
+            writefile.write('{')
+        for position_hash, book_fen, moves in group_by_position(merged):
+            kept_moves = [(uci, stats) for uci, stats in moves
+                          if stats[1] >= min_count and get_mover_score(book_fen, stats) >= min_score]
+            if not kept_moves:
+                continue
+            n_written += len(kept_moves)
+            if binary:
+                for uci, stats in kept_moves:
+                    writefile.write(RECORD.pack(position_hash, pack_uci(uci), min(stats[1], MAX_WEIGHT)))
+            else:
+                writefile.write(f'{separator}   {json.dumps(book_fen)}: {json.dumps([move[0] for move in kept_moves])}')
+                separator = ',\n'
+        if not binary:
+            writefile.write('\n}\n')
+    return n_written
+
+
+def build_opening_book(pgn_paths: List[str], output_path: str, max_plies: int = 20, min_count: int = 2,
+                       min_score: float = 0.0, workers: int = None, max_entries_in_memory: int = 10 ** 6,
+                       verbose: bool = False) -> int:
+    """
+    Builds an opening book from PGN files. Games are read one at a time and replayed in batches on a process pool.
+    The counts are kept in memory until there are more than max_entries_in_memory (position, move) pairs, then spilled
+    to a sorted temporary file. The spilled files are merged at the end, so memory use does not grow with the input.
+    :param pgn_paths:
+    :param output_path: ends in .bin for a binary book (see simple_bot.binary_book), otherwise JSON.
+    :param max_plies: moves of each game that go into the book.
+    :param min_count: fewest games a move must be played in to be kept.
+    :param min_score: lowest score (0 to 1) a move must get for the side playing it to be kept.
+    :param workers: processes used to replay games. None for one per CPU.
+    :param max_entries_in_memory:
+    :param verbose:
+    :return: the number of moves written.
+    """
+    move_stats: MoveStats = {}
+    run_paths: List[str] = []
+    output_directory = os.path.dirname(os.path.abspath(output_path))
+    with tempfile.TemporaryDirectory(dir=output_directory) as run_directory:
+
+        def add_counts(batch_stats: MoveStats) -> None:
+            for key, stats in batch_stats.items():
+                if key in move_stats:
+                    existing_stats = move_stats[key]
+                    for i in range(1, len(stats)):
+                        existing_stats[i] += stats[i]
+                else:
+                    move_stats[key] = stats
+            if len(move_stats) > max_entries_in_memory:
+                run_paths.append(spill_run(move_stats, run_directory))
+                move_stats.clear()
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            max_pending = 2 * (workers or os.cpu_count() or 1)
+            pending = set()
+            batch: List[Tuple[Dict[str, str], str]] = []
+            n_games = 0
+            for pgn_path in pgn_paths:
+                for game in read_pgn_games(pgn_path):
+                    batch.append(game)
+                    n_games += 1
+                    if len(batch) < GAMES_PER_TASK:
+                        continue
+                    pending.add(executor.submit(replay_games, batch, max_plies))
+                    batch = []
+                    # NEVER HOLD MORE THAN A FEW BATCHES OF GAMES OR RESULTS AT ONCE
+                    while len(pending) >= max_pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            add_counts(future.result())
+                    if verbose and n_games % (GAMES_PER_TASK * 50) == 0:
+                        print(f'{n_games} games read')
+            if batch:
+                pending.add(executor.submit(replay_games, batch, max_plies))
+            for future in wait(pending).done:
+                add_counts(future.result())
+        run_paths.append(spill_run(move_stats, run_directory))
+        move_stats.clear()
+        if verbose:
+            print(f'{n_games} games read, merging {len(run_paths)} runs')
+        return write_book(merge_runs(run_paths), output_path, min_count=min_count, min_score=min_score)
+
+
+if __name__ == '__main__':
+    # e.g. python -m simple_bot.book_builder simple_bot/opening_book/fen_uci.bin games1.pgn games2.pgn --plies 16
+    parser = argparse.ArgumentParser(description='Build an opening book from PGN files.')
+    parser.add_argument('output', help='book to write. Ends in .bin for a binary book, otherwise JSON.')
+    parser.add_argument('pgn', nargs='+', help='PGN files to read.')
+    parser.add_argument('--plies', type=int, default=20, help='moves of each game to put in the book.')
+    parser.add_argument('--min-count', type=int, default=2, help='fewest games a move must be played in.')
+    parser.add_argument('--min-score', type=float, default=0.0,
+                        help='lowest score (0 to 1) a move must get for the side playing it.')
+    parser.add_argument('--workers', type=int, default=None, help='processes used. Default: one per CPU.')
+    parser.add_argument('--max-entries', type=int, default=10 ** 6,
+                        help='(position, move) pairs kept in memory before spilling to disk.')
+    arguments = parser.parse_args()
+    n_moves = build_opening_book(arguments.pgn, arguments.output, max_plies=arguments.plies,
+                                 min_count=arguments.min_count, min_score=arguments.min_score,
+                                 workers=arguments.workers, max_entries_in_memory=arguments.max_entries,
+                                 verbose=True)
+    print(f'Wrote {n_moves} moves to {arguments.output}')
@@ -0,0 +1,198 @@
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from classes.position import Position
+from simple_bot.bot1.evaluation import ACTIVITY_BASE_SCORE, CENTRAL_SQUARE_BONUS, SIXTH_RANK_PIECE_CONTROL_BONUS, \
+    SQUARE_AROUND_ENEMY_KING, DEVELOPMENT_SCORE_PENALTY, SEVENTH_RANK_BONUS, CENTRALIZED_KNIGHT_BONUS, \
+    BISHOP_PAIR_SCORE, ENDGAME_BACKWARD_KING_PENALTY, evaluate_threat
+from utils.board_functions import ALL_SQUARES, SQUARE_SCOPES_MAP, LETTER_TO_NUM
+from utils.piece_square_tables import MATERIAL_VALUES, PAWN_ATTACKED_SQUARES, PAWN_CONTROL_MILLIS
+
+# EACH POSITION IS ENCODED AS 64 PIECE CODES IN THE ORDER OF ALL_SQUARES (a1, a2, ..., h8). WHITE PIECES ARE POSITIVE,
+# BLACK PIECES NEGATIVE AND EMPTY SQUARES 0
+PIECE_CODES = {'P': 1, 'N': 2, 'B': 3, 'R': 4, 'Q': 5, 'K': 6}
+SQUARE_INDICES = {square: i for i, square in enumerate(ALL_SQUARES)}
+COLOR_SIGNS = {'w': 1, 'b': -1}
+ENDGAME_MATERIAL = 13  # BOTH SIDES BELOW THIS MUCH MATERIAL, AS IN evaluate_position
+
+# MATERIAL OF EACH CODE, INDEXED BY CODE + 6
+CODE_MATERIAL = np.zeros(13)
+for piece_symbol, code in PIECE_CODES.items():
+    if piece_symbol != 'K':
+        CODE_MATERIAL[code + 6] = MATERIAL_VALUES[piece_symbol]
+        CODE_MATERIAL[-code + 6] = MATERIAL_VALUES[piece_symbol]
+
+
+def square_mask(squares: Sequence[str]) -> np.ndarray:
+    mask = np.zeros(64, dtype=bool)
+    mask[[SQUARE_INDICES[square] for square in squares]] = True
+    return mask
+
+
+def scope_matrix(scopes: Dict[str, List[str]]) -> np.ndarray:
+    """
+    :return: 64x64 array with [origin, target] = 1 where a piece on origin covers target.
+    """
+    matrix = np.zeros((64, 64), dtype=np.int16)
+    for square, covered_squares in scopes.items():
+        for covered_square in covered_squares:
+            matrix[SQUARE_INDICES[square], SQUARE_INDICES[covered_square]] = 1
+    return matrix
+
+
+KNIGHT_SCOPES = scope_matrix({square: SQUARE_SCOPES_MAP[square]['N'] for square in ALL_SQUARES})
+KING_ZONES = scope_matrix({square: SQUARE_SCOPES_MAP[square]['K'] + [square] for square in ALL_SQUARES}).astype(bool)
+PAWN_SCOPES = {color: scope_matrix(PAWN_ATTACKED_SQUARES[color]) for color in ('w', 'b')}
+PAWN_CONTROL_ARRAYS = {color: np.array([PAWN_CONTROL_MILLIS[color][square] for square in ALL_SQUARES])
+                       for color in ('w', 'b')}
+
+# FOR EACH RAY DIRECTION AND DISTANCE: (SQUARES THE RAY CAN START FROM, THE SQUARES THAT FAR ALONG IT FROM EACH)
+SLIDER_STEPS: Dict[str, List[List[Tuple[np.ndarray, np.ndarray]]]] = {'f': [], 'r': [], 'd': []}
+for file_step, rank_step in ((0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)):
+    line_type = 'f' if file_step == 0 else 'r' if rank_step == 0 else 'd'
+    steps = []
+    for distance in range(1, 8):
+        origins, targets = [], []
+        for square in ALL_SQUARES:
+            file_num = LETTER_TO_NUM[square[0]] + file_step * distance
+            rank = int(square[1]) + rank_step * distance
+            if 1 <= file_num <= 8 and 1 <= rank <= 8:
+                origins.append(SQUARE_INDICES[square])
+                targets.append((file_num - 1) * 8 + rank - 1)
+        steps.append((np.array(origins), np.array(targets)))
+    SLIDER_STEPS[line_type].append(steps)
+
+# PER COVERED SQUARE, FOR A Q, R, B OR N OF EACH COLOR
+ACTIVITY_SQUARE_SCORES = {}
+for color, sixth_rank in (('w', '6'), ('b', '3')):
+    ACTIVITY_SQUARE_SCORES[color] = ACTIVITY_BASE_SCORE + \
+        CENTRAL_SQUARE_BONUS * square_mask(['d4', 'd5', 'e4', 'e5']) + \
+        SIXTH_RANK_PIECE_CONTROL_BONUS * square_mask([f'{f}{sixth_rank}' for f in 'abcdefgh'])
+SEVENTH_RANK_MASKS = {color: square_mask([f'{f}{rank}' for f in 'abcdefgh']) for color, rank in (('w', 7), ('b', 2))}
+
+# PIECE-SQUARE TERMS OF evaluate_position: MINOR PIECES ON THEIR BACK RANK, CENTRALIZED KNIGHTS, AND (IN THE ENDGAME)
+# KINGS ON THEIR FIRST THREE RANKS
+PLACEMENT_SCORES = {}
+ENDGAME_KING_SCORES = {}
+for color, home_ranks in (('w', '123'), ('b', '876')):
+    back_rank = square_mask([f'{f}{home_ranks[0]}' for f in 'abcdefgh'])
+    PLACEMENT_SCORES[color] = {'B': DEVELOPMENT_SCORE_PENALTY * back_rank,
+                               'N': DEVELOPMENT_SCORE_PENALTY * back_rank +
+                               CENTRALIZED_KNIGHT_BONUS * square_mask(['d4', 'd5', 'e4', 'e5'])}
+    ENDGAME_KING_SCORES[color] = \
+        ENDGAME_BACKWARD_KING_PENALTY * square_mask([f'{f}{r}' for f in 'abcdefgh' for r in home_ranks[:2]]) + \
+        ENDGAME_BACKWARD_KING_PENALTY / 2 * square_mask([f'{f}{home_ranks[2]}' for f in 'abcdefgh'])
+
+
+def encode_positions(positions: Sequence[Position]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: (N x 64 array of piece codes, array of N signs: 1 where white has just moved, -1 where black has)
+    """
+    codes = np.zeros((len(positions), 64), dtype=np.int8)
+    signs = np.empty(len(positions), dtype=np.int8)
+    for i, position in enumerate(positions):
+        for color, color_sign in COLOR_SIGNS.items():
+            all_piece_squares = position.get_pieces_by_color(color).all_piece_squares
+            for piece_symbol in all_piece_squares:
+                code = PIECE_CODES[piece_symbol] * color_sign
+                for square in all_piece_squares[piece_symbol]:
+                    codes[i, SQUARE_INDICES[square]] = code
+        signs[i] = -COLOR_SIGNS[position.to_move()]
+    return codes, signs
+
+
+def get_slider_coverage(pieces: np.ndarray, occupied: np.ndarray, line_types: str) -> np.ndarray:
+    """
+    :param pieces: N x 64, True where the slider is.
+    :param occupied: N x 64, True where any piece is.
+    :param line_types: the lines the slider moves along, e.g. 'fr' for a rook.
+    :return: N x 64, the number of these sliders covering each square.
+    """
+    coverage = np.zeros(pieces.shape, dtype=np.int16)
+    for line_type in line_types:
+        for steps in SLIDER_STEPS[line_type]:
+            # WHETHER THE RAY FROM EACH SQUARE IS STILL OPEN AT THE CURRENT DISTANCE
+            ray_open = pieces.copy()
+            for origins, targets in steps:
+                reached = ray_open[:, origins]
+                coverage[:, targets] += reached
+                ray_open[:, origins] = reached & ~occupied[:, targets]
+    return coverage
+
+
+def evaluate_encoded(codes: np.ndarray, signs: np.ndarray) -> np.ndarray:
+    """
+    Scores encoded positions (see encode_positions) from white's point of view, then turns each score to the side that
+    has just moved.
+    :return: array of N scores.
+    """
+    occupied = codes != 0
+    white_material = np.where(codes > 0, CODE_MATERIAL[codes + 6], 0).sum(axis=1)
+    black_material = np.where(codes < 0, CODE_MATERIAL[codes + 6], 0).sum(axis=1)
+    scores = white_material - black_material
+    is_endgame = (white_material < ENDGAME_MATERIAL) & (black_material < ENDGAME_MATERIAL)
+    king_zones = {color: KING_ZONES[np.argmax(codes == PIECE_CODES['K'] * color_sign, axis=1)]
+                  for color, color_sign in COLOR_SIGNS.items()}
+    for color, color_sign in COLOR_SIGNS.items():
+        other_color = 'b' if color == 'w' else 'w'
+        pieces = {piece_symbol: codes == code * color_sign for piece_symbol, code in PIECE_CODES.items()}
+        # PAWN CONTROL: FULL SCORE FOR THE FIRST PAWN ON A SQUARE, HALF FOR EACH MORE, IN THOUSANDTHS AS ColorPosition
+        pawn_attack_counts = pieces['P'].astype(np.int16) @ PAWN_SCOPES[color]
+        control_millis = PAWN_CONTROL_ARRAYS[color]
+        pawn_control_millis = (pawn_attack_counts > 0) * control_millis + \
+            np.maximum(pawn_attack_counts - 1, 0) * (control_millis // 2)
+        color_score = pawn_control_millis.sum(axis=1) / 1000
+        color_score += (pieces['B'] * PLACEMENT_SCORES[color]['B']).sum(axis=1)
+        color_score += (pieces['N'] * PLACEMENT_SCORES[color]['N']).sum(axis=1)
+        color_score += is_endgame * (pieces['K'] * ENDGAME_KING_SCORES[color]).sum(axis=1)
+        n_bishops = pieces['B'].sum(axis=1)
+        n_opposing_bishops = (codes == -PIECE_CODES['B'] * color_sign).sum(axis=1)
+        color_score += ((n_bishops == 2) & (n_opposing_bishops == 1)) * BISHOP_PAIR_SCORE
+        # ACTIVITY: EVERY SQUARE COVERED BY A Q, R, B OR N, AND EVERY SQUARE AROUND THE ENEMY KING COVERED BY A PAWN
+        rook_coverage = get_slider_coverage(pieces['R'], occupied, 'fr')
+        piece_coverage = pieces['N'].astype(np.int16) @ KNIGHT_SCOPES + rook_coverage + \
+            get_slider_coverage(pieces['B'], occupied, 'd') + get_slider_coverage(pieces['Q'], occupied, 'frd')
+        color_score += (piece_coverage * ACTIVITY_SQUARE_SCORES[color]).sum(axis=1)
+        color_score += (rook_coverage * SEVENTH_RANK_MASKS[color]).sum(axis=1) * SEVENTH_RANK_BONUS
+        color_score += ((piece_coverage + (pawn_attack_counts > 0)) * king_zones[other_color]).sum(axis=1) * \
+            SQUARE_AROUND_ENEMY_KING
+        scores = scores + color_sign * color_score
+    return signs * scores
+
+
+def evaluate_batch(positions: Sequence[Position]) -> np.ndarray:
+    """
+    Material, pawn control, piece placement and piece activity of many positions at once, as array operations. These
+    are the terms of quick_evaluate that need no search of the position: checkmates, hanging material, threats, pins
+    and passed pawns are left out.
+    :return: array of scores, each for the side that has just moved in its position.
+    """
+    if not positions:
+        return np.zeros(0)
+    codes, signs = encode_positions(positions)
+    return evaluate_encoded(codes, signs)
+
+
+class BatchEvaluation:
+    """
+    evaluate_batch in the form the searches take an evaluation function. Call it on one position like quick_evaluate,
+    or give evaluate_many a list to score it in one batch (select_top_n_moves does this for all the moves of a
+    position). There is no 'threat' in the dicts it returns. The threat scores the searches need are worked out by
+    threat_func through get_threat.
+    """
+
+    def __init__(self, threat_func: Callable[[Position], float] = evaluate_threat):
+        self.threat_func = threat_func
+
+    def __call__(self, position: Position, lower_bound: float = None, upper_bound: float = None) -> Dict[str, float]:
+        """
+        The bounds are accepted for use with lazy leaf evaluation, and not needed.
+        """
+        return self.evaluate_many([position])[0]
+
+    def evaluate_many(self, positions: Sequence[Position]) -> List[Dict[str, float]]:
+        return [{'eval': float(score)} for score in evaluate_batch(positions)]
+
+    def get_threat(self, position: Position) -> float:
+        return self.threat_func(position)
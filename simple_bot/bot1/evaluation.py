@@ -1,13 +1,16 @@
-from typing import List, Iterable, Dict, Union
+import time
+from typing import Any, List, Iterable, Dict, Tuple, Union
 
+from classes.attack_map import AttackMap, LINE_TYPE_SLIDERS, square_is_attacked, square_is_attacked_on_board
 from classes.color_position import ColorPosition
-from utils.board_functions import scan_qbr_scope, scan_kn_scope, get_intervening_squares, INT_SQUARES_MAP, LINE_EXTEND_MAP, PIECE_MOVE_TYPE_DICT
-from classes.move import LegalMove, VirtualMove
+from utils.board_functions import scan_qbr_scope, scan_kn_scope, get_intervening_squares, INT_SQUARES_MAP, LINE_EXTEND_MAP
+from classes.move import LegalMove
 from classes.position import Position, opposite_color
-from simple_bot.utils import branch_from_position, check_if_move_ends_game
+from simple_bot.utils import check_if_move_ends_game
+from utils.piece_square_tables import MATERIAL_VALUES
 
 SYMBOL_TO_PIECE = {'P': 'pawn', 'K': 'king', 'Q': 'queen', 'R': 'rook', 'B': 'bishop', 'N': 'knight'}
-MATERIAL_DICT = {'K': 10, 'P': 1, 'N': 3, 'B': 3, 'R': 5, 'Q': 9}
+MATERIAL_DICT = {'K': 10} | MATERIAL_VALUES
 ALL_SQUARES = []
 for f in 'abcdefgh':
     for r in '12345678':
@@ -16,48 +19,6 @@ for f in 'abcdefgh':
 # CHECKMATE SCORE
 CHECKMATE_SCORE = 999999
 
-# SCORES FOR SQUARES CONTROLLED BY PAWNS
-CENTRAL_FILE_4TH_RANK = 0.15
-CENTRAL_FILE_5TH_RANK = 0.18
-CENTRAL_FILE_6TH_RANK = 0.22
-BISHOP_FILE_4TH_RANK = 0.13
-BISHOP_FILE_5TH_RANK = 0.15
-BISHOP_FILE_6TH_RANK = 0.17
-SEVENTH_RANK = 0.2
-EIGHTH_RANK = 0.23
-KNIGHT_FILE_5TH_RANK = 0.13
-KNIGHT_FILE_6TH_RANK = 0.16
-ALL_OTHERS = 0.1
-
-SEVENTH_RANK_SCORES = {}
-for f in 'abcdefgh':
-    SEVENTH_RANK_SCORES[f] = SEVENTH_RANK
-EIGHTH_RANK_SCORES = {}
-for f in 'abcdefgh':
-    EIGHTH_RANK_SCORES[f] = EIGHTH_RANK
-SIXTH_RANK_SCORES = {'a': ALL_OTHERS, 'b': KNIGHT_FILE_6TH_RANK, 'c': BISHOP_FILE_6TH_RANK, 'd': CENTRAL_FILE_6TH_RANK,
-                     'e': CENTRAL_FILE_6TH_RANK, 'f': BISHOP_FILE_6TH_RANK, 'g': KNIGHT_FILE_6TH_RANK, 'h': ALL_OTHERS}
-FIFTH_RANK_SCORES = {'a': ALL_OTHERS, 'b': KNIGHT_FILE_5TH_RANK, 'c': BISHOP_FILE_5TH_RANK, 'd': CENTRAL_FILE_5TH_RANK,
-                     'e': CENTRAL_FILE_5TH_RANK, 'f': BISHOP_FILE_5TH_RANK, 'g': KNIGHT_FILE_5TH_RANK, 'h': ALL_OTHERS}
-FOURTH_RANK_SCORES = {'a': ALL_OTHERS, 'b': ALL_OTHERS, 'c': BISHOP_FILE_4TH_RANK, 'd': CENTRAL_FILE_4TH_RANK,
-                      'e': CENTRAL_FILE_4TH_RANK, 'f': BISHOP_FILE_4TH_RANK, 'g': ALL_OTHERS, 'h': ALL_OTHERS}
-RANK_SCORES = {'4': FOURTH_RANK_SCORES, '5': FIFTH_RANK_SCORES, '6': SIXTH_RANK_SCORES, '7': SEVENTH_RANK_SCORES, '8': EIGHTH_RANK_SCORES}
-WHITE_PAWN_CONTROL_SCORES = {}
-BLACK_PAWN_CONTROL_SCORES = {}
-for square in ALL_SQUARES:
-    file = square[0]
-    rank = square[1]
-    if rank in RANK_SCORES:
-        WHITE_PAWN_CONTROL_SCORES[square] = RANK_SCORES[rank][file]
-    else:
-        WHITE_PAWN_CONTROL_SCORES[square] = ALL_OTHERS
-
-for square in WHITE_PAWN_CONTROL_SCORES:
-    rank = int(square[1])
-    black_rank = 9 - rank
-    mirrored_square = square[0] + str(black_rank)
-    BLACK_PAWN_CONTROL_SCORES[mirrored_square] = WHITE_PAWN_CONTROL_SCORES[square]
-
 ACTIVITY_BASE_SCORE = 0.1  # BASE SCORE AWARDED FOR EACH SQUARE COVERED BY EACH PIECE (Q, R, B, N)
 CENTRAL_SQUARE_BONUS = 0.04  # ADDITIONAL SCORE AWARDED FOR EACH SQUARE IN e4, d4, e5, or d5 COVERED BY EACH PIECE (Q, R, B, N)
 SIXTH_RANK_PIECE_CONTROL_BONUS = 0.04  # ADDITIONAL SCORE AWARDED FOR EACH SQUARE ON THE SIXTH RANK COVERED BY EACH PIECE (Q, R, B, N)
@@ -88,6 +49,25 @@ MATERIAL_THREAT_SIMULTANEOUS_WITH_CHECK = 4
 OVERWHELMING_MATERIAL_THREAT_MULTIPLIER = 2
 ENDGAME_BACKWARD_KING_PENALTY = -0.4
 
+PAWN_STRUCTURE_CACHE_SIZE = 2 ** 14  # PAWN STRUCTURES KEPT BEFORE THE CACHE IS EMPTIED
+PAWN_STRUCTURE_CACHE: Dict[int, Dict[str, dict]] = {}
+
+# THE CONSTANTS evaluate_position ADDS TO THE SCORE A NUMBER OF TIMES, WHICH evaluate_features COUNTS (SEE tuner.py).
+# PRESSURED_PIECE_THREAT_SCORE ALSO GOES INTO THE THREAT SCORE
+EVAL_TERMS = ['ACTIVITY_BASE_SCORE', 'CENTRAL_SQUARE_BONUS', 'SIXTH_RANK_PIECE_CONTROL_BONUS',
+              'SQUARE_AROUND_ENEMY_KING', 'DEVELOPMENT_SCORE_PENALTY', 'SEVENTH_RANK_BONUS', 'CENTRALIZED_KNIGHT_BONUS', 'PASSED_PAWN_SCORE',
+              'PASSED_PAWN_ADVANCEMENT_BONUS_PER_RANK', 'ROOK_SEMI_OPEN_FILE_SCORE', 'ROOK_OPEN_FILE_SCORE',
+              'BISHOP_PAIR_SCORE', 'PRESSURED_PIECE_SCORE', 'PRESSURED_PIECE_THREAT_SCORE',
+              'UNIQUE_SQUARE_AROUND_ENEMY_KING_SCORE', 'SUPPORTED_QUEEN_AROUND_ENEMY_KING_SCORE',
+              'ENDGAME_BACKWARD_KING_PENALTY']
+
+# THE BLOCKS OF evaluate_position, IN THE ORDER THEY RUN, WHOSE TIME AND SCORE AN EvaluationProfile RECORDS. 'pieces'
+# AND 'pawns' (PASSED PAWNS AND PROMOTION THREATS) RUN ONCE FOR EACH PIECE. 'lazy_bounds' IS THE WORK ONLY THE BOUNDS
+# NEED. 'attack_map' IS MOSTLY BUILDING THE ATTACK MAP, IF THE POSITION DOES NOT HAVE IT YET. 'threats' ADDS UP THE
+# THREATS OF THE PIECES THAT ARE NOT HANGING, RECORDED BY THE EARLIER BLOCKS
+EVALUATION_BLOCKS = ['material', 'lazy_bounds', 'attack_map', 'check', 'pawn_structure', 'pieces', 'pawns',
+                     'activity', 'pressure_and_pins', 'hanging_material', 'threats', 'king_zone']
+
 
 def square_around_enemy_king(square: str, opposing_pieces_position: ColorPosition):
     enemy_king_position = opposing_pieces_position.get_king_square()
@@ -95,29 +75,107 @@ def square_around_enemy_king(square: str, opposing_pieces_position: ColorPositio
     return square in squares_around_king + [enemy_king_position]
 
 
+def reveal_x_ray_attacker(square: str, vacated_sq: str, boards: Dict[str, Dict[str, str]],
+                          attackers: Dict[str, List[str]]) -> None:
+    """
+    Adds the slider (of either color) that covers square once the piece on vacated_sq has left it.
+    """
+    map_key = f'{square}{vacated_sq}'
+    if map_key not in LINE_EXTEND_MAP:
+        return
+    sliders = LINE_TYPE_SLIDERS[INT_SQUARES_MAP[map_key]['line']]
+    for sq in LINE_EXTEND_MAP[map_key]:
+        for color in ('w', 'b'):
+            if sq in boards[color]:
+                if boards[color][sq] in sliders:
+                    attackers[color].append(f'{boards[color][sq]}{sq}')
+                return
+
+
+def capture_is_legal(square: str, pns: str, color: str, boards: Dict[str, Dict[str, str]],
+                     king_squares: Dict[str, str]) -> bool:
+    """
+    Whether the piece can capture on square without leaving its own king attacked, tried on the boards and undone.
+    """
+    own_board, opposing_board = boards[color], boards[opposite_color(color)]
+    captured_piece = opposing_board.pop(square)
+    moved_piece = own_board.pop(pns[1:])
+    own_board[square] = moved_piece
+    king_square = square if pns[0] == 'K' else king_squares[color]
+    is_legal = not square_is_attacked_on_board(king_square, opposite_color(color), opposing_board, own_board)
+    del own_board[square]
+    own_board[pns[1:]] = moved_piece
+    opposing_board[square] = captured_piece
+    return is_legal
+
+
 def evaluate_exchange_on_square(position: Position, square: str, initiating_capture: LegalMove) -> int:
     """
     Counts the amount of material that the side to move stands to gain from initiating a series of captures and
     recaptures on the given square. Both sides "dogpile" onto the square, sending their least valuable pieces to capture
     first, until one side cannot recapture.
+    The exchange is played out on the attacker lists of the square (from the attack map, plus the sliders uncovered
+    behind each piece that captures) and on a square-piece dict per color, without making any Position.
     :param initiating_capture:
     :param square:
     :param position:
     :return:
     """
-
+    attack_map = position.get_attack_map()
+    boards = {'w': position.white_pieces.get_square_piece_symbol_dict(),
+              'b': position.black_pieces.get_square_piece_symbol_dict()}
+    king_squares = {'w': position.white_pieces.get_king_square(), 'b': position.black_pieces.get_king_square()}
+    attackers = {color: list(attack_map.square_attackers[color].get(square, [])) for color in ('w', 'b')}
+    # THE ORDER OF THE PIECES IN THE ATTACK MAP, WHICH DECIDES BETWEEN CAPTURES BY PIECES OF THE SAME VALUE
+    piece_order = {pns: i for color in ('w', 'b') for i, pns in enumerate(attack_map.piece_scopes[color])}
+
+    color = initiating_capture.get_color()
+    origin_sq = initiating_capture.origin_square
     if not initiating_capture.is_en_passant_capture():
         captured_piece = position.look_at_square(square).upper()
+        del boards[opposite_color(color)][square]
     else:
         captured_piece = 'P'
-    position_after_capture = branch_from_position(position, initiating_capture)
-    possible_recaptures = position_after_capture.scan_all_captures_to_square(square)
-    material_gain = MATERIAL_DICT[captured_piece]
-    if not possible_recaptures:
-        return material_gain
-    else:
-        recapture = min(possible_recaptures, key=lambda x: MATERIAL_DICT[x.piece_moved])
-        return material_gain - evaluate_exchange_on_square(position_after_capture, square, recapture)
+        en_passant_pawn_sq = f'{square[0]}{5 if color == "w" else 4}'
+        del boards[opposite_color(color)][en_passant_pawn_sq]
+        reveal_x_ray_attacker(square, en_passant_pawn_sq, boards, attackers)
+    piece_on_square = initiating_capture.promotion_piece if initiating_capture.pawn_promotion_required() \
+        else initiating_capture.piece_moved
+    del boards[color][origin_sq]
+    boards[color][square] = piece_on_square
+    if initiating_capture.piece_moved == 'K':
+        king_squares[color] = square
+    if f'{initiating_capture.piece_moved}{origin_sq}' in attackers[color]:
+        attackers[color].remove(f'{initiating_capture.piece_moved}{origin_sq}')
+    reveal_x_ray_attacker(square, origin_sq, boards, attackers)
+
+    material_gains = [MATERIAL_DICT[captured_piece]]
+    color = opposite_color(color)
+    promotion_rank = {'w': '8', 'b': '1'}
+    while True:
+        candidates = sorted(attackers[color], key=lambda pns: (MATERIAL_DICT[pns[0]], piece_order[pns]))
+        recapturing_pns = next((pns for pns in candidates if capture_is_legal(square, pns, color, boards, king_squares)),
+                               None)
+        if recapturing_pns is None:
+            break
+        material_gains.append(MATERIAL_DICT[piece_on_square])
+        # A PAWN RECAPTURING ON THE LAST RANK BECOMES A QUEEN, THE FIRST OF THE PROMOTION MOVES GENERATED
+        piece_on_square = 'Q' if recapturing_pns[0] == 'P' and square[1] == promotion_rank[color] \
+            else recapturing_pns[0]
+        del boards[opposite_color(color)][square]
+        del boards[color][recapturing_pns[1:]]
+        boards[color][square] = piece_on_square
+        if recapturing_pns[0] == 'K':
+            king_squares[color] = square
+        attackers[color].remove(recapturing_pns)
+        reveal_x_ray_attacker(square, recapturing_pns[1:], boards, attackers)
+        color = opposite_color(color)
+
+    # EACH SIDE GAINS WHAT IT CAPTURES MINUS WHAT THE OTHER SIDE GAINS FROM THE REST OF THE EXCHANGE
+    material_gain = material_gains.pop()
+    while material_gains:
+        material_gain = material_gains.pop() - material_gain
+    return material_gain
 
 
 def find_material_hanging_on_square(position: Position, capture: LegalMove) -> int:
@@ -140,37 +198,22 @@ def find_material_hanging_on_square(position: Position, capture: LegalMove) -> i
     return 0
 
 
-def invert_piece_scope_dict(piece_scope_dict: Dict[str, List[str]]) -> Dict[str, List[str]]:
-    square_covering_piece_dict = {}
-    for piece_n_square in piece_scope_dict:
-        covered_squares = piece_scope_dict[piece_n_square]
-        for square in covered_squares:
-            if square not in square_covering_piece_dict:
-                square_covering_piece_dict[square] = [piece_n_square]
-            else:
-                square_covering_piece_dict[square].append(piece_n_square)
-    return square_covering_piece_dict
-
-
-def detect_battery_or_x_ray(target_sq: str, first_attacking_pns: str, square_piece_dict: Dict[str, str], color: str,
+def detect_battery_or_x_ray(target_sq: str, first_attacking_pns: str, attack_map: AttackMap, color: str,
                             x_ray_defense: bool = False) -> List[str]:
-    map_key = f'{target_sq}{first_attacking_pns[1:]}'
+    """
+    The pieces of the color lined up behind first_attacking_pns, each x-raying target_sq through the one in front.
+    :param x_ray_defense: If True, first_attacking_pns is an enemy piece and is left out of the returned list.
+    :return: e.g. ['Qd4', 'Rd1'] for a queen on d4 attacking d6 backed up by a rook on d1.
+    """
     pieces = [] if x_ray_defense else [first_attacking_pns]
-    line_type = INT_SQUARES_MAP[map_key]['line']
-    extended_line = LINE_EXTEND_MAP[map_key]
-    for sq in extended_line:
-        if sq in square_piece_dict:
-            piece = square_piece_dict[sq]
-            own_piece = piece.isupper() if color == 'w' else piece.islower()
-            if not own_piece or piece.upper() in ('P', 'K', 'N'):
-                break
-            if line_type not in PIECE_MOVE_TYPE_DICT[piece.upper()]:
-                break
-            pieces.append(f'{piece.upper()}{sq}')
+    front_sq, covered_sq = first_attacking_pns[1:], target_sq
+    while (pns := attack_map.get_x_ray_attacker(front_sq, covered_sq, color)) is not None:
+        pieces.append(pns)
+        front_sq, covered_sq = pns[1:], front_sq
     return pieces
 
 
-def is_pinned(king_sq: str, king_color: str, pns: str, target_sq: str, square_piece_dict: Dict[str, str], ignore_target_sq: bool=False) -> Union[str, None]:
+def is_pinned(king_sq: str, king_color: str, pns: str, target_sq: str, attack_map: AttackMap, ignore_target_sq: bool=False) -> Union[str, None]:
     """
     Returns the pinning piece and square (e.g. 'Re1') if the piece indicated by pns (Piece and square it is standing on. e.g. 'Ne5') is unable to move to target_sq because of an absolute pin. False otherwise.
     Note that this will return True only if it attempts to move out of the line of the pin. For example, a rook being pinned along the e-file will still be able to move along the e-file.
@@ -180,92 +223,207 @@ def is_pinned(king_sq: str, king_color: str, pns: str, target_sq: str, square_pi
     :param king_sq:
     :param pns:
     :param target_sq:
-    :param square_piece_dict:
+    :param attack_map:
     :return:
     """
-    map_key = f'{king_sq}{pns[1:]}'
-    try:
-        line_extended = LINE_EXTEND_MAP[map_key]
-    except KeyError:
+    pin = attack_map.get_pins(king_color).get(pns[1:])
+    if pin is None:
         return None
-    squares_between_king_and_pns, line_type = INT_SQUARES_MAP[map_key]['int'], INT_SQUARES_MAP[map_key]['line']
-    for int_sq in squares_between_king_and_pns:
-        if int_sq in square_piece_dict:
-            return None
-    for sq in line_extended:
-        if sq in square_piece_dict:
-            piece_at_square = square_piece_dict[sq]
-            if piece_at_square.upper() in ('P', 'K', 'N'):
-                return None
-            enemy_of_king = piece_at_square.islower() if king_color == 'w' else piece_at_square.isupper()
-            if not enemy_of_king:
-                return None
-            if line_type in PIECE_MOVE_TYPE_DICT[piece_at_square.upper()]:
-                if ignore_target_sq or not (target_sq in squares_between_king_and_pns or target_sq in line_extended):
-                    return f'{piece_at_square.upper()}{sq}'
-                else:
-                    return None
+    pinning_pns, pin_line = pin
+    if ignore_target_sq or target_sq not in pin_line:
+        return pinning_pns
     return None
 
 
-def count_pawns_in_front_on_file(square: str, color: str, square_piece_dict: Dict[str, str]) -> int:
-    file = square[0]
-    back_rank = 1 if color == 'w' else 8
-    if square == f'{file}{back_rank}':
-        destination_rank = 9 - back_rank
-        direction = 1 if color == 'w' else -1
-        squares_in_front = [f'{file}{i}' for i in range(back_rank + direction, destination_rank + direction, direction)]
-    else:
-        squares_in_front = LINE_EXTEND_MAP[f'{file}1{square}'] if color == 'w' else LINE_EXTEND_MAP[f'{file}8{square}']
-    return len([sq for sq in square_piece_dict if sq in squares_in_front and square_piece_dict[sq].upper() == 'P'])
+def count_pawns_in_front_on_file(square: str, color: str, pawn_ranks: Dict[str, List[int]]) -> int:
+    """
+    :param pawn_ranks: {file: [ranks of the pawns of both colors on the file]}, as in get_pawn_structure.
+    :return: the number of pawns of either color on the file of square, ahead of it for the color.
+    """
+    rank = int(square[1])
+    ranks_on_file = pawn_ranks.get(square[0], [])
+    if color == 'w':
+        return len([pawn_rank for pawn_rank in ranks_on_file if pawn_rank > rank])
+    return len([pawn_rank for pawn_rank in ranks_on_file if pawn_rank < rank])
 
 
-def quick_evaluate(position: Position) -> Dict[str, float]:
+def get_pawn_structure(position: Position) -> Dict[str, dict]:
+    """
+    The parts of the evaluation that depend only on where the pawns are. Kept in PAWN_STRUCTURE_CACHE by pawn hash, so
+    a pawn structure met before costs a lookup. The result is shared, so not to be changed.
+    :param position:
+    :return: {'pawn_ranks': {file: [ranks of the pawns of both colors]}, 'passed_pawns': {'w': [squares], 'b': [squares]}}
+    """
+    pawn_hash = position.get_pawn_hash()
+    if pawn_hash in PAWN_STRUCTURE_CACHE:
+        return PAWN_STRUCTURE_CACHE[pawn_hash]
+    pawn_ranks = {}
+    for color in ('w', 'b'):
+        for pawn_sq in position.get_pieces_by_color(color).get_piece_type_squares('P'):
+            if pawn_sq[0] not in pawn_ranks:
+                pawn_ranks[pawn_sq[0]] = [int(pawn_sq[1])]
+            else:
+                pawn_ranks[pawn_sq[0]].append(int(pawn_sq[1]))
+    passed_pawns = {}
+    for color in ('w', 'b'):
+        passed_pawns[color] = []
+        back_rank = '1' if color == 'w' else '8'
+        opposing_pawn_attack_counts = position.get_pieces_by_color(opposite_color(color)).pawn_attack_counts
+        for pawn_sq in position.get_pieces_by_color(color).get_piece_type_squares('P'):
+            if count_pawns_in_front_on_file(pawn_sq, color, pawn_ranks) > 0:
+                continue
+            yet_traversed_squares = LINE_EXTEND_MAP[f'{pawn_sq[0]}{back_rank}{pawn_sq}']
+            if not any([square_in_front in opposing_pawn_attack_counts for square_in_front in yet_traversed_squares]):
+                passed_pawns[color].append(pawn_sq)
+    if len(PAWN_STRUCTURE_CACHE) >= PAWN_STRUCTURE_CACHE_SIZE:
+        PAWN_STRUCTURE_CACHE.clear()
+    PAWN_STRUCTURE_CACHE[pawn_hash] = {'pawn_ranks': pawn_ranks, 'passed_pawns': passed_pawns}
+    return PAWN_STRUCTURE_CACHE[pawn_hash]
+
+
+def get_lazy_score(score: float, margins: Tuple[float, float], lower_bound: Union[float, None],
+                   upper_bound: Union[float, None]) -> Union[float, None]:
+    """
+    :param margins: most the rest of the evaluation can raise and lower score.
+    :return: score raised or lowered by the margin towards the bounds, if that is still below lower_bound or above
+    upper_bound. Otherwise None.
+    """
+    if lower_bound is not None and score + margins[0] < lower_bound:
+        return score + margins[0]
+    if upper_bound is not None and score - margins[1] > upper_bound:
+        return score - margins[1]
+    return None
+
+
+def get_lazy_margins(position: Position, attack_map: AttackMap,
+                     own_passed_pawns: Dict[str, int]) -> Tuple[float, float]:
+    """
+    Bounds the change to the score of evaluate_position after tier 2, with the terms as they are now so that the bounds
+    still hold after the tuner changes them. The number of times each term is still to be added is known by then,
+    except for the supported queens and the passed pawns that hang. The hanging material is taken to be all of the
+    material of the side that just moved. There is no bound after tier 1 tight enough to stop on, as every piece could
+    still score every activity term.
+    :param own_passed_pawns: {pns: ranks advanced} of the passed pawns of the side that just moved.
+    :return: (most the score can still rise, most it can still fall)
+    """
+    side_to_move = position.to_move()
+    side_evaluating_for = opposite_color(side_to_move)
+    own_pieces = position.get_pieces_by_color(side_evaluating_for)
+    opposing_pieces = position.get_pieces_by_color(side_to_move)
+    own_square_covering_piece_dict = attack_map.square_attackers[side_evaluating_for]
+    opposing_square_covering_piece_dict = attack_map.square_attackers[side_to_move]
+    n_pressured = len([sq for sq in opposing_pieces.get_occupied_squares()
+                       if sq in own_square_covering_piece_dict and sq not in opposing_pieces.pawn_attack_counts])
+    n_own_pressured = len([sq for sq in own_pieces.get_occupied_squares()
+                           if sq in opposing_square_covering_piece_dict and sq not in own_pieces.pawn_attack_counts])
+    king_zone_counts = []
+    for pieces, covering_piece_dict in ((opposing_pieces, own_square_covering_piece_dict),
+                                        (own_pieces, opposing_square_covering_piece_dict)):
+        covered = [sq for sq in attack_map.piece_scopes[pieces.color][f'K{pieces.get_king_square()}']
+                   if sq in covering_piece_dict]
+        queen_covered = [sq for sq in covered if any([pns[0] == 'Q' for pns in covering_piece_dict[sq]])]
+        king_zone_counts.append((len(covered), len(queen_covered)))
+    n_unique = king_zone_counts[0][0] - king_zone_counts[1][0]
+    # (TERM, FEWEST AND MOST TIMES IT IS STILL ADDED)
+    term_counts = [('PRESSURED_PIECE_THREAT_SCORE', n_pressured, n_pressured),
+                   ('PRESSURED_PIECE_SCORE', -n_own_pressured, -n_own_pressured),
+                   ('PASSED_PAWN_SCORE', -len(own_passed_pawns), 0),
+                   ('PASSED_PAWN_ADVANCEMENT_BONUS_PER_RANK', -sum(own_passed_pawns.values()), 0),
+                   ('UNIQUE_SQUARE_AROUND_ENEMY_KING_SCORE', n_unique, n_unique),
+                   ('SUPPORTED_QUEEN_AROUND_ENEMY_KING_SCORE', -king_zone_counts[1][1], king_zone_counts[0][1])]
+    most_raised, most_lowered = 0, own_pieces.get_material() + MATERIAL_DICT['K']
+    module_constants = globals()
+    for term, fewest, most in term_counts:
+        value = module_constants[term]
+        most_raised += max(fewest * value, most * value)
+        most_lowered -= min(fewest * value, most * value)
+    return most_raised, most_lowered
+
+
+def term_score(term: str, count: float, features: Union[Dict[str, float], None]) -> float:
+    """
+    What one of EVAL_TERMS adds to the score count times. count is also added to features if given, so that every
+    term the score gets is counted by evaluate_features.
+    """
+    if features is not None:
+        features[term] += count
+    return count * globals()[term]
+
+
+def evaluate_position(position: Position, lower_bound: float = None, upper_bound: float = None,
+                      with_score: bool = True, with_threat: bool = True,
+                      features: Dict[str, float] = None, profile: 'EvaluationProfile' = None) -> Dict[str, float]:
+    """
+    Evaluates in three tiers: material and pawn control, then piece placement and activity, then hanging material,
+    threats, pins, batteries and king safety. With bounds, stops after tier 2 once the score is further outside them
+    than tier 3 can move it (see get_lazy_margins). The score returned then is only known to lie outside the bounds,
+    and the dict has 'lazy': True. Bounds are not used when check is given, so mates are always found.
+    :param position:
+    :param lower_bound: the caller has no use for scores below this.
+    :param upper_bound: the caller has no use for scores above this.
+    :param with_score: False to skip the work only 'eval' needs. 'eval' is then wrong.
+    :param with_threat: False to skip the work only 'threat' needs. 'threat' is then wrong.
+    :param features: dict with a 0 for each of EVAL_TERMS, to have added to it the number of times each is added to
+    the score (less the times it is taken off). Leave the bounds out when given.
+    :param profile: to have the time taken and the score added by each of EVALUATION_BLOCKS recorded in it.
+    :return: {'eval': score for the side that just moved, 'threat': threat score}
+    """
+    if profile is not None:
+        profile.start()
     side_to_move = position.to_move()
     side_evaluating_for = opposite_color(side_to_move)
     score = 0
     threat_score = 0
-    opposing_material = 0
-    for piece in position.get_pieces_by_color(side_to_move).list_unique_piece_types():
-        if piece != 'K':
-            opposing_material += len(position.get_pieces_by_color(side_to_move).get_piece_type_squares(piece)) * MATERIAL_DICT[piece]
-    own_material = 0
-    for piece in position.get_pieces_by_color(side_evaluating_for).list_unique_piece_types():
-        if piece != 'K':
-            own_material += len(position.get_pieces_by_color(side_evaluating_for).get_piece_type_squares(piece)) * MATERIAL_DICT[piece]
+    opposing_material = position.get_pieces_by_color(side_to_move).get_material()
+    own_material = position.get_pieces_by_color(side_evaluating_for).get_material()
     material_difference = own_material - opposing_material
     score += material_difference
+    score += position.get_pieces_by_color(side_evaluating_for).get_pawn_control_score()
+    score -= position.get_pieces_by_color(side_to_move).get_pawn_control_score()
+    if profile is not None:
+        profile.mark('material', score, threat_score)
+    use_bounds = (lower_bound is not None or upper_bound is not None) and \
+        not square_is_attacked(position.get_pieces_by_color(side_to_move).get_king_square(), side_evaluating_for,
+                               position.get_pieces_by_color(side_evaluating_for),
+                               position.get_pieces_by_color(side_to_move))
+    if profile is not None:
+        profile.mark('lazy_bounds', score, threat_score)
     overwhelming_material_multiplier = OVERWHELMING_MATERIAL_THREAT_MULTIPLIER if opposing_material < 10 and material_difference >= 5 else 1
     is_endgame = own_material < 13 and opposing_material < 13
     threat_contributing_pieces = {}
-    square_piece_dict = position.white_pieces.get_square_piece_symbol_dict() | position.black_pieces.get_square_piece_symbol_dict(lowercase=True)
+    attack_map = position.get_attack_map()
+    square_piece_dict = attack_map.square_piece_dict
     own_squares_occupied = position.get_pieces_by_color(side_evaluating_for).get_occupied_squares()
     own_king_square = position.get_pieces_by_color(side_evaluating_for).get_king_square()
     opposing_squares_occupied = position.get_pieces_by_color(side_to_move).get_occupied_squares()
-    own_piece_covered_square_dict = position.get_piece_scope_dict(side_evaluating_for)
-    opposing_piece_covered_square_dict = position.get_piece_scope_dict(side_to_move)
-    own_square_covering_piece_dict = invert_piece_scope_dict(own_piece_covered_square_dict)
-    opposing_square_covering_piece_dict = invert_piece_scope_dict(opposing_piece_covered_square_dict)
+    own_piece_covered_square_dict = attack_map.piece_scopes[side_evaluating_for]
+    opposing_piece_covered_square_dict = attack_map.piece_scopes[side_to_move]
+    own_square_covering_piece_dict = attack_map.square_attackers[side_evaluating_for]
+    opposing_square_covering_piece_dict = attack_map.square_attackers[side_to_move]
     opposing_king_square = position.get_pieces_by_color(side_to_move).get_king_square()
     check_given = opposing_king_square in own_square_covering_piece_dict
+    if profile is not None:
+        profile.mark('attack_map', score, threat_score)
     if check_given:
         threat_score += BASE_CHECK_THREAT_SCORE
         potential_escape_squares = [esc_sq for esc_sq in opposing_piece_covered_square_dict[f'K{opposing_king_square}'] if esc_sq not in opposing_squares_occupied and esc_sq not in own_square_covering_piece_dict]
-        no_legal_king_move = not any([position.virtual_move_is_legal(VirtualMove(side_to_move, 'K', opposing_king_square, attempt)) for attempt in potential_escape_squares])
+        no_legal_king_move = not any([attack_map.king_can_move_to(side_to_move, attempt) for attempt in potential_escape_squares])
         checking_pieces = own_square_covering_piece_dict[opposing_king_square]  # ['Re1', 'Nf6'] (delivering double check on a king on e8)
         double_check = len(checking_pieces) > 1
         if no_legal_king_move and double_check:
+            if profile is not None:
+                profile.mark('check', CHECKMATE_SCORE, CHECKMATE_SCORE)
             return {'eval': CHECKMATE_SCORE, 'threat': CHECKMATE_SCORE}
         elif double_check:
             threat_score += FORCED_KING_MOVE_THREAT_SCORE
-        else:
+        elif with_threat or no_legal_king_move:
             checking_piece_square = checking_pieces[0][1:]
             if checking_piece_square not in opposing_square_covering_piece_dict:
                 can_capture = False
                 legal_capturing_pns = []
             else:
                 potential_capturing_piece_n_squares = opposing_square_covering_piece_dict[checking_piece_square]
-                legal_capturing_pns = [pns for pns in potential_capturing_piece_n_squares if position.virtual_move_is_legal(VirtualMove(side_to_move, pns[0], pns[1:], checking_piece_square))]
+                legal_capturing_pns = [pns for pns in potential_capturing_piece_n_squares if attack_map.evasion_is_legal(side_to_move, pns, checking_piece_square)]
                 can_capture = len(legal_capturing_pns) > 0
             if f'{checking_piece_square}{opposing_king_square}' not in INT_SQUARES_MAP:
                 legal_blocking_pns = []
@@ -276,16 +434,17 @@ def quick_evaluate(position: Position) -> Dict[str, float]:
                 for int_sq in intervening_squares:
                     if int_sq in opposing_square_covering_piece_dict:
                         potential_blocking_pns = opposing_square_covering_piece_dict[int_sq]
-                        legal_blocking_pns.extend([{'pns': pns, 'int': int_sq, 'm': MATERIAL_DICT[pns[0]]} for pns in potential_blocking_pns if position.virtual_move_is_legal(VirtualMove(side_to_move, pns[0], pns[1:], int_sq)) and pns[0] not in ('P', 'K')])
+                        legal_blocking_pns.extend([{'pns': pns, 'int': int_sq, 'm': MATERIAL_DICT[pns[0]]} for pns in potential_blocking_pns if pns[0] not in ('P', 'K') and attack_map.evasion_is_legal(side_to_move, pns, int_sq)])
                     pawns_on_same_file = [pns for pns in opposing_piece_covered_square_dict if pns[0] == 'P' and pns[1] == int_sq[0]]
                     for pns in pawns_on_same_file:
                         squares_it_can_move_to = position.scan_pawn_non_capture_moves(side_to_move, pns[1:])
                         if int_sq in squares_it_can_move_to:
-                            is_legal = position.virtual_move_is_legal(VirtualMove(side_to_move, 'P', pns[1:], int_sq))
-                            if is_legal:
+                            if attack_map.evasion_is_legal(side_to_move, pns, int_sq):
                                 legal_blocking_pns.append({'pns': pns, 'int': int_sq, 'm': 1})
                 can_block = len(legal_blocking_pns) > 0
             if no_legal_king_move and (not can_capture) and (not can_block):
+                if profile is not None:
+                    profile.mark('check', CHECKMATE_SCORE, CHECKMATE_SCORE)
                 return {'eval': CHECKMATE_SCORE, 'threat': CHECKMATE_SCORE}
             if not (can_block or can_capture):
                 threat_score += FORCED_KING_MOVE_THREAT_SCORE
@@ -306,140 +465,179 @@ def quick_evaluate(position: Position) -> Dict[str, float]:
                         threat_score += net_gain
     else:
         checking_pieces = []
+    if profile is not None:
+        profile.mark('check', score, threat_score)
+    pawn_structure = get_pawn_structure(position)
+    pawn_ranks, passed_pawns = pawn_structure['pawn_ranks'], pawn_structure['passed_pawns']
+    if profile is not None:
+        profile.mark('pawn_structure', score, threat_score)
     own_passed_pawns = {}
     for sq in square_piece_dict:
         piece = square_piece_dict[sq]
+        if not with_score and piece.upper() != 'P':
+            continue
         own_piece = piece.isupper() if side_evaluating_for == 'w' else piece.islower()
         color = 'w' if piece.isupper() else 'b'
         if piece.upper() == 'R':
-            n_pawns_in_front = count_pawns_in_front_on_file(sq, color, square_piece_dict)
+            n_pawns_in_front = count_pawns_in_front_on_file(sq, color, pawn_ranks)
             if n_pawns_in_front == 1:
-                score += ROOK_SEMI_OPEN_FILE_SCORE if own_piece else -ROOK_SEMI_OPEN_FILE_SCORE
+                score += term_score('ROOK_SEMI_OPEN_FILE_SCORE', 1 if own_piece else -1, features)
             elif n_pawns_in_front == 0:
-                score += ROOK_OPEN_FILE_SCORE if own_piece else -ROOK_OPEN_FILE_SCORE
+                score += term_score('ROOK_OPEN_FILE_SCORE', 1 if own_piece else -1, features)
         elif piece.upper() in ('B', 'N'):
             back_rank = '1' if color == 'w' else '8'
             if sq[1] == back_rank:
-                score += DEVELOPMENT_SCORE_PENALTY if own_piece else -DEVELOPMENT_SCORE_PENALTY
+                score += term_score('DEVELOPMENT_SCORE_PENALTY', 1 if own_piece else -1, features)
             if piece.upper() == 'N':
                 if sq in ('e4', 'e5', 'd4', 'd5'):
-                    score += CENTRALIZED_KNIGHT_BONUS if own_piece else -CENTRALIZED_KNIGHT_BONUS
+                    score += term_score('CENTRALIZED_KNIGHT_BONUS', 1 if own_piece else -1, features)
             if piece.upper() == 'B':
                 opposing_color = 'w' if piece.islower() else 'b'
                 own_color = opposite_color(opposing_color)
                 n_bishops = len(position.get_pieces_by_color(own_color).get_piece_type_squares('B'))
                 n_opposing_bishops = len(position.get_pieces_by_color(opposing_color).get_piece_type_squares('B'))
                 if n_bishops == 2 and n_opposing_bishops == 1:
-                    score += BISHOP_PAIR_SCORE/2 if own_piece else -BISHOP_PAIR_SCORE/2
+                    score += term_score('BISHOP_PAIR_SCORE', 0.5 if own_piece else -0.5, features)
         elif piece.upper() == 'P':
-            n_pawns_in_front = count_pawns_in_front_on_file(sq, color, square_piece_dict)
-            if n_pawns_in_front == 0:
-                back_rank = '1' if color == 'w' else '8'
-                yet_traversed_squares = LINE_EXTEND_MAP[f'{sq[0]}{back_rank}{sq}']
-                sq_in_front_attacked = False
-                square_covering_piece_dict = opposing_square_covering_piece_dict if own_piece else own_square_covering_piece_dict
-                for sq in yet_traversed_squares:
-                    if sq in square_covering_piece_dict:
-                        if any([pns.startswith('P') for pns in square_covering_piece_dict[sq]]):
-                            sq_in_front_attacked = True
-                            break
-                if not sq_in_front_attacked:
-                    score += PASSED_PAWN_SCORE if own_piece else -PASSED_PAWN_SCORE
-                    rank = int(sq[1])
-                    ranks_advanced = rank - 2 if color == 'w' else (9 - rank) - 2
-                    score += ranks_advanced * PASSED_PAWN_ADVANCEMENT_BONUS_PER_RANK if own_piece else -ranks_advanced * PASSED_PAWN_ADVANCEMENT_BONUS_PER_RANK
-                    if own_piece:
-                        own_passed_pawns[f'P{sq}'] = PASSED_PAWN_SCORE + ranks_advanced * PASSED_PAWN_ADVANCEMENT_BONUS_PER_RANK
-                        threat_contributing_pieces[f'P{sq}'] = [ranks_advanced * PASSED_PAWN_ADVANCEMENT_THREAT_SCORE_PER_RANK * overwhelming_material_multiplier]
-            if own_piece:
+            if sq in passed_pawns[color]:
+                score += term_score('PASSED_PAWN_SCORE', 1 if own_piece else -1, features)
+                rank = int(sq[1])
+                ranks_advanced = rank - 2 if color == 'w' else (9 - rank) - 2
+                score += term_score('PASSED_PAWN_ADVANCEMENT_BONUS_PER_RANK',
+                                    ranks_advanced if own_piece else -ranks_advanced, features)
+                if own_piece:
+                    own_passed_pawns[f'P{sq}'] = ranks_advanced
+                    threat_contributing_pieces[f'P{sq}'] = [ranks_advanced * PASSED_PAWN_ADVANCEMENT_THREAT_SCORE_PER_RANK * overwhelming_material_multiplier]
+            if own_piece and with_threat:
                 seventh_rank, promotion_rank = (7, 8) if piece == 'P' else (2, 1)
                 if int(sq[1]) == seventh_rank:
                     promotion_square = f'{sq[0]}{promotion_rank}'
                     if promotion_square not in opposing_squares_occupied and promotion_square not in opposing_square_covering_piece_dict:
                         threat_contributing_pieces[f'P{sq}'] = [PROMOTION_THREAT_SCORE * overwhelming_material_multiplier]
                     elif promotion_square not in opposing_squares_occupied and promotion_square in opposing_square_covering_piece_dict:
-                        if promotion_square in own_square_covering_piece_dict or detect_battery_or_x_ray(promotion_square, sq, square_piece_dict, side_evaluating_for, True):
+                        if promotion_square in own_square_covering_piece_dict or detect_battery_or_x_ray(promotion_square, f'P{sq}', attack_map, side_evaluating_for, True):
                             threat_contributing_pieces[f'P{sq}'] = [PROMOTION_THREAT_SCORE * overwhelming_material_multiplier]
         elif piece.upper() == 'K' and is_endgame:
             back_rank = '1' if color == 'w' else '8'
             second_rank = '2' if color == 'w' else '7'
             third_rank = '3' if color == 'w' else '6'
             if sq[1] in (back_rank, second_rank):
-                score += ENDGAME_BACKWARD_KING_PENALTY if own_piece else -ENDGAME_BACKWARD_KING_PENALTY
+                score += term_score('ENDGAME_BACKWARD_KING_PENALTY', 1 if own_piece else -1, features)
             elif sq[1] == third_rank:
-                score += ENDGAME_BACKWARD_KING_PENALTY / 2 if own_piece else -ENDGAME_BACKWARD_KING_PENALTY / 2
-
-    own_pawn_unique_controlled_squares = []
-    already_pawn_controlled_squares_around_king = []
-    for pns in own_piece_covered_square_dict:
-        piece = pns[0]
-        squares_covered = own_piece_covered_square_dict[pns]
-        if piece in ('Q', 'R', 'B', 'N'):
-            for covered_square in squares_covered:
-                score += ACTIVITY_BASE_SCORE
-                if covered_square in ('e4', 'e5', 'd4', 'd5'):
-                    score += CENTRAL_SQUARE_BONUS
-                if covered_square in opposing_piece_covered_square_dict[f'K{opposing_king_square}'] + [opposing_king_square]:
-                    score += SQUARE_AROUND_ENEMY_KING
-                if piece == 'R':
-                    seventh_rank = '7' if side_evaluating_for == 'w' else '2'
-                    if covered_square[1] == seventh_rank:
-                        score += SEVENTH_RANK_BONUS
-                sixth_rank = '6' if side_evaluating_for == 'w' else '3'
-                if covered_square[1] == sixth_rank:
-                    score += SIXTH_RANK_PIECE_CONTROL_BONUS
-        elif piece == 'P':
-            pawn_control_score_map = WHITE_PAWN_CONTROL_SCORES if side_evaluating_for == 'w' else BLACK_PAWN_CONTROL_SCORES
-            for covered_square in squares_covered:
-                if covered_square not in own_pawn_unique_controlled_squares:
-                    score += pawn_control_score_map[covered_square]
-                    own_pawn_unique_controlled_squares.append(covered_square)
+                score += term_score('ENDGAME_BACKWARD_KING_PENALTY', 0.5 if own_piece else -0.5, features)
+        if profile is not None:
+            profile.mark('pawns' if piece.upper() == 'P' else 'pieces', score, threat_score)
+
+    own_pawn_attack_counts = position.get_pieces_by_color(side_evaluating_for).pawn_attack_counts
+    opposing_pawn_attack_counts = position.get_pieces_by_color(side_to_move).pawn_attack_counts
+    if with_score:
+        already_pawn_controlled_squares_around_king = []
+        for pns in own_piece_covered_square_dict:
+            piece = pns[0]
+            squares_covered = own_piece_covered_square_dict[pns]
+            if piece in ('Q', 'R', 'B', 'N'):
+                for covered_square in squares_covered:
+                    score += term_score('ACTIVITY_BASE_SCORE', 1, features)
+                    if covered_square in ('e4', 'e5', 'd4', 'd5'):
+                        score += term_score('CENTRAL_SQUARE_BONUS', 1, features)
+                    if covered_square in opposing_piece_covered_square_dict[f'K{opposing_king_square}'] + [opposing_king_square]:
+                        score += term_score('SQUARE_AROUND_ENEMY_KING', 1, features)
+                    if piece == 'R':
+                        seventh_rank = '7' if side_evaluating_for == 'w' else '2'
+                        if covered_square[1] == seventh_rank:
+                            score += term_score('SEVENTH_RANK_BONUS', 1, features)
+                    sixth_rank = '6' if side_evaluating_for == 'w' else '3'
+                    if covered_square[1] == sixth_rank:
+                        score += term_score('SIXTH_RANK_PIECE_CONTROL_BONUS', 1, features)
+            elif piece == 'P':
+                for covered_square in squares_covered:
+                    if covered_square in opposing_piece_covered_square_dict[f'K{opposing_king_square}'] + [opposing_king_square]:
+                        if covered_square not in already_pawn_controlled_squares_around_king:
+                            score += term_score('SQUARE_AROUND_ENEMY_KING', 1, features)
+                            already_pawn_controlled_squares_around_king.append(covered_square)
+
+        already_pawn_controlled_squares_around_king = []
+        for pns in opposing_piece_covered_square_dict:
+            piece = pns[0]
+            squares_covered = opposing_piece_covered_square_dict[pns]
+            if piece in ('Q', 'R', 'B', 'N'):
+                for covered_square in squares_covered:
+                    score += term_score('ACTIVITY_BASE_SCORE', -1, features)
+                    if covered_square in ('e4', 'e5', 'd4', 'd5'):
+                        score += term_score('CENTRAL_SQUARE_BONUS', -1, features)
+                    if covered_square in own_piece_covered_square_dict[f'K{own_king_square}'] + [own_king_square]:
+                        score += term_score('SQUARE_AROUND_ENEMY_KING', -1, features)
+                    if piece == 'R':
+                        seventh_rank = '7' if side_to_move == 'w' else '2'
+                        if covered_square[1] == seventh_rank:
+                            score += term_score('SEVENTH_RANK_BONUS', -1, features)
+                    sixth_rank = '6' if side_to_move == 'w' else '3'
+                    if covered_square[1] == sixth_rank:
+                        score += term_score('SIXTH_RANK_PIECE_CONTROL_BONUS', -1, features)
+            elif piece == 'P':
+                for covered_square in squares_covered:
+                    if covered_square in own_piece_covered_square_dict[f'K{own_king_square}'] + [own_king_square]:
+                        if covered_square not in already_pawn_controlled_squares_around_king:
+                            score += term_score('SQUARE_AROUND_ENEMY_KING', -1, features)
+                            already_pawn_controlled_squares_around_king.append(covered_square)
+
+    if profile is not None:
+        profile.mark('activity', score, threat_score)
+    if use_bounds:
+        lazy_margins = get_lazy_margins(position, attack_map, own_passed_pawns)
+    if profile is not None:
+        profile.mark('lazy_bounds', score, threat_score)
+    if use_bounds and (lazy_score := get_lazy_score(score, lazy_margins, lower_bound, upper_bound)) is not None:
+        return {'eval': lazy_score, 'threat': threat_score, 'lazy': True}
+    for attacked_square in own_square_covering_piece_dict:
+        if attacked_square in opposing_squares_occupied:
+            if attacked_square == opposing_king_square:
+                continue
+            if attacked_square not in opposing_pawn_attack_counts:
+                threat_score += PRESSURED_PIECE_THREAT_SCORE
+                score += term_score('PRESSURED_PIECE_THREAT_SCORE', 1, features)
+            if not with_threat:
+                continue
+            capturing_pns = own_square_covering_piece_dict[attacked_square]
+            lightest_capturing_pns = min(capturing_pns, key=lambda x: MATERIAL_DICT[x[0]])
+            piece_at_square = square_piece_dict[attacked_square].upper()
+            pinning_pns = is_pinned(opposing_king_square, side_to_move, f'{piece_at_square}{attacked_square}', '', attack_map, ignore_target_sq=True)
+            if pinning_pns:
+                if pinning_pns in threat_contributing_pieces:
+                    threat_contributing_pieces[pinning_pns].append(PINNED_PIECE_THREAT_SCORE)
                 else:
-                    score += pawn_control_score_map[covered_square] / 2
-                if covered_square in opposing_piece_covered_square_dict[f'K{opposing_king_square}'] + [opposing_king_square]:
-                    if covered_square not in already_pawn_controlled_squares_around_king:
-                        score += SQUARE_AROUND_ENEMY_KING
-                        already_pawn_controlled_squares_around_king.append(covered_square)
-
-    opposing_pawn_unique_controlled_squares = []
-    already_pawn_controlled_squares_around_king = []
-    for pns in opposing_piece_covered_square_dict:
-        piece = pns[0]
-        squares_covered = opposing_piece_covered_square_dict[pns]
-        if piece in ('Q', 'R', 'B', 'N'):
-            for covered_square in squares_covered:
-                score -= ACTIVITY_BASE_SCORE
-                if covered_square in ('e4', 'e5', 'd4', 'd5'):
-                    score -= CENTRAL_SQUARE_BONUS
-                if covered_square in own_piece_covered_square_dict[f'K{own_king_square}'] + [own_king_square]:
-                    score -= SQUARE_AROUND_ENEMY_KING
-                if piece == 'R':
-                    seventh_rank = '7' if side_to_move == 'w' else '2'
-                    if covered_square[1] == seventh_rank:
-                        score -= SEVENTH_RANK_BONUS
-                sixth_rank = '6' if side_to_move == 'w' else '3'
-                if covered_square[1] == sixth_rank:
-                    score -= SIXTH_RANK_PIECE_CONTROL_BONUS
-        elif piece == 'P':
-            pawn_control_score_map = WHITE_PAWN_CONTROL_SCORES if side_to_move == 'w' else BLACK_PAWN_CONTROL_SCORES
-            for covered_square in squares_covered:
-                if covered_square not in opposing_pawn_unique_controlled_squares:
-                    score -= pawn_control_score_map[covered_square]
-                    opposing_pawn_unique_controlled_squares.append(covered_square)
+                    threat_contributing_pieces[pinning_pns] = [PINNED_PIECE_THREAT_SCORE]
+            if attacked_square not in opposing_square_covering_piece_dict:
+                if lightest_capturing_pns not in threat_contributing_pieces:
+                    threat_contributing_pieces[lightest_capturing_pns] = [MATERIAL_DICT[piece_at_square] * MATERIAL_THREAT_SCORE_FACTOR]
                 else:
-                    score -= pawn_control_score_map[covered_square] / 2
-                if covered_square in own_piece_covered_square_dict[f'K{own_king_square}'] + [own_king_square]:
-                    if covered_square not in already_pawn_controlled_squares_around_king:
-                        score -= SQUARE_AROUND_ENEMY_KING
-                        already_pawn_controlled_squares_around_king.append(covered_square)
+                    threat_contributing_pieces[lightest_capturing_pns].append(MATERIAL_DICT[piece_at_square] * MATERIAL_THREAT_SCORE_FACTOR)
+            else:
+                capturing_piece_worth = MATERIAL_DICT[lightest_capturing_pns[0]]
+                threatened_material = MATERIAL_DICT[piece_at_square] - capturing_piece_worth
+                if threatened_material > 0:
+                    m = PINNED_THREATENED_MATERIAL_MULTIPLIER if pinning_pns else 1
+                    if lightest_capturing_pns not in threat_contributing_pieces:
+                        threat_contributing_pieces[lightest_capturing_pns] = [threatened_material * MATERIAL_THREAT_SCORE_FACTOR * m]
+                    else:
+                        threat_contributing_pieces[lightest_capturing_pns].append(threatened_material * MATERIAL_THREAT_SCORE_FACTOR * m)
+                    if check_given and not all([pns == lightest_capturing_pns for pns in checking_pieces]):
+                        threat_score += MATERIAL_THREAT_SIMULTANEOUS_WITH_CHECK
+    if profile is not None:
+        profile.mark('pressure_and_pins', score, threat_score)
 
     hanging_material_list = []
+    # WITHOUT THE SCORE, ONLY THE PIECES CONTRIBUTING TO THE THREAT SCORE NEED TO BE CHECKED FOR HANGING
+    threat_contributing_squares = None if with_score else [pns[1:] for pns in threat_contributing_pieces]
     for attacked_square in opposing_square_covering_piece_dict:
+        if threat_contributing_squares is not None and attacked_square not in threat_contributing_squares and \
+                attacked_square != position.get_en_passant_square():
+            continue
         if check_given and not all([pns[1:] == attacked_square for pns in checking_pieces]):
             continue
         if attacked_square in own_squares_occupied or (attacked_square == position.get_en_passant_square() and any([pns[0] == 'P' for pns in opposing_square_covering_piece_dict[attacked_square]])):
-            if (attacked_square not in own_pawn_unique_controlled_squares) and attacked_square != position.get_en_passant_square():
-                score -= PRESSURED_PIECE_SCORE
+            if (attacked_square not in own_pawn_attack_counts) and attacked_square != position.get_en_passant_square():
+                score += term_score('PRESSURED_PIECE_SCORE', -1, features)
             piece_at_square = square_piece_dict[attacked_square].upper() if attacked_square != position.get_en_passant_square() else 'P'
             if piece_at_square == 'K':
                 continue
@@ -453,7 +651,7 @@ def quick_evaluate(position: Position) -> Dict[str, float]:
                 defenders_pns = own_square_covering_piece_dict[attacked_square]
                 defenders_array = []
                 for pns in defenders_pns:
-                    if is_pinned(own_king_square, side_evaluating_for, pns, attacked_square, square_piece_dict):
+                    if is_pinned(own_king_square, side_evaluating_for, pns, attacked_square, attack_map):
                         continue
                     curr_battery = [pns]
                     if pns[0] in ('K', 'N'):
@@ -461,10 +659,10 @@ def quick_evaluate(position: Position) -> Dict[str, float]:
                         continue
                     defender_sq = pns[1:]
                     if f'{attacked_square}{defender_sq}' in INT_SQUARES_MAP:
-                        battery = detect_battery_or_x_ray(attacked_square, pns, square_piece_dict, side_evaluating_for)
+                        battery = detect_battery_or_x_ray(attacked_square, pns, attack_map, side_evaluating_for)
                         curr_battery = []
                         for battery_pns in battery:
-                            if is_pinned(own_king_square, side_evaluating_for, battery_pns, attacked_square, square_piece_dict):
+                            if is_pinned(own_king_square, side_evaluating_for, battery_pns, attacked_square, attack_map):
                                 break
                             curr_battery.append(battery_pns)
                         if curr_battery:
@@ -472,25 +670,25 @@ def quick_evaluate(position: Position) -> Dict[str, float]:
                 attackers_pns = opposing_square_covering_piece_dict[attacked_square]
                 attackers_array = []
                 for pns in attackers_pns:
-                    if is_pinned(opposing_king_square, side_to_move, pns, attacked_square, square_piece_dict):
+                    if is_pinned(opposing_king_square, side_to_move, pns, attacked_square, attack_map):
                         continue
                     if pns[0] in ('K', 'N'):
                         attackers_array.append([pns])
                         continue
                     attacker_square = pns[1:]
                     if f'{attacked_square}{attacker_square}' in INT_SQUARES_MAP:
-                        battery = detect_battery_or_x_ray(attacked_square, pns, square_piece_dict, side_to_move)
+                        battery = detect_battery_or_x_ray(attacked_square, pns, attack_map, side_to_move)
                         curr_battery = []
                         for battery_pns in battery:
-                            if is_pinned(opposing_king_square, side_to_move, battery_pns, attacked_square, square_piece_dict):
+                            if is_pinned(opposing_king_square, side_to_move, battery_pns, attacked_square, attack_map):
                                 break
                             curr_battery.append(battery_pns)
                         if curr_battery:
                             attackers_array.append(curr_battery)
-                        x_ray = detect_battery_or_x_ray(attacked_square, pns, square_piece_dict, side_evaluating_for, True)
+                        x_ray = detect_battery_or_x_ray(attacked_square, pns, attack_map, side_evaluating_for, True)
                         curr_battery = [f'A{pns}']
                         for battery_pns in x_ray:
-                            if is_pinned(own_king_square, side_evaluating_for, battery_pns, attacked_square, square_piece_dict):
+                            if is_pinned(own_king_square, side_evaluating_for, battery_pns, attacked_square, attack_map):
                                 break
                             curr_battery.append(battery_pns)
                         if len(curr_battery) > 1:
@@ -548,65 +746,215 @@ def quick_evaluate(position: Position) -> Dict[str, float]:
                         hanging_material_list.append((f'P{attacked_square[0]}{en_passant_pawn_rank}', -curr_material_change))
     score -= max([m[1] for m in hanging_material_list]) if hanging_material_list else 0
 
-    for attacked_square in own_square_covering_piece_dict:
-        if attacked_square in opposing_squares_occupied:
-            if attacked_square == opposing_king_square:
-                continue
-            if attacked_square not in opposing_pawn_unique_controlled_squares:
-                threat_score += PRESSURED_PIECE_THREAT_SCORE
-                score += PRESSURED_PIECE_THREAT_SCORE
-            capturing_pns = own_square_covering_piece_dict[attacked_square]
-            lightest_capturing_pns = min(capturing_pns, key=lambda x: MATERIAL_DICT[x[0]])
-            piece_at_square = square_piece_dict[attacked_square].upper()
-            pinning_pns = is_pinned(opposing_king_square, side_to_move, f'{piece_at_square}{attacked_square}', '', square_piece_dict, ignore_target_sq=True)
-            if pinning_pns:
-                if pinning_pns in threat_contributing_pieces:
-                    threat_contributing_pieces[pinning_pns].append(PINNED_PIECE_THREAT_SCORE)
-                else:
-                    threat_contributing_pieces[pinning_pns] = [PINNED_PIECE_THREAT_SCORE]
-            if attacked_square not in opposing_square_covering_piece_dict:
-                if lightest_capturing_pns not in threat_contributing_pieces:
-                    threat_contributing_pieces[lightest_capturing_pns] = [MATERIAL_DICT[piece_at_square] * MATERIAL_THREAT_SCORE_FACTOR]
-                else:
-                    threat_contributing_pieces[lightest_capturing_pns].append(MATERIAL_DICT[piece_at_square] * MATERIAL_THREAT_SCORE_FACTOR)
-            else:
-                capturing_piece_worth = MATERIAL_DICT[lightest_capturing_pns[0]]
-                threatened_material = MATERIAL_DICT[piece_at_square] - capturing_piece_worth
-                if threatened_material > 0:
-                    m = PINNED_THREATENED_MATERIAL_MULTIPLIER if pinning_pns else 1
-                    if lightest_capturing_pns not in threat_contributing_pieces:
-                        threat_contributing_pieces[lightest_capturing_pns] = [threatened_material * MATERIAL_THREAT_SCORE_FACTOR * m]
-                    else:
-                        threat_contributing_pieces[lightest_capturing_pns].append(threatened_material * MATERIAL_THREAT_SCORE_FACTOR * m)
-                    if check_given and not all([pns == lightest_capturing_pns for pns in checking_pieces]):
-                        threat_score += MATERIAL_THREAT_SIMULTANEOUS_WITH_CHECK
-
     for hanging_pns, m in hanging_material_list:
         if hanging_pns in threat_contributing_pieces:
             threat_contributing_pieces.pop(hanging_pns)
         if hanging_pns in own_passed_pawns:
-            score -= own_passed_pawns.pop(hanging_pns)
+            # THE BONUSES THE PASSED PAWN GOT ARE TAKEN BACK
+            ranks_advanced = own_passed_pawns.pop(hanging_pns)
+            score += term_score('PASSED_PAWN_SCORE', -1, features) + \
+                term_score('PASSED_PAWN_ADVANCEMENT_BONUS_PER_RANK', -ranks_advanced, features)
+    if profile is not None:
+        profile.mark('hanging_material', score, threat_score)
     for pns in threat_contributing_pieces:
         threat_score += sum(threat_contributing_pieces[pns])
+    if profile is not None:
+        profile.mark('threats', score, threat_score)
 
     for square in opposing_piece_covered_square_dict[f'K{opposing_king_square}']:
         if square in own_square_covering_piece_dict:
             threat_score += UNIQUE_SQUARE_AROUND_ENEMY_KING_THREAT_SCORE * overwhelming_material_multiplier
-            score += UNIQUE_SQUARE_AROUND_ENEMY_KING_SCORE
+            score += term_score('UNIQUE_SQUARE_AROUND_ENEMY_KING_SCORE', 1, features)
             if any([pns.startswith('Q') for pns in own_square_covering_piece_dict[square]]):
                 queen_pns = [pns for pns in own_square_covering_piece_dict[square] if pns[0] == 'Q'][0]
-                battery = detect_battery_or_x_ray(square, queen_pns, square_piece_dict, color='w' if side_evaluating_for == 'w' else 'b')
+                battery = detect_battery_or_x_ray(square, queen_pns, attack_map, color='w' if side_evaluating_for == 'w' else 'b')
                 if len(own_square_covering_piece_dict[square]) > 1 or len(battery) > 1:
                     threat_score += SUPPORTED_QUEEN_AROUND_ENEMY_KING_THREAT_SCORE * overwhelming_material_multiplier
-                    score += SUPPORTED_QUEEN_AROUND_ENEMY_KING_SCORE
-
-    for square in own_piece_covered_square_dict[f'K{own_king_square}']:
-        if square in opposing_square_covering_piece_dict:
-            score -= UNIQUE_SQUARE_AROUND_ENEMY_KING_SCORE
-            if any([pns.startswith('Q') for pns in opposing_square_covering_piece_dict[square]]):
-                queen_pns = [pns for pns in opposing_square_covering_piece_dict[square] if pns[0] == 'Q'][0]
-                battery = detect_battery_or_x_ray(square, queen_pns, square_piece_dict, color='w' if side_to_move == 'w' else 'b')
-                if len(opposing_square_covering_piece_dict[square]) > 1 or len(battery) > 1:
-                    score -= SUPPORTED_QUEEN_AROUND_ENEMY_KING_SCORE
+                    score += term_score('SUPPORTED_QUEEN_AROUND_ENEMY_KING_SCORE', 1, features)
+
+    if with_score:
+        for square in own_piece_covered_square_dict[f'K{own_king_square}']:
+            if square in opposing_square_covering_piece_dict:
+                score += term_score('UNIQUE_SQUARE_AROUND_ENEMY_KING_SCORE', -1, features)
+                if any([pns.startswith('Q') for pns in opposing_square_covering_piece_dict[square]]):
+                    queen_pns = [pns for pns in opposing_square_covering_piece_dict[square] if pns[0] == 'Q'][0]
+                    battery = detect_battery_or_x_ray(square, queen_pns, attack_map, color='w' if side_to_move == 'w' else 'b')
+                    if len(opposing_square_covering_piece_dict[square]) > 1 or len(battery) > 1:
+                        score += term_score('SUPPORTED_QUEEN_AROUND_ENEMY_KING_SCORE', -1, features)
+    if profile is not None:
+        profile.mark('king_zone', score, threat_score)
 
     return {'eval': score, 'threat': threat_score}
+
+
+def quick_evaluate(position: Position, lower_bound: float = None, upper_bound: float = None) -> Dict[str, float]:
+    """
+    The score and the threat score together, sharing the work both need. See evaluate_position.
+    """
+    return evaluate_position(position, lower_bound=lower_bound, upper_bound=upper_bound)
+
+
+def evaluate_score(position: Position, lower_bound: float = None, upper_bound: float = None) -> Dict[str, float]:
+    """
+    quick_evaluate without the threat score, for searches given evaluate_threat as their threat function.
+    :return: {'eval': score for the side that just moved}, with 'lazy': True if cut short by the bounds.
+    """
+    evaluation = evaluate_position(position, lower_bound=lower_bound, upper_bound=upper_bound, with_threat=False)
+    evaluation.pop('threat')
+    return evaluation
+
+
+def evaluate_features(position: Position) -> Union[Dict[str, float], None]:
+    """
+    The score of quick_evaluate split into the number of times each of EVAL_TERMS is added to it, so the score with
+    other values of the constants is 'base' plus the sum of each count times its value.
+    :return: {term: count for each of EVAL_TERMS, 'base': the rest of the score (material, pawn control and hanging
+    material), 'eval': the score}, all for the side that just moved, or None if the score is a checkmate.
+    """
+    features = {term: 0 for term in EVAL_TERMS}
+    score = evaluate_position(position, with_threat=False, features=features)['eval']
+    if score == CHECKMATE_SCORE:
+        return None
+    features['base'] = score - sum([count * globals()[term] for term, count in features.items()])
+    features['eval'] = score
+    return features
+
+
+def check_features(position: Position, delta: float = 0.125) -> None:
+    """
+    Evaluates position again with each of EVAL_TERMS raised by delta in turn, and checks that the score moves by the
+    count from evaluate_features times delta. A term added to the score without being counted would otherwise be
+    taken into 'base' unnoticed.
+    :raises AssertionError: if the count of a term is wrong.
+    """
+    features = evaluate_features(position)
+    if features is None:
+        return
+    module_constants = globals()
+    for term in EVAL_TERMS:
+        value = module_constants[term]
+        module_constants[term] = value + delta
+        try:
+            score = evaluate_position(position, with_threat=False)['eval']
+        finally:
+            module_constants[term] = value
+        if abs(score - features['eval'] - features[term] * delta) > 1e-6:
+            raise AssertionError(f'{term} is counted {features[term]} times but moves the score by '
+                                 f'{(score - features["eval"]) / delta} times delta in {position.generate_fen()}.')
+
+
+def evaluate_threat(position: Position) -> float:
+    """
+    The threat score of quick_evaluate on its own, for the searches to work out only when picking threatening moves.
+    """
+    return evaluate_position(position, with_score=False)['threat']
+
+
+class EvaluationProfile:
+    """
+    Wall time, runs and score added by each of EVALUATION_BLOCKS, over every evaluate_position it is given to. The
+    time of a block runs from the end of the one before, so the blocks add up to nearly all of each evaluation.
+    """
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(EVALUATION_BLOCKS, 0.0)
+        self.runs = dict.fromkeys(EVALUATION_BLOCKS, 0)
+        self.total_eval = dict.fromkeys(EVALUATION_BLOCKS, 0.0)  # SIZE OF WHAT EACH BLOCK ADDS, SUMMED
+        self.total_threat = dict.fromkeys(EVALUATION_BLOCKS, 0.0)
+        self.last_eval = {}  # {block: score added} IN THE LAST EVALUATION
+        self.last_threat = {}
+        self.evaluations = 0
+        self.lazy_evaluations = 0
+        self.mark_time = 0.0
+        self.mark_score = 0
+        self.mark_threat_score = 0
+
+    def start(self) -> None:
+        self.evaluations += 1
+        self.last_eval = {}
+        self.last_threat = {}
+        self.mark_score = 0
+        self.mark_threat_score = 0
+        self.mark_time = time.perf_counter()
+
+    def mark(self, block: str, score: float, threat_score: float) -> None:
+        """
+        Ends block, with the score and threat score so far.
+        """
+        now = time.perf_counter()
+        self.seconds[block] += now - self.mark_time
+        self.runs[block] += 1
+        added_score, added_threat = score - self.mark_score, threat_score - self.mark_threat_score
+        self.total_eval[block] += abs(added_score)
+        self.total_threat[block] += abs(added_threat)
+        self.last_eval[block] = self.last_eval.get(block, 0) + added_score
+        self.last_threat[block] = self.last_threat.get(block, 0) + added_threat
+        self.mark_score = score
+        self.mark_threat_score = threat_score
+        self.mark_time = now
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        :return: {'evaluations': number profiled, 'lazy_evaluations': those cut short by bounds, 'seconds': total time,
+        'blocks': {block: {'seconds', 'share' of the total time, 'runs', 'microseconds_per_run', 'mean_eval' and
+        'mean_threat': mean size of what the block adds to each score, over all evaluations}}}, blocks slowest first.
+        """
+        total_seconds = sum(self.seconds.values())
+        n_evaluations = max(self.evaluations, 1)
+        blocks = {block: {'seconds': self.seconds[block],
+                          'share': self.seconds[block] / total_seconds if total_seconds else 0.0,
+                          'runs': self.runs[block],
+                          'microseconds_per_run': 1e6 * self.seconds[block] / self.runs[block] if self.runs[block]
+                          else 0.0,
+                          'mean_eval': self.total_eval[block] / n_evaluations,
+                          'mean_threat': self.total_threat[block] / n_evaluations}
+                  for block in sorted(EVALUATION_BLOCKS, key=lambda block: self.seconds[block], reverse=True)}
+        return {'evaluations': self.evaluations, 'lazy_evaluations': self.lazy_evaluations, 'seconds': total_seconds,
+                'blocks': blocks}
+
+    def format_stats(self) -> str:
+        stats = self.get_stats()
+        lines = [f'{stats["evaluations"]} evaluations ({stats["lazy_evaluations"]} lazy) in {stats["seconds"]:.3f}s',
+                 'block               share  us/run      runs  mean eval  mean threat']
+        for block, block_stats in stats['blocks'].items():
+            lines.append(f'{block:<18} {block_stats["share"]:6.1%} {block_stats["microseconds_per_run"]:7.1f} '
+                         f'{block_stats["runs"]:9d} {block_stats["mean_eval"]:10.3f} '
+                         f'{block_stats["mean_threat"]:12.3f}')
+        return '\n'.join(lines)
+
+
+class ProfiledEvaluation:
+    """
+    quick_evaluate (or evaluate_score, with with_threat=False) that records each evaluation in self.profile. Give it to
+    a Bot as evaluation_func and read the profile with Bot.get_evaluation_profile. Slower than the function it stands
+    in for by the timing itself.
+    """
+
+    def __init__(self, with_threat: bool = True):
+        self.with_threat = with_threat
+        self.profile = EvaluationProfile()
+
+    def __call__(self, position: Position, lower_bound: float = None, upper_bound: float = None) -> Dict[str, float]:
+        evaluation = evaluate_position(position, lower_bound=lower_bound, upper_bound=upper_bound,
+                                       with_threat=self.with_threat, profile=self.profile)
+        if evaluation.get('lazy'):
+            self.profile.lazy_evaluations += 1
+        if not self.with_threat:
+            evaluation.pop('threat')
+        return evaluation
+
+    def reset(self) -> None:
+        self.profile = EvaluationProfile()
+
+
+def evaluate_breakdown(position: Position) -> Dict[str, Any]:
+    """
+    quick_evaluate with what each of EVALUATION_BLOCKS added to the score and the threat score, and the time it took.
+    :return: {'eval', 'threat', 'blocks': {block: {'eval', 'threat', 'microseconds'}}} for the blocks that ran.
+    """
+    profile = EvaluationProfile()
+    evaluation = evaluate_position(position, profile=profile)
+    evaluation['blocks'] = {block: {'eval': profile.last_eval[block], 'threat': profile.last_threat[block],
+                                    'microseconds': 1e6 * profile.seconds[block]}
+                            for block in EVALUATION_BLOCKS if block in profile.last_eval}
+    return evaluation
@@ -0,0 +1,178 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from simple_bot.bot1 import evaluation
+from simple_bot.bot1.evaluation import EVAL_TERMS, evaluate_features, check_features
+from utils.parse_fen import parse_full_fen
+
+RESULT_VALUES = {'1-0': 1.0, '1': 1.0, '1.0': 1.0, '0-1': 0.0, '0': 0.0, '0.0': 0.0,
+                 '1/2-1/2': 0.5, '1/2': 0.5, '0.5': 0.5}
+POSITIONS_PER_TASK = 500
+
+
+def load_labelled_positions(path: str) -> List[Tuple[str, float]]:
+    """
+    :param path: text file with one position per line, a FEN then the result of the game it comes from for white
+    (1-0, 0-1 or 1/2-1/2, or 1, 0 or 0.5), separated by a space or a semicolon. Blank lines and lines starting with #
+    are skipped.
+    :return: [(FEN, result)]
+    """
+    labelled_positions = []
+    with open(path) as labelled_file:
+        for line_number, line in enumerate(labelled_file, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fen, _, result = line.replace(';', ' ').rpartition(' ')
+            result = result.strip('[]"')
+            if result not in RESULT_VALUES or not fen.strip():
+                raise ValueError(f'Line {line_number} of {path} is not a FEN followed by a result: {line}')
+            labelled_positions.append((fen.strip(), RESULT_VALUES[result]))
+    return labelled_positions
+
+
+def extract_features(fens: List[str]) -> List[List[float]]:
+    """
+    :return: for each FEN, [base, the count of each of EVAL_TERMS] from evaluate_features, turned to white's point of
+    view, or an empty list for a checkmate.
+    :raises AssertionError: if the counts of the first position are wrong (see check_features).
+    """
+    rows = []
+    for i, fen in enumerate(fens):
+        position = parse_full_fen(fen)
+        if i == 0:
+            check_features(position)
+        features = evaluate_features(position)
+        if features is None:
+            rows.append([])
+            continue
+        sign = -1 if position.to_move() == 'w' else 1  # evaluate_features SCORES FOR THE SIDE THAT JUST MOVED
+        rows.append([sign * features['base']] + [sign * features[term] for term in EVAL_TERMS])
+    return rows
+
+
+def build_feature_matrix(labelled_positions: List[Tuple[str, float]],
+                         workers: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Extracts the features of the positions in several processes. Checkmates are left out.
+    :param labelled_positions: [(FEN, result)]
+    :param workers: processes used. Default: one per CPU. 1 to extract in this process.
+    :return: (N x len(EVAL_TERMS) counts, N bases, N results), all for white.
+    """
+    fens = [fen for fen, _ in labelled_positions]
+    tasks = [fens[i:i + POSITIONS_PER_TASK] for i in range(0, len(fens), POSITIONS_PER_TASK)]
+    if workers == 1:
+        rows = [row for task in tasks for row in extract_features(task)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rows = [row for task_rows in executor.map(extract_features, tasks) for row in task_rows]
+    kept = [i for i, row in enumerate(rows) if row]
+    matrix = np.array([rows[i] for i in kept], dtype=np.float64).reshape(len(kept), len(EVAL_TERMS) + 1)
+    results = np.array([labelled_positions[i][1] for i in kept], dtype=np.float64)
+    return matrix[:, 1:], matrix[:, 0], results
+
+
+def win_probability(scores: np.ndarray, scaling: float) -> np.ndarray:
+    """
+    Expected result for white of a score in pawns: 1 / (1 + 10 ** (-scaling * score / 4)).
+    """
+    return 1 / (1 + np.power(10.0, -scaling * scores / 4))
+
+
+def fit_scaling(scores: np.ndarray, results: np.ndarray) -> float:
+    """
+    :return: the scaling of win_probability with the least mean squared error for the current scores, so that the
+    tuning changes the constants and not the scale of the score.
+    """
+    low, high = 0.01, 5.0
+    for _ in range(4):
+        candidates = np.linspace(low, high, 50)
+        errors = np.mean((win_probability(scores[None, :], candidates[:, None]) - results[None, :]) ** 2, axis=1)
+        best = int(np.argmin(errors))
+        step = candidates[1] - candidates[0]
+        low, high = max(candidates[best] - step, 1e-3), candidates[best] + step
+    return float(candidates[best])
+
+
+def mean_squared_error(features: np.ndarray, bases: np.ndarray, results: np.ndarray, weights: np.ndarray,
+                       scaling: float) -> float:
+    return float(np.mean((win_probability(bases + features @ weights, scaling) - results) ** 2))
+
+
+def tune_weights(features: np.ndarray, bases: np.ndarray, results: np.ndarray, initial_weights: np.ndarray,
+                 scaling: float, iterations: int = 2000, learning_rate: float = 0.002,
+                 verbose: bool = False) -> np.ndarray:
+    """
+    Texel-style tuning: full-batch gradient descent (Adam) on the mean squared error between the results and
+    win_probability of the scores, the scores being linear in the weights.
+    :return: the tuned weights, in the order of EVAL_TERMS.
+    """
+    weights = initial_weights.astype(np.float64).copy()
+    first_moment = np.zeros_like(weights)
+    second_moment = np.zeros_like(weights)
+    beta_1, beta_2, epsilon = 0.9, 0.999, 1e-8
+    for iteration in range(1, iterations + 1):
+        probabilities = win_probability(bases + features @ weights, scaling)
+        errors = probabilities - results
+        slopes = probabilities * (1 - probabilities) * np.log(10) * scaling / 4
+        gradient = 2 * features.T @ (errors * slopes) / len(results)
+        first_moment = beta_1 * first_moment + (1 - beta_1) * gradient
+        second_moment = beta_2 * second_moment + (1 - beta_2) * gradient ** 2
+        weights -= learning_rate * (first_moment / (1 - beta_1 ** iteration)) / \
+            (np.sqrt(second_moment / (1 - beta_2 ** iteration)) + epsilon)
+        if verbose and iteration % 500 == 0:
+            print(f'iteration {iteration}: error {np.mean(errors ** 2):.6f}')
+    return weights
+
+
+def get_current_weights() -> np.ndarray:
+    return np.array([getattr(evaluation, term) for term in EVAL_TERMS], dtype=np.float64)
+
+
+def format_constants(weights: np.ndarray) -> str:
+    """
+    :return: lines to paste over the constants in evaluation.py, each with its old value.
+    """
+    return '\n'.join([f'{term} = {round(float(weight), 4)}  # WAS {getattr(evaluation, term)}'
+                      for term, weight in zip(EVAL_TERMS, weights)])
+
+
+def tune_from_file(path: str, workers: int = None, iterations: int = 2000, learning_rate: float = 0.002,
+                   verbose: bool = False) -> Dict[str, float]:
+    """
+    :return: {term: tuned value for each of EVAL_TERMS}
+    """
+    start = time.perf_counter()
+    features, bases, results = build_feature_matrix(load_labelled_positions(path), workers=workers)
+    initial_weights = get_current_weights()
+    scaling = fit_scaling(bases + features @ initial_weights, results)
+    if verbose:
+        print(f'{len(results)} positions extracted in {time.perf_counter() - start:.1f}s, scaling {scaling:.3f}, '
+              f'error {mean_squared_error(features, bases, results, initial_weights, scaling):.6f}')
+    weights = tune_weights(features, bases, results, initial_weights, scaling, iterations=iterations,
+                           learning_rate=learning_rate, verbose=verbose)
+    if verbose:
+        print(f'tuned error {mean_squared_error(features, bases, results, weights, scaling):.6f}')
+    return {term: float(weight) for term, weight in zip(EVAL_TERMS, weights)}
+
+
+if __name__ == '__main__':
+    # e.g. python -m simple_bot.bot1.tuner labelled_positions.txt --iterations 5000
+    parser = argparse.ArgumentParser(description='Tune the evaluation constants on positions labelled with results.')
+    parser.add_argument('positions', help='file of FENs, each followed by the result for white (see '
+                                          'load_labelled_positions).')
+    parser.add_argument('--workers', type=int, default=None, help='processes used. Default: one per CPU.')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--learning-rate', type=float, default=0.002)
+    arguments = parser.parse_args()
+    if not os.path.isfile(arguments.positions):
+        parser.error(f'{arguments.positions} not found')
+    tuned = tune_from_file(arguments.positions, workers=arguments.workers, iterations=arguments.iterations,
+                           learning_rate=arguments.learning_rate, verbose=True)
+    # THE LAZY MARGINS OF evaluate_position DEPEND ON THESE VALUES. RE-MEASURE THEM AFTER CHANGING THE CONSTANTS
+    print(format_constants(np.array([tuned[term] for term in EVAL_TERMS])))
@@ -0,0 +1,226 @@
+import sys
+from collections import OrderedDict
+from typing import List, Tuple, Union
+from classes.position import Position, opposite_color
+from simple_bot.utils import branch_from_position
+
+INFINITY = 10 ** 9  # PROOF OR DISPROOF NUMBER OF A SOLVED NODE
+
+
+class MateSearchNode:
+    """
+    Node of a proof-number search tree. At attacking nodes the attacker is to move and only checking moves are
+    searched. At defending nodes every legal reply is searched. moves_left counts the attacker's moves still allowed,
+    including the one about to be played at an attacking node.
+    """
+
+    def __init__(self, position: Position, uci: str, attacking: bool, moves_left: int, parent=None):
+        self.position = position
+        self.position_hash = position.get_hash()
+        self.uci = uci
+        self.attacking = attacking
+        self.moves_left = moves_left
+        self.parent = parent
+        self.children: List[MateSearchNode] = []
+        self.expanded = False
+        self.proof_number = 1
+        self.disproof_number = 1
+
+    def set_proven(self) -> None:
+        self.proof_number = 0
+        self.disproof_number = INFINITY
+
+    def set_disproven(self) -> None:
+        self.proof_number = INFINITY
+        self.disproof_number = 0
+
+    def is_solved(self) -> bool:
+        return self.proof_number == 0 or self.disproof_number == 0
+
+    def update_numbers(self) -> None:
+        if self.attacking:
+            self.proof_number = min(child.proof_number for child in self.children)
+            self.disproof_number = min(INFINITY, sum(child.disproof_number for child in self.children))
+        else:
+            self.proof_number = min(INFINITY, sum(child.proof_number for child in self.children))
+            self.disproof_number = min(child.disproof_number for child in self.children)
+
+
+class MateSearch:
+    """
+    Proof-number search for a forced mate by the side to move, over checks by the attacker and all replies by the
+    defender. Solved positions are kept in a transposition cache keyed by (position hash, attacking, attacker moves
+    left), which stays valid across calls to find_mate on the same object. The same position can be met as an attacking
+    node in one call and as a defending node in another, where it must not count as solved. The least recently used entry is evicted once
+    max_entries are held.
+    """
+
+    def __init__(self, max_nodes: int = 20000, max_entries: int = 2 ** 16):
+        """
+        :param max_nodes: most nodes one call to find_mate may create before giving up.
+        :param max_entries: most solved positions kept in the transposition cache.
+        """
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1.')
+        self.max_nodes = max_nodes
+        self.max_entries = max_entries
+        self.solved: OrderedDict[Tuple[int, bool, int], bool] = OrderedDict()
+        self.longest_solved = 0
+        self.nodes = 0
+
+    def look_up(self, position_hash: int, attacking: bool, moves_left: int) -> Union[bool, None]:
+        """
+        A mate found with fewer moves left still works with more moves left, and a position with no mate in more moves
+        has none in fewer.
+        :return: True if proven, False if disproven, None if unknown.
+        """
+        for k in range(moves_left + 1):
+            if self.solved.get((position_hash, attacking, k)) is True:
+                self.solved.move_to_end((position_hash, attacking, k))
+                return True
+        for k in range(moves_left, self.longest_solved + 1):
+            if self.solved.get((position_hash, attacking, k)) is False:
+                self.solved.move_to_end((position_hash, attacking, k))
+                return False
+        return None
+
+    def record(self, node: MateSearchNode) -> None:
+        if node.is_solved():
+            key = (node.position_hash, node.attacking, node.moves_left)
+            self.solved[key] = node.proof_number == 0
+            self.solved.move_to_end(key)
+            if len(self.solved) > self.max_entries:
+                self.solved.popitem(last=False)
+            self.longest_solved = max(self.longest_solved, node.moves_left)
+
+    def create_child(self, parent: MateSearchNode, uci: str, position: Position) -> MateSearchNode:
+        self.nodes += 1
+        if parent.attacking:
+            child = MateSearchNode(position, uci, attacking=False, moves_left=parent.moves_left - 1, parent=parent)
+            defending_moves = position.get_all_legal_moves_for_side_to_move()
+            if not defending_moves:
+                # THE ATTACKER ONLY PLAYS CHECKS, SO HAVING NO REPLIES IS ALWAYS MATE
+                child.set_proven()
+            elif child.moves_left == 0:
+                child.set_disproven()
+            else:
+                child.disproof_number = len(defending_moves)
+        else:
+            child = MateSearchNode(position, uci, attacking=True, moves_left=parent.moves_left, parent=parent)
+        if not child.is_solved():
+            cached_result = self.look_up(child.position_hash, child.attacking, child.moves_left)
+            if cached_result is True:
+                child.set_proven()
+            elif cached_result is False:
+                child.set_disproven()
+        if child.is_solved():
+            child.position = None
+        return child
+
+    def expand(self, node: MateSearchNode) -> None:
+        position = node.position
+        to_move = position.to_move()
+        for move in position.get_all_legal_moves_for_color(to_move):
+            new_position = branch_from_position(position, move)
+            if node.attacking and not new_position.is_under_check(opposite_color(to_move)):
+                continue
+            node.children.append(self.create_child(node, move.generate_uci(), new_position))
+        node.expanded = True
+        node.position = None
+        if not node.children:
+            # ATTACKER HAS NO CHECKS. A DEFENDER ALWAYS HAS A REPLY HERE, AS MATED DEFENDING NODES ARE NEVER EXPANDED.
+            node.set_disproven()
+        else:
+            node.update_numbers()
+
+    def select_most_proving_node(self, root: MateSearchNode) -> MateSearchNode:
+        node = root
+        while node.expanded:
+            if node.attacking:
+                node = min(node.children, key=lambda child: child.proof_number)
+            else:
+                node = min(node.children, key=lambda child: child.disproof_number)
+        return node
+
+    def find_mate(self, position: Position, moves: int) -> Union[str, None]:
+        """
+        Looks for a mate in at most the given number of moves by the side to move.
+        :param position:
+        :param moves: e.g. 2 for mate in two.
+        :return: UCI of the first move of a forced mate, or None if there is none or the node limit was reached.
+        """
+        root = MateSearchNode(position.copy(), '', attacking=True, moves_left=moves)
+        cached_result = self.look_up(root.position_hash, True, moves)
+        if cached_result is False:
+            return None
+        self.nodes = 0
+        while not root.is_solved() and self.nodes < self.max_nodes:
+            node = self.select_most_proving_node(root)
+            self.expand(node)
+            self.record(node)
+            while node.parent is not None:
+                node = node.parent
+                node.update_numbers()
+                self.record(node)
+        if root.proof_number != 0:
+            return None
+        for child in root.children:
+            if child.proof_number == 0:
+                return child.uci
+        return None
+
+
+def find_forced_mate(position: Position, max_moves: int = 3, max_nodes: int = 20000,
+                     mate_search: MateSearch = None) -> Union[Tuple[str, int], None]:
+    """
+    Finds the shortest forced mate for the side to move, trying mate in one, then mate in two, and so on.
+    :param position:
+    :param max_moves: longest mate looked for, in moves of the side to move.
+    :param max_nodes: node limit for each length tried.
+    :param mate_search: a MateSearch to reuse, keeping its transposition cache. A new one is made if None.
+    :return: (UCI of the first move, length of the mate in moves), or None if no mate was found.
+    """
+    if mate_search is None:
+        mate_search = MateSearch(max_nodes=max_nodes)
+    for moves in range(1, max_moves + 1):
+        uci = mate_search.find_mate(position, moves)
+        if uci is not None:
+            return uci, moves
+    return None
+
+
+def check_cache_sides() -> None:
+    """
+    Regression check that a position solved as an attacking node is not taken as solved when it is met again as a
+    defending node. After b2c1=Q# is found for black, white's Ra1-c1 reaches the same position with black to move,
+    which the cache must not count as white's mate.
+    :raises AssertionError: if a reused MateSearch answers differently from a new one.
+    """
+    from utils.parse_fen import parse_full_fen
+    mate_search = MateSearch()
+    assert find_forced_mate(parse_full_fen('2k5/8/8/8/8/8/1p4PP/2R4K b - - 1 1'), 1, mate_search=mate_search) == \
+        ('b2c1q', 1)
+    white_to_move = parse_full_fen('2k5/8/8/8/8/8/1p4PP/R6K w - - 0 1')
+    expected = find_forced_mate(white_to_move, 2)
+    result = find_forced_mate(white_to_move, 2, mate_search=mate_search)
+    if result != expected:
+        raise AssertionError(f'Reused MateSearch found {result}, a new one found {expected}.')
+
+
+if __name__ == '__main__':
+    # e.g. python -m simple_bot.mate_search "6k1/5ppp/8/8/8/8/8/R5K1 w - - 0 1" 2
+    from utils.parse_fen import parse_full_fen
+    if len(sys.argv) < 2:
+        print('Usage: python -m simple_bot.mate_search "<FEN>" [max moves]')
+        print('       python -m simple_bot.mate_search --check')
+        sys.exit(1)
+    if sys.argv[1] == '--check':
+        check_cache_sides()
+        print('Mate search cache check passed.')
+        sys.exit(0)
+    puzzle_max_moves = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    result = find_forced_mate(parse_full_fen(sys.argv[1]), max_moves=puzzle_max_moves, max_nodes=10 ** 6)
+    if result is None:
+        print(f'No mate in {puzzle_max_moves} found.')
+    else:
+        print(f'Mate in {result[1]}: {result[0]}')
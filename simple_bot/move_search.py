@@ -1,83 +1,118 @@
 from typing import List, Callable, Tuple, Dict, Union, Iterable
+from collections import OrderedDict
 from random import uniform
 import random
 from classes.move import LegalMove
 from classes.position import Position, opposite_color
+from simple_bot.prescreen import prescreen_moves
 from simple_bot.utils import branch_from_position
 
+APPROXIMATE_POSITION_BYTES = 4000  # A SEARCHED POSITION WITH ITS MOVE AND SCORE, MEASURED WITH tracemalloc
+APPROXIMATE_MOVE_BYTES = 500  # A MOVE AND SCORE KEPT WITHOUT ITS POSITION, MEASURED WITH tracemalloc
 
-class Node:
-
-    def __init__(self, name: str, value, parent=None):
-        self.parent = parent
-        self.children = []
-        self.name = name
-        self.value = value
-
-    def get_parent(self):
-        return self.parent
-
-    def add_child(self, name, value):
-        child = Node(name, value, self)
-        self.children.append(child)
-        return child
-
-    def remove_all_children(self):
-        self.children = []
-
-    def get_name(self) -> str:
-        return self.name
-
-    def get_children(self) -> list:
-        return self.children
-
-    def get_siblings(self) -> List:
-        return [node for node in self.get_parent().get_children() if node.get_name() != self.get_name()]
-
-    def get_value(self):
-        return self.value
-
-    def set_value(self, value):
-        self.value = value
-
-    def is_leaf(self) -> bool:
-        return self.get_children() == []
 
+class SearchAborted(Exception):
+    """
+    Raised inside a search when its should_stop callback returns True.
+    """
+    pass
 
-def search_downstream(node: Node) -> List[Node]:
-    if node.is_leaf():
-        return [node]
-    else:
-        children = node.get_children()
-        leaves = []
-        for child in children:
-            leaves.extend(search_downstream(child))
-        return leaves
 
+class SearchTree:
+    """
+    Move tree stored as parallel lists indexed by node number, with the root as node 0. A node is only ever added after
+    its parent, so every child has a higher number than its parent and one pass over the nodes in reverse order backs
+    up the minimax values.
+    """
 
-def search_upstream(node: Node) -> Node:
-    if node.get_parent() is None:
-        return node
-    else:
-        return search_upstream(node.get_parent())
+    def __init__(self):
+        self.parents: List[int] = [-1]
+        self.moves: List[str] = ['']
+        self.scores: List[float] = [0]
+        self.depths: List[int] = [0]
+        self.n_children: List[int] = [0]
+
+    def __len__(self):
+        return len(self.parents)
+
+    def add_node(self, parent: int, uci: str, score: float) -> int:
+        """
+        :param parent: node number of the parent.
+        :param uci: the move leading from the parent to the new node.
+        :param score: static score of the new node.
+        :return: node number of the new node.
+        """
+        self.parents.append(parent)
+        self.moves.append(uci)
+        self.scores.append(score)
+        self.depths.append(self.depths[parent] + 1)
+        self.n_children.append(0)
+        self.n_children[parent] += 1
+        return len(self.parents) - 1
+
+    def get_root_children(self) -> List[int]:
+        return [node for node in range(1, len(self.parents)) if self.parents[node] == 0]
+
+    def back_up(self, aggregator: Callable[[Iterable], float] = max) -> List[float]:
+        """
+        Leaves keep their static score. Every other node below the root gets aggregator(values of its children) if its
+        children are at an odd depth, and -aggregator(values of its children) if they are at an even depth.
+        :param aggregator:
+        :return: the backed up value of every node, indexed by node number. The root's value is not backed up.
+        """
+        values = list(self.scores)
+        child_values: Dict[int, List[float]] = {}
+        for node in range(len(self.parents) - 1, 0, -1):
+            if self.n_children[node]:
+                if (self.depths[node] + 1) % 2:
+                    values[node] = aggregator(child_values.pop(node))
+                else:
+                    values[node] = -aggregator(child_values.pop(node))
+            child_values.setdefault(self.parents[node], []).append(values[node])
+        return values
+
+
+def get_threat_score(evaluate: Callable[[Position], Dict[str, float]], position: Position,
+                     evaluation: Dict[str, float] = None) -> float:
+    """
+    The threat score from the evaluation of position if it has one. Otherwise evaluate must have a get_threat method
+    that works it out (an EvaluationCache with a threat function, or a BatchEvaluation).
+    """
+    if evaluation is None:
+        evaluation = evaluate(position)
+    if 'threat' in evaluation:
+        return evaluation['threat']
+    return evaluate.get_threat(position)
 
 
-def collapse_node(node: Node, aggregator: Callable[[List[float]], float]):
-    leaves = search_downstream(node)
-    values = [leave.get_value() for leave in leaves]
-    value = aggregator(values)
-    node.set_value(value)
-    node.remove_all_children()
+def evaluate_positions(evaluate: Callable[[Position], Dict[str, float]],
+                       positions: List[Position]) -> List[Dict[str, float]]:
+    """
+    Evaluates positions in one call if evaluate has an evaluate_many method (e.g. a BatchEvaluation), otherwise one at
+    a time.
+    """
+    if hasattr(evaluate, 'evaluate_many'):
+        return evaluate.evaluate_many(positions)
+    return [evaluate(position) for position in positions]
 
 
 def select_top_n_moves(position: Position, evaluate: Callable[[Position], Dict[str, float]], n: int,
-                       pick_n_threatening: int, fluctuation: float = 0) -> Dict[
+                       pick_n_threatening: int, fluctuation: float = 0, prescreen_factor: int = None) -> Dict[
     str, List[Tuple[LegalMove, Position, float]]]:
+    """
+    Evaluates the position after every legal move and selects the n best, plus up to pick_n_threatening of the rest by
+    threat score.
+    :param prescreen_factor: if given, only the prescreen_factor * n moves ranked best by score_move_cheaply are made
+    and evaluated (see simple_bot.prescreen). None evaluates every legal move.
+    :return: {'top': selected (move, position, score), 'all': every (move, position, score) evaluated}
+    """
     to_move = position.to_move()
     initial_score = -evaluate(position)['eval']
     all_legal_moves = position.get_all_legal_moves_for_color(to_move)
+    if prescreen_factor is not None:
+        all_legal_moves = prescreen_moves(position, all_legal_moves, prescreen_factor * n)
     positions = [branch_from_position(position, move) for move in all_legal_moves]
-    evaluation_scores = [evaluate(posn) for posn in positions]
+    evaluation_scores = evaluate_positions(evaluate, positions)
     uci_bare_evaluation_dict: Dict[str, Dict[str, float]] = {}
     for i in range(len(all_legal_moves)):
         uci_bare_evaluation_dict[all_legal_moves[i].generate_uci()] = evaluation_scores[i]
@@ -85,8 +120,9 @@ def select_top_n_moves(position: Position, evaluate: Callable[[Position], Dict[s
                i in range(len(all_legal_moves))]
     if len(all_mpe) <= n:
         return {'top': all_mpe, 'all': all_mpe}
-    all_mpe_threat_scores = [(all_legal_moves[i], positions[i], evaluation_scores[i]['threat']) for i in
-                             range(len(all_legal_moves))]
+    all_mpe_threat_scores = [(all_legal_moves[i], positions[i], get_threat_score(evaluate, positions[i],
+                                                                                  evaluation_scores[i]))
+                             for i in range(len(all_legal_moves))] if pick_n_threatening > 0 else []
     all_mpe.sort(key=lambda x: x[2], reverse=True)
     all_mpe_threat_scores.sort(key=lambda x: x[2], reverse=True)
     returned_list = []
@@ -121,98 +157,366 @@ def select_top_n_moves(position: Position, evaluate: Callable[[Position], Dict[s
     return {'top': returned_list, 'all': all_mpe}
 
 
-def make_4_ply_move_tree(initial_mpe_list: List[Tuple[LegalMove, Position, float]],
-                         evaluate: Callable[[Position], Dict[str, float]], n: int,
-                         aggression: int, fluctuation: float = 0, assumed_opp_aggression: int = 1) -> Node:
-    tree = Node('Current', 0)
-    top_first_moves = initial_mpe_list
-    for first_move_tup in top_first_moves:
-        first_move = first_move_tup[0]
-        position_after_first_move = first_move_tup[1]
-        first_move_node = tree.add_child(first_move.generate_uci(), first_move_tup[2])
-        top_first_replies = \
-            select_top_n_moves(position_after_first_move, evaluate, n, assumed_opp_aggression, fluctuation)['top']
-        for first_reply_tup in top_first_replies:
-            first_reply = first_reply_tup[0]
-            position_after_first_reply = first_reply_tup[1]
-            first_reply_node = first_move_node.add_child(f'{first_move_node.get_name()}-{first_reply.generate_uci()}',
-                                                         first_reply_tup[2])
-            top_second_moves = select_top_n_moves(position_after_first_reply, evaluate, n, aggression, fluctuation)[
-                'top']
-            for second_move_tup in top_second_moves:
-                second_move = second_move_tup[0]
-                position_after_second_move = second_move_tup[1]
-                second_move_node = first_reply_node.add_child(
-                    f'{first_move_node.get_name()}-{second_move.generate_uci()}',
-                    second_move_tup[2])
-                top_second_replies = \
-                    select_top_n_moves(position_after_second_move, evaluate, n, assumed_opp_aggression, fluctuation)[
-                        'top']
-                for second_reply_tup in top_second_replies:
-                    second_reply = second_reply_tup[0]
-                    second_reply_node = second_move_node.add_child(
-                        f'{second_move_node.get_name()}-{second_reply.generate_uci()}',
-                        second_reply_tup[2])
-    return tree
+class EvaluationCache:
+    """
+    Wraps an evaluation function with a cache of its results keyed by position hash, evicting the least recently used
+    entry once max_entries are held. Call it like the evaluation function it wraps. The returned dicts are shared, so
+    callers must not modify them.
 
+    If the evaluation function leaves out 'threat' (e.g. evaluate_score), give the function working it out on its own
+    as threat_func (e.g. evaluate_threat). The searches then call get_threat only for the moves whose threat score they
+    need, and the threat scores are cached apart from the evaluations, up to max_entries of them.
 
-def make_move_tree(initial_mpe_list: List[Tuple[LegalMove, Position, float]],
-                   evaluate: Callable[[Position], Dict[str, float]], breadth: int = 3, aggression: int = 1,
-                   fluctuation: float = 0, assumed_opp_aggression: int = 1, ply_depth: int = 4) -> Node:
-    tree = Node('Current', 0)
+    Pickling it (e.g. passing it to a ProcessPoolExecutor task) sends only the evaluation function and the size, so
+    each worker starts with an empty cache.
+    """
 
-    def create_new_node_name(node: Node, move: LegalMove) -> str:
-        if node.get_name() == 'Current':
-            return move.generate_uci()
+    def __init__(self, evaluation_func: Callable[[Position], Dict[str, float]], max_entries: int = 2 ** 18,
+                 threat_func: Callable[[Position], float] = None):
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1.')
+        self.evaluation_func = evaluation_func
+        self.max_entries = max_entries
+        self.threat_func = threat_func
+        self.evaluations: OrderedDict[int, Dict[str, float]] = OrderedDict()
+        self.threats: OrderedDict[int, float] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        return {'evaluation_func': self.evaluation_func, 'max_entries': self.max_entries,
+                'threat_func': self.threat_func}
+
+    def __setstate__(self, state):
+        self.__init__(evaluation_func=state['evaluation_func'], max_entries=state['max_entries'],
+                      threat_func=state['threat_func'])
+
+    def __len__(self):
+        return len(self.evaluations)
+
+    def __call__(self, position: Position, lower_bound: float = None, upper_bound: float = None) -> Dict[str, float]:
+        """
+        The bounds are passed on to the evaluation function if given (see quick_evaluate). An evaluation cut short by
+        them (marked 'lazy') is returned without being kept.
+        """
+        position_hash = position.get_hash()
+        evaluation = self.evaluations.get(position_hash)
+        if evaluation is not None:
+            self.hits += 1
+            self.evaluations.move_to_end(position_hash)
+            return evaluation
+        self.misses += 1
+        if lower_bound is None and upper_bound is None:
+            evaluation = self.evaluation_func(position)
         else:
-            return f'{node.get_name()}-{move.generate_uci()}'
+            evaluation = self.evaluation_func(position, lower_bound=lower_bound, upper_bound=upper_bound)
+            if evaluation.get('lazy'):
+                return evaluation
+        self.evaluations[position_hash] = evaluation
+        if len(self.evaluations) > self.max_entries:
+            self.evaluations.popitem(last=False)
+        return evaluation
+
+    def evaluate_many(self, positions: List[Position]) -> List[Dict[str, float]]:
+        """
+        Same as calling the cache on each position, except that the positions not in the cache are evaluated in one
+        call if the evaluation function has an evaluate_many method.
+        """
+        if not hasattr(self.evaluation_func, 'evaluate_many'):
+            return [self(position) for position in positions]
+        evaluations: List[Union[Dict[str, float], None]] = [self.evaluations.get(position.get_hash())
+                                                             for position in positions]
+        missing_indices = [i for i in range(len(positions)) if evaluations[i] is None]
+        self.hits += len(positions) - len(missing_indices)
+        self.misses += len(missing_indices)
+        for i in range(len(positions)):
+            if evaluations[i] is not None:
+                self.evaluations.move_to_end(positions[i].get_hash())
+        if missing_indices:
+            new_evaluations = self.evaluation_func.evaluate_many([positions[i] for i in missing_indices])
+            for i, evaluation in zip(missing_indices, new_evaluations):
+                evaluations[i] = evaluation
+                self.evaluations[positions[i].get_hash()] = evaluation
+            while len(self.evaluations) > self.max_entries:
+                self.evaluations.popitem(last=False)
+        return evaluations
+
+    def get_threat(self, position: Position) -> float:
+        # AN EVALUATION FUNCTION WITH ITS OWN get_threat (e.g. a BatchEvaluation) NEEDS NO threat_func
+        threat_func = self.threat_func if self.threat_func is not None else \
+            getattr(self.evaluation_func, 'get_threat', None)
+        if threat_func is None:
+            raise ValueError('The evaluation function gives no threat score and no threat_func was given.')
+        position_hash = position.get_hash()
+        threat_score = self.threats.get(position_hash)
+        if threat_score is not None:
+            self.threats.move_to_end(position_hash)
+            return threat_score
+        threat_score = threat_func(position)
+        self.threats[position_hash] = threat_score
+        if len(self.threats) > self.max_entries:
+            self.threats.popitem(last=False)
+        return threat_score
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        :return: hits, misses, hit rate and number of entries since the cache was made or last cleared.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.evaluations)}
+
+    def clear(self) -> None:
+        self.evaluations.clear()
+        self.threats.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class ExpansionCache:
+    """
+    Keeps the select_top_n_moves result for every position a search expanded, so that the next search can continue
+    from the subtree it already has instead of generating and evaluating the same moves again. Keyed by position hash
+    and the selection parameters. Only valid for one evaluation function.
 
-    current_depth = 1
-    while current_depth <= ply_depth:
-        agg = aggression if (current_depth % 2) else assumed_opp_aggression
-        if current_depth == 1:
-            for mpe in initial_mpe_list:
-                tree.add_child(create_new_node_name(tree, mpe[0]), {'P': mpe[1], 'S': mpe[2]})
-        else:
-            current_leaves = search_downstream(tree)
-            for leaf in current_leaves:
-                position: Position = leaf.get_value()['P']
-                top_n_moves = select_top_n_moves(position, evaluate, n=breadth, pick_n_threatening=agg,
-                                                 fluctuation=fluctuation)['top']
-                for mpe in top_n_moves:
-                    leaf.add_child(create_new_node_name(leaf, mpe[0]), {'P': mpe[1], 'S': mpe[2]})
-        current_depth += 1
-    return tree
+    Only the positions of the 'top' moves are kept, as only those are searched further. The other moves in 'all' keep
+    their move and score, with None for the position, and the hashes of their positions for reroot. A position costs
+    about APPROXIMATE_POSITION_BYTES and a move kept without one about APPROXIMATE_MOVE_BYTES.
 
+    Call reroot with the new root position before each search to drop everything the game can no longer reach.
+    """
 
-def aggregator(leaf_vals: Iterable) -> float:
-    def e(val):
-        return val if (type(val) == float or type(val) == int) else val['S']
+    def __init__(self):
+        self.expansions: Dict[Tuple[int, int, int, float, int], Dict[str, list]] = {}
+        self.n_positions = 0
+        self.n_moves = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.expansions)
+
+    def select_top_n_moves(self, position: Position, evaluate: Callable[[Position], Dict[str, float]], n: int,
+                           pick_n_threatening: int, fluctuation: float = 0, prescreen_factor: int = None,
+                           with_all_positions: bool = False) -> Dict[str, List[Tuple[LegalMove, Position, float]]]:
+        """
+        :param with_all_positions: True to have the positions of every move in 'all', made again if the expansion was
+        kept. Otherwise only the 'top' moves have their positions in 'all'.
+        """
+        key = (position.get_hash(), n, pick_n_threatening, fluctuation, prescreen_factor)
+        if key in self.expansions:
+            self.hits += 1
+            expansion = self.expansions[key]
+            if not with_all_positions:
+                return expansion
+            return {'top': expansion['top'],
+                    'all': [(move, branch_from_position(position, move) if child_position is None else child_position,
+                             score) for move, child_position, score in expansion['all']]}
+        self.misses += 1
+        expansion = select_top_n_moves(position=position, evaluate=evaluate, n=n,
+                                       pick_n_threatening=pick_n_threatening, fluctuation=fluctuation,
+                                       prescreen_factor=prescreen_factor)
+        top_positions = {id(mpe[1]) for mpe in expansion['top']}
+        self.expansions[key] = {'top': expansion['top'],
+                                'all': [(move, child_position if id(child_position) in top_positions else None, score)
+                                        for move, child_position, score in expansion['all']],
+                                'hashes': [mpe[1].get_hash() for mpe in expansion['all']]}
+        self.n_positions += len(expansion['top'])
+        self.n_moves += len(expansion['all'])
+        return expansion if with_all_positions else self.expansions[key]
+
+    def reroot(self, position: Position) -> None:
+        """
+        Keeps only the expansions reachable from position through expanded moves. Clears the cache if position was
+        never expanded.
+        :param position: the position about to be searched.
+        :return:
+        """
+        keys_by_hash: Dict[int, List[Tuple[int, int, int, float, int]]] = {}
+        for key in self.expansions:
+            keys_by_hash.setdefault(key[0], []).append(key)
+        reachable_keys = set()
+        hashes_to_visit = [position.get_hash()]
+        visited_hashes = set(hashes_to_visit)
+        while hashes_to_visit:
+            position_hash = hashes_to_visit.pop()
+            for key in keys_by_hash.get(position_hash, []):
+                reachable_keys.add(key)
+                for child_hash in self.expansions[key]['hashes']:
+                    if child_hash not in visited_hashes:
+                        visited_hashes.add(child_hash)
+                        hashes_to_visit.append(child_hash)
+        self.expansions = {key: self.expansions[key] for key in self.expansions if key in reachable_keys}
+        self.n_positions = sum(len(expansion['top']) for expansion in self.expansions.values())
+        self.n_moves = sum(len(expansion['all']) for expansion in self.expansions.values())
+
+    def clear(self) -> None:
+        self.expansions = {}
+        self.n_positions = 0
+        self.n_moves = 0
+
+
+class SearchBudget:
+    """
+    Caps the nodes one search expands and the memory it holds in positions. Once either limit is reached, the search
+    stops expanding, scores the nodes it has not expanded by their static evaluation and backs up what it has.
+
+    Memory is estimated as APPROXIMATE_POSITION_BYTES per position held: the positions in the expansion cache if the
+    search uses one, with APPROXIMATE_MOVE_BYTES for each move it keeps, otherwise the positions the search itself is
+    holding on to.
+    """
+
+    def __init__(self, max_nodes: int = None, max_memory_bytes: int = None, expansion_cache: ExpansionCache = None):
+        self.max_nodes = max_nodes
+        self.max_memory_bytes = max_memory_bytes
+        self.expansion_cache = expansion_cache
+        self.nodes = 0
+        self.held_positions = 0
+        self.peak_memory_bytes = 0
+        self.exhausted = False
+
+    def get_memory_estimate(self) -> int:
+        if self.expansion_cache is not None:
+            return self.expansion_cache.n_positions * APPROXIMATE_POSITION_BYTES + \
+                self.expansion_cache.n_moves * APPROXIMATE_MOVE_BYTES
+        return self.held_positions * APPROXIMATE_POSITION_BYTES
+
+    def check_memory(self) -> None:
+        memory_bytes = self.get_memory_estimate()
+        self.peak_memory_bytes = max(self.peak_memory_bytes, memory_bytes)
+        if self.max_memory_bytes is not None and memory_bytes >= self.max_memory_bytes:
+            self.exhausted = True
+
+    def add_node(self) -> None:
+        self.nodes += 1
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            self.exhausted = True
+        self.check_memory()
+
+    def hold_positions(self, n_positions: int) -> None:
+        self.held_positions += n_positions
+        self.check_memory()
+
+    def release_positions(self, n_positions: int) -> None:
+        self.held_positions -= n_positions
+
+    def get_usage(self) -> Dict[str, Union[int, bool, None]]:
+        """
+        :return: nodes expanded and estimated peak memory, next to their limits (None if unlimited), and whether the
+        search was cut short.
+        """
+        return {'nodes': self.nodes, 'max_nodes': self.max_nodes, 'peak_memory_bytes': self.peak_memory_bytes,
+                'max_memory_bytes': self.max_memory_bytes, 'exhausted': self.exhausted}
+
+
+def expand_position(position: Position, evaluate: Callable[[Position], Dict[str, float]], n: int,
+                    pick_n_threatening: int, fluctuation: float = 0, expansion_cache: ExpansionCache = None,
+                    budget: SearchBudget = None, prescreen_factor: int = None,
+                    with_all_positions: bool = False) -> Dict[str, List[Tuple[LegalMove, Position, float]]]:
+    """
+    select_top_n_moves, through expansion_cache if one is given. Counts the node against budget if one is given.
+    :param with_all_positions: see ExpansionCache.select_top_n_moves. Without an expansion cache, 'all' always has
+    the positions.
+    """
+    if budget is not None:
+        budget.add_node()
+    if expansion_cache is None:
+        return select_top_n_moves(position=position, evaluate=evaluate, n=n, pick_n_threatening=pick_n_threatening,
+                                  fluctuation=fluctuation, prescreen_factor=prescreen_factor)
+    return expansion_cache.select_top_n_moves(position=position, evaluate=evaluate, n=n,
+                                              pick_n_threatening=pick_n_threatening, fluctuation=fluctuation,
+                                              prescreen_factor=prescreen_factor,
+                                              with_all_positions=with_all_positions)
+
+
+def search_leaf_node(position: Position, evaluation_func: Callable[..., Dict[str, float]], n: int,
+                     fluctuation: float = 0, budget: SearchBudget = None,
+                     prescreen_factor: int = None) -> Tuple[str, float]:
+    """
+    What search_node_recursive gives at ply_depth 1, where only the best move counts, without evaluating every move in
+    full. Each move is evaluated with the best score so far as lower bound, so the evaluation can stop early for moves
+    that cannot beat it. evaluation_func must take lower_bound like quick_evaluate. Nothing is kept in an expansion
+    cache.
+    """
+    if budget is not None:
+        budget.add_node()
+    to_move = position.to_move()
+    all_legal_moves = position.get_all_legal_moves_for_color(to_move)
+    if not all_legal_moves:
+        if position.is_under_check(to_move):
+            return '0000', -9999
+        else:
+            return '0000', 0
+    if prescreen_factor is not None:
+        all_legal_moves = prescreen_moves(position, all_legal_moves, prescreen_factor * n)
+    noises = [uniform(-fluctuation, fluctuation) for _ in all_legal_moves]
+    if len(all_legal_moves) <= n:
+        # select_top_n_moves LEAVES THE MOVES UNSORTED WHEN THERE ARE NO MORE THAN n
+        return all_legal_moves[0].generate_uci(), \
+            evaluation_func(branch_from_position(position, all_legal_moves[0]))['eval'] + noises[0]
+    # CAPTURES FIRST, AS THE BEST MOVE IS OFTEN ONE AND A HIGH BOUND EARLY CUTS MORE EVALUATIONS SHORT. TIES STILL GO TO
+    # THE EARLIEST MOVE, AS IN select_top_n_moves
+    best_index, best_score = None, None
+    for i in sorted(range(len(all_legal_moves)), key=lambda x: not all_legal_moves[x].is_capture()):
+        child = branch_from_position(position, all_legal_moves[i])
+        if best_score is None:
+            score = evaluation_func(child)['eval'] + noises[i]
+        else:
+            score = evaluation_func(child, lower_bound=best_score - noises[i])['eval'] + noises[i]
+        if best_score is None or score > best_score or (score == best_score and i < best_index):
+            best_index, best_score = i, score
+    return all_legal_moves[best_index].generate_uci(), best_score
 
-    return max([e(leaf_val) for leaf_val in leaf_vals])
 
+def make_move_tree(initial_mpe_list: List[Tuple[LegalMove, Position, float]],
+                   evaluate: Callable[[Position], Dict[str, float]], breadth: int = 3, aggression: int = 1,
+                   fluctuation: float = 0, assumed_opp_aggression: int = 1, ply_depth: int = 4,
+                   expansion_cache: ExpansionCache = None, budget: SearchBudget = None,
+                   prescreen_factor: int = None) -> SearchTree:
+    """
+    Builds the tree one ply at a time. Only the positions of the current deepest nodes are kept, and each one is
+    dropped as soon as its children have been generated. If budget runs out, the nodes not yet expanded stay leaves.
+    """
+    tree = SearchTree()
+    frontier: List[Tuple[int, Position]] = []
+    for mpe in initial_mpe_list:
+        frontier.append((tree.add_node(0, mpe[0].generate_uci(), mpe[2]), mpe[1]))
+    if budget is not None:
+        budget.hold_positions(len(frontier))
+    for current_depth in range(2, ply_depth + 1):
+        agg = aggression if (current_depth % 2) else assumed_opp_aggression
+        next_frontier: List[Tuple[int, Position]] = []
+        for node, position in frontier:
+            if budget is not None and budget.exhausted:
+                break
+            top_n_moves = expand_position(position, evaluate, n=breadth, pick_n_threatening=agg,
+                                          fluctuation=fluctuation, expansion_cache=expansion_cache,
+                                          budget=budget, prescreen_factor=prescreen_factor)['top']
+            for mpe in top_n_moves:
+                next_frontier.append((tree.add_node(node, mpe[0].generate_uci(), mpe[2]), mpe[1]))
+            if budget is not None:
+                budget.hold_positions(len(top_n_moves))
+        if budget is not None:
+            budget.release_positions(len(frontier))
+        frontier = next_frontier
+    if budget is not None:
+        budget.release_positions(len(frontier))
+    return tree
 
-def collapse_at_level(tree: Node, level: int, aggregator: Callable[[List[Union[Position, float]]], float]):
-    all_leaves = search_downstream(tree)
-    levels = [len(leave.get_name().split('-')) for leave in all_leaves]
-    highest_level = max(levels)
-    if highest_level == 1 or level > highest_level or level == 1:
-        return
-    collapsed_node_names = []
-    for leave in all_leaves:
-        if len(leave.get_name().split('-')) != level:
-            continue
-        if leave.get_name().rsplit('-', maxsplit=1)[0] not in collapsed_node_names:
-            parent = leave.get_parent()
-            collapse_node(parent, aggregator)
-            collapsed_node_names.append(parent.get_name())
+
+def aggregator(leaf_vals: Iterable) -> float:
+    return max(leaf_vals)
 
 
 def choose_best_move(position: Position, evaluate: Callable[[Position], Dict[str, float]],
                      breadth: int = 3, aggression: int = 1, fluctuation: float = 0, assumed_opp_aggression: int = 1,
-                     ply_depth: int = 4) -> str:
+                     ply_depth: int = 4, expansion_cache: ExpansionCache = None, budget: SearchBudget = None,
+                     prescreen_factor: int = None) -> str:
     """
     Returns a UCI notation e.g. 'd1h5'
+    :param prescreen_factor:
+    :param expansion_cache:
+    :param budget:
     :param ply_depth:
     :param assumed_opp_aggression:
     :param fluctuation:
@@ -223,8 +527,11 @@ def choose_best_move(position: Position, evaluate: Callable[[Position], Dict[str
     :return:
     """
     initial_score = -evaluate(position)['eval']
-    all_mpe_and_top = select_top_n_moves(position=position, evaluate=evaluate, n=breadth,
-                                         pick_n_threatening=aggression, fluctuation=fluctuation)
+    # THE SECOND BATCH OF ROOT MOVES IS DRAWN FROM 'all', SO IT NEEDS THEIR POSITIONS
+    all_mpe_and_top = expand_position(position=position, evaluate=evaluate, n=breadth,
+                                      pick_n_threatening=aggression, fluctuation=fluctuation,
+                                      expansion_cache=expansion_cache, budget=budget,
+                                      prescreen_factor=prescreen_factor, with_all_positions=True)
     all_mpe = all_mpe_and_top['all']
     if len(all_mpe) == 1:
         return all_mpe[0][0].generate_uci()
@@ -235,7 +542,8 @@ def choose_best_move(position: Position, evaluate: Callable[[Position], Dict[str
         uci_mpe_dict[mpe[0].generate_uci()] = mpe
     best_move, best_score = converge(mpe_list=top_mpe, evaluation_func=evaluate, breadth=breadth, aggression=aggression,
                                      fluctuation=fluctuation, assumed_opp_aggression=assumed_opp_aggression,
-                                     tree_ply_depth=ply_depth, aggregator=aggregator)
+                                     tree_ply_depth=ply_depth, aggregator=aggregator, expansion_cache=expansion_cache,
+                                     budget=budget, prescreen_factor=prescreen_factor)
     for uci in top_moves_uci:
         uci_mpe_dict.pop(uci)
     next_n_mpe = select_n_random_mpe(breadth=breadth, evaluate=evaluate, initial_score=initial_score,
@@ -244,7 +552,9 @@ def choose_best_move(position: Position, evaluate: Callable[[Position], Dict[str
         return best_move
     run2_best_move, run2_best_score = converge(mpe_list=next_n_mpe, evaluation_func=evaluate, breadth=breadth,
                                                aggression=aggression, fluctuation=fluctuation, aggregator=aggregator,
-                                               assumed_opp_aggression=assumed_opp_aggression, tree_ply_depth=ply_depth)
+                                               assumed_opp_aggression=assumed_opp_aggression, tree_ply_depth=ply_depth,
+                                               expansion_cache=expansion_cache, budget=budget,
+                                               prescreen_factor=prescreen_factor)
     candidates = [(best_move, best_score), (run2_best_move, run2_best_score)]
     # next_n_mpe = select_n_random_mpe(breadth, evaluate, initial_score, uci_mpe_dict)
     # if next_n_mpe:
@@ -254,6 +564,20 @@ def choose_best_move(position: Position, evaluate: Callable[[Position], Dict[str
     return candidates[0][0]
 
 
+def pick_best_candidate(candidates: List[Tuple[str, float]]) -> Tuple[str, float]:
+    """
+    Picks the highest scoring (uci, score) pair. Ties go to the earliest candidate.
+    :param candidates:
+    :return:
+    """
+    best_move, best_score = candidates[0]
+    for uci, score in candidates:
+        if score > best_score:
+            best_score = score
+            best_move = uci
+    return best_move, best_score
+
+
 def select_n_random_mpe(breadth: int, evaluate: Callable[[Position], Dict[str, float]], initial_score: float,
                         uci_mpe_dict: Dict[str, Tuple[LegalMove, Position, float]]) -> List[
     Tuple[LegalMove, Position, float]]:
@@ -266,7 +590,7 @@ def select_n_random_mpe(breadth: int, evaluate: Callable[[Position], Dict[str, f
         score = mpe[2]
         if initial_score - score > 1.5:
             position = mpe[1]
-            threat_score = evaluate(position)['threat']
+            threat_score = get_threat_score(evaluate, position)
             if threat_score < 7:
                 uci_mpe_dict.pop(random_choice_uci)
                 continue
@@ -277,31 +601,30 @@ def select_n_random_mpe(breadth: int, evaluate: Callable[[Position], Dict[str, f
 
 
 def converge(mpe_list, evaluation_func, breadth: int = 3, aggression: int = 1, fluctuation: float = 0,
-             assumed_opp_aggression: int = 0, tree_ply_depth: int = 4, aggregator: Callable[[Iterable], float] = max) -> \
-        Tuple[str, float]:
+             assumed_opp_aggression: int = 0, tree_ply_depth: int = 4, aggregator: Callable[[Iterable], float] = max,
+             expansion_cache: ExpansionCache = None, budget: SearchBudget = None,
+             prescreen_factor: int = None) -> Tuple[str, float]:
     tree = make_move_tree(initial_mpe_list=mpe_list, evaluate=evaluation_func, breadth=breadth, aggression=aggression,
                           fluctuation=fluctuation, assumed_opp_aggression=assumed_opp_aggression,
-                          ply_depth=tree_ply_depth)
-    for i in range(tree_ply_depth, 1, -1):
-        if i % 2:
-            collapse_at_level(tree=tree, level=i, aggregator=aggregator)
-        else:
-            collapse_at_level(tree=tree, level=i, aggregator=lambda x: -aggregator(x))
-
-    candidate_moves = tree.get_children()
-    best_move = candidate_moves[0].get_name()
-    best_score = candidate_moves[0].get_value()
-    for move in candidate_moves:
-        move_score = move.get_value()
-        if move_score > best_score:
-            best_score = move_score
-            best_move = move.get_name()
+                          ply_depth=tree_ply_depth, expansion_cache=expansion_cache, budget=budget,
+                          prescreen_factor=prescreen_factor)
+    values = tree.back_up(aggregator)
+    candidate_moves = tree.get_root_children()
+    best_move = tree.moves[candidate_moves[0]]
+    best_score = values[candidate_moves[0]]
+    for node in candidate_moves:
+        if values[node] > best_score:
+            best_score = values[node]
+            best_move = tree.moves[node]
     return best_move, best_score
 
 
 def choose_best_move_recursive(position: Position, evaluation_func: Callable[[Position], Dict[str, float]],
                                breadth: int = 3, aggression: int = 1, fluctuation: float = 0,
-                               assumed_opp_aggression: int = 1, ply_depth: int = 4) -> Tuple[str, float]:
+                               assumed_opp_aggression: int = 1, ply_depth: int = 4, transposition_table=None,
+                               should_stop: Callable[[], bool] = None, expansion_cache: ExpansionCache = None,
+                               budget: SearchBudget = None, lazy_leaves: bool = False,
+                               prescreen_factor: int = None) -> Tuple[str, float]:
     """
 
     :param position:
@@ -311,10 +634,48 @@ def choose_best_move_recursive(position: Position, evaluation_func: Callable[[Po
     :param fluctuation:
     :param assumed_opp_aggression:
     :param ply_depth:
+    :param transposition_table: optional table with probe(hash) and store(hash, depth, score, uci) methods, e.g. a
+    SharedTranspositionTable. A position already searched to at least ply_depth is not searched again.
+    :param should_stop: optional callback checked at every node. Raises SearchAborted once it returns True.
+    :param expansion_cache: optional ExpansionCache kept between searches.
+    :param budget: optional SearchBudget. Once it runs out, candidate moves not yet searched are scored by their static
+    evaluation.
+    :param lazy_leaves: search the nodes at ply_depth 1 with search_leaf_node. evaluation_func must then take bounds
+    like quick_evaluate.
+    :param prescreen_factor: at every node, only evaluate the prescreen_factor * breadth moves ranked best by
+    score_move_cheaply. None evaluates every legal move.
     :return:
     """
-    all_mpe = select_top_n_moves(position=position, evaluate=evaluation_func, n=breadth, pick_n_threatening=aggression,
-                                 fluctuation=fluctuation)
+    if should_stop is not None and should_stop():
+        raise SearchAborted
+    if transposition_table is not None:
+        entry = transposition_table.probe(position.get_hash())
+        if entry is not None and entry[0] >= ply_depth:
+            return entry[2], entry[1]
+    best_move, best_score = search_node_recursive(position=position, evaluation_func=evaluation_func,
+                                                  breadth=breadth, aggression=aggression, fluctuation=fluctuation,
+                                                  assumed_opp_aggression=assumed_opp_aggression, ply_depth=ply_depth,
+                                                  transposition_table=transposition_table, should_stop=should_stop,
+                                                  expansion_cache=expansion_cache, budget=budget,
+                                                  lazy_leaves=lazy_leaves, prescreen_factor=prescreen_factor)
+    if transposition_table is not None:
+        transposition_table.store(position.get_hash(), ply_depth, best_score, best_move)
+    return best_move, best_score
+
+
+def search_node_recursive(position: Position, evaluation_func: Callable[[Position], Dict[str, float]],
+                          breadth: int, aggression: int, fluctuation: float, assumed_opp_aggression: int,
+                          ply_depth: int, transposition_table, should_stop: Callable[[], bool],
+                          expansion_cache: ExpansionCache = None, budget: SearchBudget = None,
+                          lazy_leaves: bool = False, prescreen_factor: int = None) -> Tuple[str, float]:
+    if lazy_leaves and ply_depth == 1:
+        return search_leaf_node(position=position, evaluation_func=evaluation_func, n=breadth,
+                                fluctuation=fluctuation, budget=budget, prescreen_factor=prescreen_factor)
+    # AT THE LAST PLY ONLY THE BEST MOVE COUNTS, SO NO THREAT SCORES ARE NEEDED UNLESS THE EXPANSION IS KEPT
+    pick_n_threatening = 0 if ply_depth == 1 and expansion_cache is None else aggression
+    all_mpe = expand_position(position=position, evaluate=evaluation_func, n=breadth,
+                              pick_n_threatening=pick_n_threatening, fluctuation=fluctuation,
+                              expansion_cache=expansion_cache, budget=budget, prescreen_factor=prescreen_factor)
     if len(all_mpe['all']) == 0:
         if position.is_under_check(position.to_move()):
             return '0000', -9999
@@ -330,16 +691,30 @@ def choose_best_move_recursive(position: Position, evaluation_func: Callable[[Po
         candidate_mpes = all_mpe['top']
         candidate_moves_uci = [mpe[0].generate_uci() for mpe in candidate_mpes]
         uci_position_dict: Dict[str, Position] = {}
+        uci_static_score_dict: Dict[str, float] = {}
         for mpe in candidate_mpes:
             uci_position_dict[mpe[0].generate_uci()] = mpe[1]
+            uci_static_score_dict[mpe[0].generate_uci()] = mpe[2]
+        if budget is not None:
+            budget.hold_positions(len(all_mpe['all']))
         uci_score_dict: Dict[str, float] = {}
         for uci in candidate_moves_uci:
+            if budget is not None and budget.exhausted:
+                uci_score_dict[uci] = uci_static_score_dict[uci]
+                continue
             uci_score_dict[uci] = -1 * \
                                   choose_best_move_recursive(position=uci_position_dict[uci],
                                                              evaluation_func=evaluation_func,
                                                              breadth=breadth, aggression=assumed_opp_aggression,
                                                              fluctuation=fluctuation, assumed_opp_aggression=aggression,
-                                                             ply_depth=ply_depth - 1)[1]
+                                                             ply_depth=ply_depth - 1,
+                                                             transposition_table=transposition_table,
+                                                             should_stop=should_stop,
+                                                             expansion_cache=expansion_cache, budget=budget,
+                                                             lazy_leaves=lazy_leaves,
+                                                             prescreen_factor=prescreen_factor)[1]
+        if budget is not None:
+            budget.release_positions(len(all_mpe['all']))
         best_move = candidate_moves_uci[0]
         best_score = uci_score_dict[best_move]
         for uci in uci_score_dict:
@@ -348,3 +723,54 @@ def choose_best_move_recursive(position: Position, evaluation_func: Callable[[Po
                 best_score = score
                 best_move = uci
         return best_move, best_score
+
+
+def choose_best_move_recursive_stoppable(position: Position,
+                                         evaluation_func: Callable[[Position], Dict[str, float]],
+                                         should_stop: Callable[[], bool], breadth: int = 3, aggression: int = 1,
+                                         fluctuation: float = 0, assumed_opp_aggression: int = 1, ply_depth: int = 4,
+                                         transposition_table=None, expansion_cache: ExpansionCache = None,
+                                         budget: SearchBudget = None, lazy_leaves: bool = False,
+                                         prescreen_factor: int = None) -> Tuple[str, float]:
+    """
+    Same search as choose_best_move_recursive, except that once should_stop returns True the search is abandoned and
+    the best move found so far is returned. Root moves whose subtree was not finished are left out. If no subtree was
+    finished, returns the candidate move with the best static evaluation.
+    :return:
+    """
+    if lazy_leaves and ply_depth == 1:
+        return search_leaf_node(position=position, evaluation_func=evaluation_func, n=breadth,
+                                fluctuation=fluctuation, budget=budget, prescreen_factor=prescreen_factor)
+    # AT THE LAST PLY ONLY THE BEST MOVE COUNTS, SO NO THREAT SCORES ARE NEEDED UNLESS THE EXPANSION IS KEPT
+    pick_n_threatening = 0 if ply_depth == 1 and expansion_cache is None else aggression
+    all_mpe = expand_position(position=position, evaluate=evaluation_func, n=breadth,
+                              pick_n_threatening=pick_n_threatening, fluctuation=fluctuation,
+                              expansion_cache=expansion_cache, budget=budget, prescreen_factor=prescreen_factor)
+    if len(all_mpe['all']) == 0:
+        if position.is_under_check(position.to_move()):
+            return '0000', -9999
+        else:
+            return '0000', 0
+    if len(all_mpe['all']) == 1 or ply_depth == 1:
+        return all_mpe['all'][0][0].generate_uci(), all_mpe['all'][0][2]
+    candidate_mpes = all_mpe['top']
+    candidates = []
+    for mpe in candidate_mpes:
+        if budget is not None and budget.exhausted:
+            candidates.append((mpe[0].generate_uci(), mpe[2]))
+            continue
+        try:
+            score = -1 * choose_best_move_recursive(position=mpe[1], evaluation_func=evaluation_func, breadth=breadth,
+                                                    aggression=assumed_opp_aggression, fluctuation=fluctuation,
+                                                    assumed_opp_aggression=aggression, ply_depth=ply_depth - 1,
+                                                    transposition_table=transposition_table,
+                                                    should_stop=should_stop, expansion_cache=expansion_cache,
+                                                    budget=budget, lazy_leaves=lazy_leaves,
+                                                    prescreen_factor=prescreen_factor)[1]
+        except SearchAborted:
+            break
+        candidates.append((mpe[0].generate_uci(), score))
+    if not candidates:
+        static_best_mpe = max(candidate_mpes, key=lambda x: x[2])
+        return static_best_mpe[0].generate_uci(), static_best_mpe[2]
+    return pick_best_candidate(candidates)
@@ -0,0 +1,147 @@
+from typing import Callable, Dict, List, Sequence, Union
+
+import numpy as np
+
+from classes.position import Position, opposite_color
+from simple_bot.bitboards import PIECE_ORDER, SQUARE_BITS
+from simple_bot.bot1.evaluation import evaluate_threat
+
+# AN INPUT FEATURE IS ONE PIECE ON ONE SQUARE, SEEN FROM ONE SIDE: (OWN OR OTHER COLOR * 6 + PIECE) * 64 + SQUARE, WITH
+# SQUARES NUMBERED AS IN simple_bot.bitboards (a1 = 0, h8 = 63). FROM BLACK'S SIDE, RANKS ARE MIRRORED
+N_FEATURES = 768
+SQUARE_INDICES = {square: bit.bit_length() - 1 for square, bit in SQUARE_BITS.items()}
+PERSPECTIVES = ('w', 'b')  # ROW OF EACH SIDE'S ACCUMULATOR
+
+
+def get_feature_index(perspective: str, color: str, piece: str, square: str) -> int:
+    square_index = SQUARE_INDICES[square] if perspective == 'w' else SQUARE_INDICES[square] ^ 56
+    return ((0 if color == perspective else 1) * 6 + PIECE_ORDER.index(piece)) * 64 + square_index
+
+
+def check_nnue_weights(weights: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    Layers: accumulator = b1 + the rows of w1 (768 x H) of the pieces, one for each side. Then clipped to [0, 1] and
+    joined (side that has just moved first) for a dense layer w2 (2H x H2), b2, clipped again, and the output w3 (H2),
+    b3, in pawns for the side that has just moved.
+    :return: the weights as float64 arrays, with w3 flattened and b3 a scalar.
+    """
+    missing_keys = [key for key in ('w1', 'b1', 'w2', 'b2', 'w3', 'b3') if key not in weights]
+    if missing_keys:
+        raise ValueError(f'NNUE weights are missing {missing_keys}.')
+    checked = {key: np.asarray(weights[key], dtype=np.float64) for key in ('w1', 'b1', 'w2', 'b2', 'w3', 'b3')}
+    checked['w3'] = checked['w3'].reshape(-1)
+    checked['b3'] = checked['b3'].reshape(-1)
+    hidden_size = checked['b1'].shape[0] if checked['b1'].ndim == 1 else -1
+    second_hidden_size = checked['b2'].shape[0] if checked['b2'].ndim == 1 else -1
+    if checked['w1'].shape != (N_FEATURES, hidden_size) or \
+            checked['w2'].shape != (2 * hidden_size, second_hidden_size) or \
+            checked['w3'].shape != (second_hidden_size,) or checked['b3'].shape != (1,):
+        shapes = {key: np.shape(weights[key]) for key in checked}
+        raise ValueError(f'NNUE weight shapes do not fit together: {shapes}.')
+    checked['b3'] = checked['b3'][0]
+    return checked
+
+
+def load_nnue_weights(path: str) -> Dict[str, np.ndarray]:
+    """
+    :param path: .npz file with arrays w1, b1, w2, b2, w3 and b3 (see check_nnue_weights).
+    """
+    with np.load(path) as npz_file:
+        return check_nnue_weights({key: npz_file[key] for key in npz_file.files})
+
+
+def save_nnue_weights(path: str, weights: Dict[str, np.ndarray]) -> None:
+    np.savez(path, **check_nnue_weights(weights))
+
+
+def create_random_weights(hidden_size: int = 128, second_hidden_size: int = 32,
+                          seed: int = 0) -> Dict[str, np.ndarray]:
+    """
+    Untrained weights of the right shapes, e.g. as a starting point for training.
+    """
+    rng = np.random.default_rng(seed)
+    return {'w1': rng.normal(0, 0.1, (N_FEATURES, hidden_size)), 'b1': np.full(hidden_size, 0.5),
+            'w2': rng.normal(0, 1 / np.sqrt(2 * hidden_size), (2 * hidden_size, second_hidden_size)),
+            'b2': np.zeros(second_hidden_size),
+            'w3': rng.normal(0, 1 / np.sqrt(second_hidden_size), second_hidden_size), 'b3': np.zeros(1)}
+
+
+class NNUEEvaluation:
+    """
+    Evaluates with a small network whose first layer is kept up to date in the positions themselves. The first time a
+    position is evaluated, the accumulator of each color (the sum of the first-layer rows of its pieces, from both
+    sides) is worked out and stored in its ColorPosition, which then adds and subtracts rows as pieces are placed,
+    moved and taken. Positions branched from it copy the accumulators, so evaluating a leaf costs one addition and two
+    small dense layers. Use it as evaluation_func of a Bot. Like BatchEvaluation, the dicts it returns have no
+    'threat', which comes from threat_func through get_threat, and checkmates are not detected.
+    """
+
+    def __init__(self, weights: Union[str, Dict[str, np.ndarray]],
+                 threat_func: Callable[[Position], float] = evaluate_threat):
+        """
+        :param weights: path of an .npz file (see load_nnue_weights), or the weights themselves.
+        :param threat_func:
+        """
+        self.weights = load_nnue_weights(weights) if isinstance(weights, str) else check_nnue_weights(weights)
+        self.threat_func = threat_func
+        # {color: {piece: {square: the rows of w1 for that piece from both sides}}}, AS ColorPosition TAKES THEM
+        self.accumulator_weights = {color: {piece: {square: np.stack(
+            [self.weights['w1'][get_feature_index(perspective, color, piece, square)] for perspective in PERSPECTIVES])
+            for square in SQUARE_INDICES} for piece in PIECE_ORDER} for color in PERSPECTIVES}
+
+    def __getstate__(self):
+        return {'weights': self.weights, 'threat_func': self.threat_func}
+
+    def __setstate__(self, state):
+        self.__init__(weights=state['weights'], threat_func=state['threat_func'])
+
+    def attach(self, position: Position) -> None:
+        """
+        Works out the accumulators of position from scratch and stores them in its ColorPositions.
+        """
+        for color in PERSPECTIVES:
+            color_position = position.get_pieces_by_color(color)
+            accumulator_weights = self.accumulator_weights[color]
+            color_position.accumulator_weights = accumulator_weights
+            color_position.accumulator = np.zeros((2, self.weights['b1'].shape[0]))
+            for piece, squares in color_position.all_piece_squares.items():
+                for square in squares:
+                    color_position.accumulator += accumulator_weights[piece][square]
+
+    def get_accumulators(self, position: Position) -> np.ndarray:
+        """
+        :return: 2 x H array, the accumulator from white's side then from black's.
+        """
+        white_pieces, black_pieces = position.get_pieces_by_color('w'), position.get_pieces_by_color('b')
+        if white_pieces.accumulator_weights is not self.accumulator_weights['w'] or \
+                black_pieces.accumulator_weights is not self.accumulator_weights['b']:
+            self.attach(position)
+        return white_pieces.accumulator + black_pieces.accumulator + self.weights['b1']
+
+    def get_output(self, own_accumulators: np.ndarray, other_accumulators: np.ndarray) -> np.ndarray:
+        hidden = np.clip(np.concatenate([own_accumulators, other_accumulators], axis=-1), 0, 1)
+        hidden = np.clip(hidden @ self.weights['w2'] + self.weights['b2'], 0, 1)
+        return hidden @ self.weights['w3'] + self.weights['b3']
+
+    def __call__(self, position: Position, lower_bound: float = None, upper_bound: float = None) -> Dict[str, float]:
+        """
+        The bounds are accepted for use with lazy leaf evaluation, and not needed.
+        """
+        accumulators = self.get_accumulators(position)
+        own_row = PERSPECTIVES.index(opposite_color(position.to_move()))
+        return {'eval': float(self.get_output(accumulators[own_row], accumulators[1 - own_row]))}
+
+    def evaluate_many(self, positions: Sequence[Position]) -> List[Dict[str, float]]:
+        """
+        Same as calling it on each position, with the dense layers run once for all of them.
+        """
+        if not positions:
+            return []
+        accumulators = np.stack([self.get_accumulators(position) for position in positions])
+        own_rows = np.array([PERSPECTIVES.index(opposite_color(position.to_move())) for position in positions])
+        indices = np.arange(len(positions))
+        scores = self.get_output(accumulators[indices, own_rows], accumulators[indices, 1 - own_rows])
+        return [{'eval': float(score)} for score in scores]
+
+    def get_threat(self, position: Position) -> float:
+        return self.threat_func(position)
@@ -0,0 +1,230 @@
+from concurrent.futures import Executor, wait
+from typing import Callable, Dict, List, Tuple, Union
+
+from classes.position import Position
+from simple_bot.move_search import select_top_n_moves, choose_best_move_recursive, converge, aggregator, \
+    select_n_random_mpe, SearchAborted, pick_best_candidate
+from simple_bot.transposition_table import SharedTranspositionTable, SharedStopFlag
+
+STOP_POLL_INTERVAL = 0.05  # SECONDS BETWEEN CHECKS OF should_stop WHILE WAITING FOR WORKER PROCESSES
+
+
+def search_root_subtree(position: Position, evaluation_func: Callable[[Position], Dict[str, float]],
+                        stop_flag: SharedStopFlag = None, **kwargs) -> Union[Tuple[str, float], None]:
+    """
+    Task body for one root move of choose_best_move_recursive_parallel. Runs choose_best_move_recursive, polling
+    stop_flag at every node.
+    :param kwargs: passed on to choose_best_move_recursive.
+    :return: its (uci, score), or None if stop_flag was set before it finished.
+    """
+    try:
+        return choose_best_move_recursive(position=position, evaluation_func=evaluation_func,
+                                          should_stop=stop_flag.stop_requested if stop_flag is not None else None,
+                                          **kwargs)
+    except SearchAborted:
+        return None
+
+
+def choose_best_move_recursive_parallel(position: Position, evaluation_func: Callable[[Position], Dict[str, float]],
+                                        executor: Executor, breadth: int = 3, aggression: int = 1,
+                                        fluctuation: float = 0, assumed_opp_aggression: int = 1,
+                                        ply_depth: int = 4, should_stop: Callable[[], bool] = None,
+                                        stop_flag: SharedStopFlag = None,
+                                        prescreen_factor: int = None) -> Tuple[str, float]:
+    """
+    Same search as choose_best_move_recursive, but the subtree under each candidate root move is searched in its own
+    task on the executor. With fluctuation=0, returns the same move and score as the serial search.
+    If should_stop returns True before all subtrees are searched, returns the best of the finished root moves (or the
+    best candidate by static evaluation if none finished). Queued subtrees are cancelled. With a stop_flag, running
+    subtrees are told to stop through it and waited for, so that they do not hold up the executor's next search;
+    without one they run on in the background.
+    :param position:
+    :param evaluation_func: must be picklable (e.g. a module-level function) when using a ProcessPoolExecutor.
+    :param executor:
+    :param breadth:
+    :param aggression:
+    :param fluctuation:
+    :param assumed_opp_aggression:
+    :param ply_depth:
+    :param should_stop:
+    :param stop_flag: shared with the worker processes. Must be clear when the search starts.
+    :param prescreen_factor:
+    :return:
+    """
+    if ply_depth <= 1:
+        return choose_best_move_recursive(position=position, evaluation_func=evaluation_func, breadth=breadth,
+                                          aggression=aggression, fluctuation=fluctuation,
+                                          assumed_opp_aggression=assumed_opp_aggression, ply_depth=ply_depth,
+                                          prescreen_factor=prescreen_factor)
+    all_mpe = select_top_n_moves(position=position, evaluate=evaluation_func, n=breadth, pick_n_threatening=aggression,
+                                 fluctuation=fluctuation, prescreen_factor=prescreen_factor)
+    if len(all_mpe['all']) == 0:
+        if position.is_under_check(position.to_move()):
+            return '0000', -9999
+        else:
+            return '0000', 0
+    if len(all_mpe['all']) == 1:
+        return all_mpe['all'][0][0].generate_uci(), all_mpe['all'][0][2]
+
+    candidate_mpes = all_mpe['top']
+    futures = [executor.submit(search_root_subtree, position=mpe[1], evaluation_func=evaluation_func,
+                               stop_flag=stop_flag, breadth=breadth, aggression=assumed_opp_aggression,
+                               fluctuation=fluctuation, assumed_opp_aggression=aggression, ply_depth=ply_depth - 1,
+                               prescreen_factor=prescreen_factor)
+               for mpe in candidate_mpes]
+    if should_stop is None:
+        wait(futures)
+    else:
+        while wait(futures, timeout=STOP_POLL_INTERVAL).not_done:
+            if should_stop():
+                for future in futures:
+                    future.cancel()
+                if stop_flag is not None:
+                    stop_flag.request_stop()
+                    wait(futures)
+                    stop_flag.clear_stop()
+                break
+    candidates = [(candidate_mpes[i][0].generate_uci(), -1 * futures[i].result()[1])
+                  for i in range(len(candidate_mpes))
+                  if futures[i].done() and not futures[i].cancelled() and futures[i].result() is not None]
+    if not candidates:
+        static_best_mpe = max(candidate_mpes, key=lambda x: x[2])
+        return static_best_mpe[0].generate_uci(), static_best_mpe[2]
+    return pick_best_candidate(candidates)
+
+
+def converge_parallel(mpe_list, evaluation_func, executor: Executor, breadth: int = 3, aggression: int = 1,
+                      fluctuation: float = 0, assumed_opp_aggression: int = 0, tree_ply_depth: int = 4,
+                      prescreen_factor: int = None) -> List[Tuple[str, float]]:
+    """
+    Submits one converge task per root move. The trees under the root moves never interact, so converging each one
+    separately gives the same root scores as converging them together.
+    :return: the futures, in the same order as mpe_list.
+    """
+    return [executor.submit(converge, mpe_list=[mpe], evaluation_func=evaluation_func, breadth=breadth,
+                            aggression=aggression, fluctuation=fluctuation,
+                            assumed_opp_aggression=assumed_opp_aggression, tree_ply_depth=tree_ply_depth,
+                            aggregator=aggregator, prescreen_factor=prescreen_factor)
+            for mpe in mpe_list]
+
+
+def choose_best_move_parallel(position: Position, evaluate: Callable[[Position], Dict[str, float]],
+                              executor: Executor, breadth: int = 3, aggression: int = 1, fluctuation: float = 0,
+                              assumed_opp_aggression: int = 1, ply_depth: int = 4, prescreen_factor: int = None) -> str:
+    """
+    Same search as choose_best_move, with the move trees of both converge runs built and collapsed on the executor.
+    The random second batch of root moves is still drawn in this process.
+    :return: a UCI notation e.g. 'd1h5'
+    """
+    initial_score = -evaluate(position)['eval']
+    all_mpe_and_top = select_top_n_moves(position=position, evaluate=evaluate, n=breadth,
+                                         pick_n_threatening=aggression, fluctuation=fluctuation,
+                                         prescreen_factor=prescreen_factor)
+    all_mpe = all_mpe_and_top['all']
+    if len(all_mpe) == 1:
+        return all_mpe[0][0].generate_uci()
+    top_mpe = all_mpe_and_top['top']
+    uci_mpe_dict = {}
+    for mpe in all_mpe:
+        uci_mpe_dict[mpe[0].generate_uci()] = mpe
+    for mpe in top_mpe:
+        uci_mpe_dict.pop(mpe[0].generate_uci())
+    run1_futures = converge_parallel(mpe_list=top_mpe, evaluation_func=evaluate, executor=executor, breadth=breadth,
+                                     aggression=aggression, fluctuation=fluctuation,
+                                     assumed_opp_aggression=assumed_opp_aggression, tree_ply_depth=ply_depth,
+                                     prescreen_factor=prescreen_factor)
+    next_n_mpe = select_n_random_mpe(breadth=breadth, evaluate=evaluate, initial_score=initial_score,
+                                     uci_mpe_dict=uci_mpe_dict)
+    run2_futures = converge_parallel(mpe_list=next_n_mpe, evaluation_func=evaluate, executor=executor,
+                                     breadth=breadth, aggression=aggression, fluctuation=fluctuation,
+                                     assumed_opp_aggression=assumed_opp_aggression, tree_ply_depth=ply_depth,
+                                     prescreen_factor=prescreen_factor)
+    best_move, best_score = pick_best_candidate([future.result() for future in run1_futures])
+    if not run2_futures:
+        return best_move
+    run2_best_move, run2_best_score = pick_best_candidate([future.result() for future in run2_futures])
+    candidates = [(best_move, best_score), (run2_best_move, run2_best_score)]
+    candidates.sort(key=lambda x: x[1], reverse=True)
+    return candidates[0][0]
+
+
+def lazy_smp_worker(position: Position, evaluation_func: Callable[[Position], Dict[str, float]],
+                    transposition_table: SharedTranspositionTable, worker_index: int, max_depth: int,
+                    breadth: int = 3, aggression: int = 1, fluctuation: float = 0,
+                    assumed_opp_aggression: int = 1, prescreen_factor: int = None) -> Union[Tuple[str, float], None]:
+    """
+    One Lazy SMP search process. Deepens iteratively from 1 ply to max_depth, starting the root moves at a different
+    candidate for every worker so that the workers fill the shared table with different subtrees first.
+    Scores are still compared in the original candidate order, so ties go to the same move in every worker.
+    :return: the (uci, score) of the deepest completed iteration. None if there are no legal moves.
+    """
+    all_mpe = select_top_n_moves(position=position, evaluate=evaluation_func, n=breadth, pick_n_threatening=aggression,
+                                 fluctuation=fluctuation, prescreen_factor=prescreen_factor)
+    if len(all_mpe['all']) == 0:
+        return None
+    if len(all_mpe['all']) == 1 or max_depth == 1:
+        return all_mpe['all'][0][0].generate_uci(), all_mpe['all'][0][2]
+    candidate_mpes = all_mpe['top']
+    start = worker_index % len(candidate_mpes)
+    search_order = candidate_mpes[start:] + candidate_mpes[:start]
+    result = all_mpe['all'][0][0].generate_uci(), all_mpe['all'][0][2]
+    try:
+        for depth in range(2, max_depth + 1):
+            uci_score_dict: Dict[str, float] = {}
+            for mpe in search_order:
+                uci_score_dict[mpe[0].generate_uci()] = -1 * \
+                    choose_best_move_recursive(position=mpe[1], evaluation_func=evaluation_func, breadth=breadth,
+                                               aggression=assumed_opp_aggression, fluctuation=fluctuation,
+                                               assumed_opp_aggression=aggression, ply_depth=depth - 1,
+                                               transposition_table=transposition_table,
+                                               should_stop=transposition_table.stop_requested,
+                                               prescreen_factor=prescreen_factor)[1]
+            result = pick_best_candidate([(mpe[0].generate_uci(), uci_score_dict[mpe[0].generate_uci()])
+                                          for mpe in candidate_mpes])
+            transposition_table.store(position.get_hash(), depth, result[1], result[0])
+    except SearchAborted:
+        pass
+    return result
+
+
+def choose_best_move_lazy_smp(position: Position, evaluation_func: Callable[[Position], Dict[str, float]],
+                              executor: Executor, transposition_table: SharedTranspositionTable, workers: int,
+                              breadth: int = 3, aggression: int = 1, fluctuation: float = 0,
+                              assumed_opp_aggression: int = 1, ply_depth: int = 4,
+                              should_stop: Callable[[], bool] = None,
+                              prescreen_factor: int = None) -> Tuple[str, float]:
+    """
+    Lazy SMP: every worker searches the same root, sharing one transposition table. Odd-numbered helpers search one
+    ply deeper than the main worker. The move of the main worker (index 0) is played. Once it finishes, the helpers
+    are told to stop through the table's stop flag.
+    If should_stop returns True first, all workers are stopped and the main worker's deepest completed iteration is
+    used.
+    :return:
+    """
+    all_mpe = select_top_n_moves(position=position, evaluate=evaluation_func, n=breadth, pick_n_threatening=aggression,
+                                 fluctuation=fluctuation, prescreen_factor=prescreen_factor)
+    if len(all_mpe['all']) == 0:
+        if position.is_under_check(position.to_move()):
+            return '0000', -9999
+        else:
+            return '0000', 0
+    if len(all_mpe['all']) == 1 or ply_depth <= 1:
+        return all_mpe['all'][0][0].generate_uci(), all_mpe['all'][0][2]
+    transposition_table.clear_stop()
+    futures = [executor.submit(lazy_smp_worker, position=position, evaluation_func=evaluation_func,
+                               transposition_table=transposition_table, worker_index=i,
+                               max_depth=ply_depth + (i % 2), breadth=breadth, aggression=aggression,
+                               fluctuation=fluctuation, assumed_opp_aggression=assumed_opp_aggression,
+                               prescreen_factor=prescreen_factor)
+               for i in range(workers)]
+    if should_stop is not None:
+        while wait(futures[:1], timeout=STOP_POLL_INTERVAL).not_done:
+            if should_stop():
+                transposition_table.request_stop()
+                break
+    best_move, best_score = futures[0].result()
+    transposition_table.request_stop()
+    for future in futures[1:]:
+        future.result()
+    transposition_table.clear_stop()
+    return best_move, best_score
@@ -0,0 +1,157 @@
+import argparse
+import random
+import time
+from typing import Dict, List
+from classes.attack_map import AttackMap
+from classes.move import LegalMove
+from classes.position import Position, generate_starting_position, opposite_color
+from simple_bot.bot1.evaluation import evaluate_exchange_on_square, quick_evaluate
+from utils.board_functions import SQUARE_SCOPES_MAP, INT_SQUARES_MAP, PIECE_MOVE_TYPE_DICT
+from utils.piece_square_tables import MATERIAL_VALUES, PAWN_ATTACKED_SQUARES, PAWN_CONTROL_MILLIS
+
+PIECE_VALUES = {'K': 10} | MATERIAL_VALUES
+CHECK_SCORE = 1  # FOR A MOVE GIVING CHECK
+SCOPE_SQUARE_SCORE = 0.02  # FOR EACH SQUARE MORE (OR LESS) THE MOVED PIECE COVERS FROM ITS NEW SQUARE ON AN EMPTY BOARD
+
+
+def move_gives_check(move: LegalMove, attack_map: AttackMap) -> bool:
+    """
+    Whether move gives check, directly or by uncovering a slider, read off the attack map of the position before the
+    move. Checks by the rook of a castling move or uncovered by an en passant capture are missed.
+    """
+    color = move.get_color()
+    king_sq = attack_map.king_squares[opposite_color(color)]
+    origin_sq, destination_sq = move.origin_square, move.destination_square
+    piece = move.promotion_piece if move.pawn_promotion_required() else move.piece_moved
+    if piece == 'P':
+        if king_sq in PAWN_ATTACKED_SQUARES[color][destination_sq]:
+            return True
+    elif piece == 'N':
+        if king_sq in SQUARE_SCOPES_MAP[destination_sq]['N']:
+            return True
+    elif piece != 'K':
+        for move_type in PIECE_MOVE_TYPE_DICT[piece]:
+            if king_sq in SQUARE_SCOPES_MAP[destination_sq][move_type]:
+                map_key = f'{destination_sq}{king_sq}'
+                intervening_squares = INT_SQUARES_MAP[map_key]['int'] if map_key in INT_SQUARES_MAP else []
+                if all([int_sq == origin_sq or int_sq not in attack_map.square_piece_dict
+                        for int_sq in intervening_squares]):
+                    return True
+    uncovered_slider = attack_map.get_x_ray_attacker(origin_sq, king_sq, color)
+    if uncovered_slider is not None:
+        return destination_sq not in INT_SQUARES_MAP[f'{uncovered_slider[1:]}{king_sq}']['int']
+    return False
+
+
+def score_move_cheaply(position: Position, move: LegalMove) -> float:
+    """
+    A rough score of move for its side, without making it: the material won by the exchange it starts (or lost by
+    leaving the moved piece where it can be taken), promotion, check, and the change in the squares the moved piece
+    covers on an empty board (pawn control for a pawn).
+    """
+    attack_map = position.get_attack_map()
+    color = move.get_color()
+    origin_sq, destination_sq = move.origin_square, move.destination_square
+    score = 0
+    if move.is_capture():
+        score += evaluate_exchange_on_square(position, destination_sq, move)
+    elif move.piece_moved != 'K' and destination_sq in attack_map.square_attackers[opposite_color(color)]:
+        moved_piece_worth = PIECE_VALUES[move.piece_moved]
+        lightest_attacker_worth = min([PIECE_VALUES[pns[0]] for pns in
+                                       attack_map.square_attackers[opposite_color(color)][destination_sq]])
+        defenders = [pns for pns in attack_map.square_attackers[color].get(destination_sq, [])
+                     if pns[1:] != origin_sq]
+        score -= moved_piece_worth if not defenders else max(0, moved_piece_worth - lightest_attacker_worth)
+    if move.pawn_promotion_required():
+        score += MATERIAL_VALUES[move.promotion_piece] - MATERIAL_VALUES['P']
+    if move_gives_check(move, attack_map):
+        score += CHECK_SCORE
+    if move.piece_moved == 'P':
+        pawn_control_millis = PAWN_CONTROL_MILLIS[color]
+        score += (sum([pawn_control_millis[sq] for sq in PAWN_ATTACKED_SQUARES[color][destination_sq]]) -
+                  sum([pawn_control_millis[sq] for sq in PAWN_ATTACKED_SQUARES[color][origin_sq]])) / 1000
+    elif move.piece_moved != 'K':
+        scope_change = 0
+        for move_type in PIECE_MOVE_TYPE_DICT[move.piece_moved]:
+            scope_change += len(SQUARE_SCOPES_MAP[destination_sq][move_type]) - \
+                len(SQUARE_SCOPES_MAP[origin_sq][move_type])
+        score += scope_change * SCOPE_SQUARE_SCORE
+    return score
+
+
+def prescreen_moves(position: Position, moves: List[LegalMove], n_kept: int) -> List[LegalMove]:
+    """
+    :return: the n_kept moves with the best score_move_cheaply, in the order they were given.
+    """
+    if len(moves) <= n_kept:
+        return moves
+    cheap_scores = [score_move_cheaply(position, move) for move in moves]
+    kept_indices = sorted(sorted(range(len(moves)), key=lambda i: cheap_scores[i], reverse=True)[:n_kept])
+    return [moves[i] for i in kept_indices]
+
+
+def generate_benchmark_positions(n_positions: int, seed: int = 0, max_plies: int = 80) -> List[Position]:
+    """
+    Positions from random games, one taken every few plies.
+    """
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < n_positions:
+        position = generate_starting_position()
+        for ply in range(max_plies):
+            moves = position.get_all_legal_moves_for_side_to_move()
+            if not moves:
+                break
+            position.process_legal_move(rng.choice(moves), generate_notation=False)
+            if ply % 7 == 6 and len(positions) < n_positions:
+                positions.append(position.copy())
+    return positions
+
+
+def benchmark_prescreen(positions: List[Position], factors: List[int], breadth: int = 3, aggression: int = 1,
+                        evaluate=quick_evaluate) -> Dict[int, Dict[str, float]]:
+    """
+    Runs select_top_n_moves with each prescreen factor (None for no pre-screen) on positions.
+    :return: {factor: {'seconds': time taken, 'best_kept': share of positions where the best move by full evaluation
+    is still chosen as best, 'top_kept': share of the moves selected without pre-screen that are still selected}}
+    """
+    from simple_bot.move_search import select_top_n_moves
+    results = {}
+    reference = None
+    for factor in [None] + [factor for factor in factors if factor is not None]:
+        start = time.perf_counter()
+        selections = [select_top_n_moves(position.copy(), evaluate, n=breadth, pick_n_threatening=aggression,
+                                         prescreen_factor=factor) for position in positions]
+        seconds = time.perf_counter() - start
+        # 'all' IS LEFT UNSORTED WHEN THERE ARE NO MORE THAN breadth MOVES
+        best_moves = [max(selection['all'], key=lambda mpe: mpe[2])[0].generate_uci() if selection['all'] else None
+                      for selection in selections]
+        top_moves = [{mpe[0].generate_uci() for mpe in selection['top']} for selection in selections]
+        if reference is None:
+            reference = (best_moves, top_moves)
+        n_top = sum([len(top) for top in reference[1]])
+        results[factor] = {'seconds': seconds,
+                           'best_kept': sum([best == reference_best for best, reference_best
+                                             in zip(best_moves, reference[0])]) / len(positions),
+                           'top_kept': sum([len(top & reference_top) for top, reference_top
+                                            in zip(top_moves, reference[1])]) / n_top if n_top else 1.0}
+    return results
+
+
+if __name__ == '__main__':
+    # e.g. python -m simple_bot.prescreen --positions 300 --factors 1 2 3 4
+    parser = argparse.ArgumentParser(description='Speed and quality of select_top_n_moves with a pre-screen.')
+    parser.add_argument('--positions', type=int, default=200, help='positions from random games to test on.')
+    parser.add_argument('--factors', type=int, nargs='+', default=[1, 2, 3, 4],
+                        help='prescreen factors to try. Each keeps factor * breadth moves.')
+    parser.add_argument('--breadth', type=int, default=3)
+    parser.add_argument('--aggression', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+    benchmark_positions = generate_benchmark_positions(arguments.positions, seed=arguments.seed)
+    benchmark = benchmark_prescreen(benchmark_positions, arguments.factors, breadth=arguments.breadth,
+                                    aggression=arguments.aggression)
+    print('factor  seconds  best kept  top kept')
+    for prescreen_factor, result in benchmark.items():
+        print(f'{str(prescreen_factor):>6}  {result["seconds"]:7.2f}  {result["best_kept"]:9.1%}  '
+              f'{result["top_kept"]:8.1%}')
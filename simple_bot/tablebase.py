@@ -0,0 +1,459 @@
+import mmap
+import sys
+from array import array
+from os import path
+from typing import Dict, List, Set, Tuple, Union
+from classes.color_position import ColorPosition
+from classes.position import Position, opposite_color
+from simple_bot.utils import branch_from_position
+from utils.board_functions import SQUARE_TO_INDEX, INDEX_TO_SQUARE
+
+TABLEBASE_FILE_EXTENSION = '.tb'
+PIECE_ORDER = 'KQRBNP'
+MAX_STORED_PLIES = 254
+
+# ONE BYTE PER POSITION. 0 IS A DRAW (OR AN ILLEGAL POSITION, OR AN ENTRY NEVER USED). ANY OTHER VALUE v MEANS MATE
+# IN v - 1 PLIES: ODD PLIES ARE A WIN FOR THE SIDE TO MOVE, EVEN PLIES A LOSS (1 MEANS THE SIDE TO MOVE IS MATED
+# ALREADY).
+DRAW = 0
+
+
+def encode_plies(plies: int) -> int:
+    return min(plies, MAX_STORED_PLIES) + 1
+
+
+def decode_value(value: int) -> Tuple[str, int]:
+    """
+    :param value: a byte from a table.
+    :return: ('win', plies to mate), ('loss', plies to mate) or ('draw', 0), for the side to move.
+    """
+    if value == DRAW:
+        return 'draw', 0
+    plies = value - 1
+    return ('win' if plies % 2 else 'loss'), plies
+
+
+def split_material(material: str) -> Tuple[str, str]:
+    """
+    :param material: white's pieces then black's, each starting with the king, e.g. 'KRK' or 'KRKP'.
+    :return: e.g. ('KR', 'KP')
+    """
+    if not material.startswith('K') or material.count('K') != 2 or \
+            any(piece not in PIECE_ORDER for piece in material):
+        raise ValueError(f'Invalid material: {material}. Give white\'s pieces then black\'s, each starting with K, '
+                         f'e.g. KRK or KQKR.')
+    second_king = material.index('K', 1)
+    return material[:second_king], material[second_king:]
+
+
+def sort_side_pieces(pieces: str) -> str:
+    return ''.join(sorted(pieces, key=PIECE_ORDER.index))
+
+
+def is_insufficient_material(white_pieces: str, black_pieces: str) -> bool:
+    """
+    Only kings, or kings and a single knight or bishop.
+    """
+    non_king_pieces = white_pieces[1:] + black_pieces[1:]
+    return len(non_king_pieces) == 0 or (len(non_king_pieces) == 1 and non_king_pieces in 'BN')
+
+
+def get_side_piece_string(color_position: ColorPosition) -> str:
+    return sort_side_pieces(''.join(piece * len(color_position.get_piece_type_squares(piece))
+                                    for piece in PIECE_ORDER))
+
+
+def get_piece_slot_squares(color_position: ColorPosition, pieces: str) -> List[int]:
+    """
+    :return: square index of each piece in pieces, in order. Pieces of the same type are taken in square order.
+    """
+    squares = []
+    for piece in dict.fromkeys(pieces):
+        squares.extend(sorted(SQUARE_TO_INDEX[square] for square in color_position.get_piece_type_squares(piece)))
+    return squares
+
+
+KING_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+KNIGHT_OFFSETS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)]
+SLIDING_DIRECTIONS = {'R': [(-1, 0), (1, 0), (0, -1), (0, 1)], 'B': [(-1, -1), (-1, 1), (1, -1), (1, 1)]}
+SLIDING_DIRECTIONS['Q'] = SLIDING_DIRECTIONS['R'] + SLIDING_DIRECTIONS['B']
+
+# SQUARE MAPS OF THE BOARD SYMMETRIES. WITH PAWNS ONLY THE MIRROR BETWEEN THE A- AND H-FILES KEEPS THE RULES THE SAME.
+PAWN_SYMMETRIES = [list(range(64)), [square ^ 7 for square in range(64)]]
+PAWNLESS_SYMMETRIES = [[square ^ flip for square in range(64)] for flip in (0, 7, 56, 63)]
+PAWNLESS_SYMMETRIES += [[((symmetry[square] & 7) << 3) | (symmetry[square] >> 3) for square in range(64)]
+                        for symmetry in PAWNLESS_SYMMETRIES]
+
+
+def kings_touch(square1: int, square2: int) -> bool:
+    return abs((square1 & 7) - (square2 & 7)) <= 1 and abs((square1 >> 3) - (square2 >> 3)) <= 1
+
+
+class TablebaseIndex:
+    """
+    Numbers the positions of one material set. Index = side to move (0 for white, 1 for black), then the king pair,
+    then the square of every other piece in the order of the material string, as digits of a mixed-radix number.
+    Pawns never stand on the first or last rank, so their squares are counted from a2 and take 48 values, others 64.
+
+    Positions that are the same up to a symmetry of the board share one index: any of the 8 rotations and reflections
+    without pawns, the mirror between the a- and h-files with pawns. Only king pairs with white's king in a1-d1-d4
+    (on the a- to d-files with pawns) are numbered, and none with the kings next to each other. Where that leaves a
+    position more than one way to write it (e.g. both kings on the a1-h8 diagonal), the smallest index is used and
+    the others are never read.
+    """
+
+    def __init__(self, material: str):
+        white_pieces, black_pieces = split_material(material)
+        self.pieces = [('w', piece) for piece in white_pieces] + [('b', piece) for piece in black_pieces]
+        self.black_king_slot = len(white_pieces)
+        self.symmetries = PAWN_SYMMETRIES if 'P' in material else PAWNLESS_SYMMETRIES
+        self.king_pairs = []
+        for white_king in range(64):
+            file, rank = white_king & 7, white_king >> 3
+            if file > 3 or (len(self.symmetries) == 8 and rank > file):
+                continue
+            for black_king in range(64):
+                if kings_touch(white_king, black_king):
+                    continue
+                if len(self.symmetries) == 8 and rank == file and (black_king >> 3) > (black_king & 7):
+                    continue
+                self.king_pairs.append((white_king, black_king))
+        self.king_pair_indices = {king_pair: i for i, king_pair in enumerate(self.king_pairs)}
+        # (SLOT, NUMBER OF SQUARES, FIRST SQUARE) OF EVERY PIECE OTHER THAN THE KINGS
+        self.other_slots = [(slot, 48, 8) if piece == 'P' else (slot, 64, 0)
+                            for slot, (_, piece) in enumerate(self.pieces) if piece != 'K']
+        # SLOTS OF PIECES OF THE SAME COLOR AND TYPE, WHICH ARE INTERCHANGEABLE
+        self.same_piece_slots = [[slot for slot in range(len(self.pieces)) if self.pieces[slot] == colored_piece]
+                                 for colored_piece in dict.fromkeys(self.pieces)
+                                 if self.pieces.count(colored_piece) > 1]
+        self.n_positions = 2 * len(self.king_pairs)
+        for _, n_squares, _ in self.other_slots:
+            self.n_positions *= n_squares
+
+    def squares_to_index(self, side_to_move: str, squares: List[int]) -> Union[int, None]:
+        """
+        :param side_to_move:
+        :param squares: square index of every piece, in the order of the material string.
+        :return: None if the kings touch.
+        """
+        best_index = None
+        for symmetry in self.symmetries:
+            king_pair = self.king_pair_indices.get((symmetry[squares[0]], symmetry[squares[self.black_king_slot]]))
+            if king_pair is None:
+                continue
+            mapped_squares = [symmetry[square] for square in squares]
+            for slots in self.same_piece_slots:
+                for slot, square in zip(slots, sorted(mapped_squares[slot] for slot in slots)):
+                    mapped_squares[slot] = square
+            index = (1 if side_to_move == 'b' else 0) * len(self.king_pairs) + king_pair
+            for slot, n_squares, first_square in self.other_slots:
+                index = index * n_squares + mapped_squares[slot] - first_square
+            if best_index is None or index < best_index:
+                best_index = index
+        return best_index
+
+    def index_to_squares(self, index: int) -> Tuple[str, List[int]]:
+        squares = [0] * len(self.pieces)
+        for slot, n_squares, first_square in reversed(self.other_slots):
+            squares[slot] = index % n_squares + first_square
+            index //= n_squares
+        squares[0], squares[self.black_king_slot] = self.king_pairs[index % len(self.king_pairs)]
+        return ('b' if index // len(self.king_pairs) else 'w'), squares
+
+
+class Tablebase:
+    """
+    The table for one material set, memory-mapped from its file. Entry i is the value of the position numbered i by
+    TablebaseIndex.
+    """
+
+    def __init__(self, file_path: str, material: str):
+        self.material = material
+        self.index = TablebaseIndex(material)
+        with open(file_path, 'rb') as readfile:
+            self.table = mmap.mmap(readfile.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.table) != self.index.n_positions:
+            self.table.close()
+            raise ValueError(f'{file_path} is not a {material} tablebase.')
+
+    def close(self) -> None:
+        self.table.close()
+
+    def probe_squares(self, side_to_move: str, squares: List[int]) -> int:
+        return self.table[self.index.squares_to_index(side_to_move, squares)]
+
+
+class Tablebases:
+    """
+    All the tables in a directory, each in a file named after its material, e.g. KRK.tb. Files are opened the first
+    time they are needed. A table for white's material also answers the same material with colors reversed.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.tablebases: Dict[str, Union[Tablebase, None]] = {}
+
+    def get_tablebase(self, material: str) -> Union[Tablebase, None]:
+        if material not in self.tablebases:
+            file_path = path.join(self.directory, material + TABLEBASE_FILE_EXTENSION)
+            self.tablebases[material] = Tablebase(file_path, material) if path.isfile(file_path) else None
+        return self.tablebases[material]
+
+    def close(self) -> None:
+        for tablebase in self.tablebases.values():
+            if tablebase is not None:
+                tablebase.close()
+        self.tablebases = {}
+
+    def probe(self, position: Position) -> Union[int, None]:
+        """
+        En passant is not covered by the tables and is ignored. Positions with castling rights are not probed.
+        :param position:
+        :return: the stored value (see decode_value), or None if there is no table for the material.
+        """
+        if position.get_castling_rights() != '-':
+            return None
+        white_pieces = get_side_piece_string(position.white_pieces)
+        black_pieces = get_side_piece_string(position.black_pieces)
+        if is_insufficient_material(white_pieces, black_pieces):
+            return DRAW
+        tablebase = self.get_tablebase(white_pieces + black_pieces)
+        if tablebase is not None:
+            squares = get_piece_slot_squares(position.white_pieces, white_pieces) + \
+                get_piece_slot_squares(position.black_pieces, black_pieces)
+            return tablebase.probe_squares(position.to_move(), squares)
+        tablebase = self.get_tablebase(black_pieces + white_pieces)
+        if tablebase is not None:
+            # SAME MATERIAL WITH THE COLORS REVERSED: SWAP THE COLORS AND MIRROR THE BOARD TOP TO BOTTOM
+            squares = get_piece_slot_squares(position.black_pieces, black_pieces) + \
+                get_piece_slot_squares(position.white_pieces, white_pieces)
+            return tablebase.probe_squares(opposite_color(position.to_move()), [square ^ 56 for square in squares])
+        return None
+
+    def choose_move(self, position: Position) -> str:
+        """
+        Perfect play from the tables: the fastest mate when winning, a drawing move when drawn, and the slowest mate
+        when losing.
+        :param position:
+        :return: a UCI move, or '0000' if the position or one of its successors is not covered by the tables.
+        """
+        if self.probe(position) is None:
+            return '0000'
+        best_move = '0000'
+        best_key = None
+        for move in position.get_all_legal_moves_for_side_to_move():
+            value = self.probe(branch_from_position(position, move))
+            if value is None:
+                return '0000'
+            result, plies = decode_value(value)
+            # RESULT FOR THE OPPONENT, WHO IS TO MOVE AFTER THIS MOVE
+            if result == 'loss':
+                key = (2, -plies)
+            elif result == 'draw':
+                key = (1, 0)
+            else:
+                key = (0, plies)
+            if best_key is None or key > best_key:
+                best_key = key
+                best_move = move.generate_uci()
+        return best_move
+
+
+def create_position_from_squares(white_pieces: str, black_pieces: str, side_to_move: str,
+                                 squares: List[int]) -> Union[Position, None]:
+    """
+    :return: the position, or None if it is illegal: two pieces on one square, a pawn on the first or last rank, or
+    the side not to move in check.
+    """
+    if len(set(squares)) != len(squares):
+        return None
+    piece_squares = {'w': {}, 'b': {}}
+    pieces = [('w', piece) for piece in white_pieces] + [('b', piece) for piece in black_pieces]
+    for (color, piece), square in zip(pieces, squares):
+        if piece == 'P' and square // 8 in (0, 7):
+            return None
+        piece_squares[color].setdefault(piece, []).append(INDEX_TO_SQUARE[square])
+    position = Position(white_pieces=ColorPosition('w', piece_squares['w'], False, False),
+                        black_pieces=ColorPosition('b', piece_squares['b'], False, False),
+                        side_to_move=side_to_move)
+    if position.is_under_check(opposite_color(side_to_move)):
+        return None
+    return position
+
+
+def get_unmove_origin_squares(color: str, piece: str, square: int, occupied_squares: Set[int]) -> List[int]:
+    """
+    The squares piece could have come from to square without capturing or promoting. Castling and en passant are not
+    covered by the tables and are left out.
+    :param color:
+    :param piece: e.g. 'R'
+    :param square:
+    :param occupied_squares: squares of all the pieces, including the piece itself.
+    :return:
+    """
+    file, rank = square & 7, square >> 3
+    if piece == 'P':
+        step = -8 if color == 'w' else 8
+        if square + step in occupied_squares or not 1 <= (square + step) >> 3 <= 6:
+            return []
+        origin_squares = [square + step]
+        if rank == (3 if color == 'w' else 4) and square + 2 * step not in occupied_squares:
+            origin_squares.append(square + 2 * step)
+        return origin_squares
+    origin_squares = []
+    if piece in 'KN':
+        for file_step, rank_step in (KING_OFFSETS if piece == 'K' else KNIGHT_OFFSETS):
+            origin_file, origin_rank = file + file_step, rank + rank_step
+            if 0 <= origin_file < 8 and 0 <= origin_rank < 8 and origin_rank * 8 + origin_file not in occupied_squares:
+                origin_squares.append(origin_rank * 8 + origin_file)
+        return origin_squares
+    for file_step, rank_step in SLIDING_DIRECTIONS[piece]:
+        origin_file, origin_rank = file + file_step, rank + rank_step
+        while 0 <= origin_file < 8 and 0 <= origin_rank < 8 and origin_rank * 8 + origin_file not in occupied_squares:
+            origin_squares.append(origin_rank * 8 + origin_file)
+            origin_file, origin_rank = origin_file + file_step, origin_rank + rank_step
+    return origin_squares
+
+
+def get_predecessor_indices(index: TablebaseIndex, side_to_move: str, squares: List[int]) -> Set[int]:
+    """
+    :return: indices of the positions with the same material that lead here by one move, some of which may be
+    illegal.
+    """
+    moved_color = opposite_color(side_to_move)
+    occupied_squares = set(squares)
+    predecessor_indices = set()
+    for slot, (color, piece) in enumerate(index.pieces):
+        if color != moved_color:
+            continue
+        for origin_square in get_unmove_origin_squares(color, piece, squares[slot], occupied_squares):
+            predecessor_squares = list(squares)
+            predecessor_squares[slot] = origin_square
+            predecessor_index = index.squares_to_index(moved_color, predecessor_squares)
+            if predecessor_index is not None:
+                predecessor_indices.add(predecessor_index)
+    return predecessor_indices
+
+
+def generate_tablebase(material: str, directory: str, tablebases: Tablebases = None, verbose: bool = False) -> str:
+    """
+    Builds the table for one material set by retrograde analysis and writes it to directory.
+
+    Every legal position is generated with the project's own move generator, once per TablebaseIndex entry. Moves that
+    change the material (captures and promotions) are scored from the smaller tables, which must already be in
+    directory, except for endings with insufficient material. For the other moves only the number of different
+    entries they lead to is kept.
+    Values are then resolved ply by ply from the mates backwards. The entries leading to a resolved position are found
+    by taking back moves, so no move graph is stored. A position is lost once every move leads to a win for the
+    opponent, so moves to a draw keep it from ever being resolved.
+    :param material: e.g. 'KRK'
+    :param directory:
+    :param tablebases: the smaller tables. Opened from directory if None.
+    :param verbose: print progress.
+    :return: path of the written file.
+    """
+    white_pieces, black_pieces = split_material(material)
+    if not 3 <= len(material) <= 4:
+        raise ValueError('Only 3- and 4-piece tables are supported.')
+    if tablebases is None:
+        tablebases = Tablebases(directory)
+    index = TablebaseIndex(material)
+    n_positions = index.n_positions
+
+    # LEGAL ENTRIES, MATES AND WHAT IS ALREADY KNOWN FROM MOVES THAT CHANGE THE MATERIAL
+    legal = bytearray(n_positions)
+    mated = bytearray(n_positions)
+    moves_not_losing_yet = array('H', bytes(2 * n_positions))  # MOVES NOT YET KNOWN TO LEAD TO A WIN FOR THE OPPONENT
+    external_win_plies: Dict[int, int] = {}  # SHORTEST MATE REACHED BY CHANGING THE MATERIAL
+    external_loss_plies: Dict[int, int] = {}  # LONGEST LOSS AFTER CHANGING THE MATERIAL
+    external_losing_moves: Dict[int, int] = {}  # NUMBER OF MATERIAL-CHANGING MOVES THAT LOSE
+    for position_index in range(n_positions):
+        if verbose and position_index % 65536 == 0:
+            print(f'{material}: generating {position_index}/{n_positions}')
+        side_to_move, squares = index.index_to_squares(position_index)
+        if index.squares_to_index(side_to_move, squares) != position_index:
+            continue
+        position = create_position_from_squares(white_pieces, black_pieces, side_to_move, squares)
+        if position is None:
+            continue
+        legal[position_index] = 1
+        moves = position.get_all_legal_moves_for_side_to_move()
+        if not moves and position.is_under_check(side_to_move):
+            mated[position_index] = 1
+        # SYMMETRIC MOVES LEAD TO ONE ENTRY AND ARE TAKEN BACK AS ONE, SO EACH ENTRY COUNTS ONCE
+        successor_indices = set()
+        n_material_changing_moves = 0
+        for move in moves:
+            if move.is_capture() or move.pawn_promotion_required():
+                n_material_changing_moves += 1
+                value = tablebases.probe(branch_from_position(position, move))
+                if value is None:
+                    raise ValueError(f'{material} needs the table for the material after {move.generate_uci()} in '
+                                     f'{position.generate_fen()}. Generate it first.')
+                result, plies = decode_value(value)
+                if result == 'loss':
+                    external_win_plies[position_index] = min(external_win_plies.get(position_index, plies), plies)
+                elif result == 'win':
+                    external_loss_plies[position_index] = max(external_loss_plies.get(position_index, plies), plies)
+                    external_losing_moves[position_index] = external_losing_moves.get(position_index, 0) + 1
+            else:
+                slot = squares.index(SQUARE_TO_INDEX[move.origin_square])
+                successor_squares = list(squares)
+                successor_squares[slot] = SQUARE_TO_INDEX[move.destination_square]
+                successor_indices.add(index.squares_to_index(opposite_color(side_to_move), successor_squares))
+        moves_not_losing_yet[position_index] = len(successor_indices) + n_material_changing_moves
+
+    # RETROGRADE RESOLUTION. buckets[p] HOLDS POSITIONS THAT GET A VALUE OF p PLIES UNLESS RESOLVED EARLIER.
+    values = bytearray(n_positions)
+    resolved = bytearray(n_positions)
+    longest_loss = array('H', bytes(2 * n_positions))
+    buckets: Dict[int, List[int]] = {}
+    for position_index in range(n_positions):
+        if mated[position_index]:
+            buckets.setdefault(0, []).append(position_index)
+    for position_index, plies in external_win_plies.items():
+        buckets.setdefault(plies + 1, []).append(position_index)
+    for position_index, n_losing_moves in external_losing_moves.items():
+        longest_loss[position_index] = external_loss_plies[position_index]
+        moves_not_losing_yet[position_index] -= n_losing_moves
+        if moves_not_losing_yet[position_index] == 0:
+            buckets.setdefault(longest_loss[position_index] + 1, []).append(position_index)
+    del mated
+
+    plies = 0
+    while buckets:
+        for position_index in buckets.pop(plies, []):
+            if resolved[position_index]:
+                continue
+            resolved[position_index] = 1
+            values[position_index] = encode_plies(plies)
+            side_to_move, squares = index.index_to_squares(position_index)
+            for predecessor in get_predecessor_indices(index, side_to_move, squares):
+                if not legal[predecessor] or resolved[predecessor]:
+                    continue
+                if plies % 2 == 0:
+                    # THIS POSITION IS LOST FOR THE SIDE TO MOVE, SO THE PREDECESSOR WINS BY MOVING HERE
+                    buckets.setdefault(plies + 1, []).append(predecessor)
+                else:
+                    moves_not_losing_yet[predecessor] -= 1
+                    longest_loss[predecessor] = max(longest_loss[predecessor], plies)
+                    if moves_not_losing_yet[predecessor] == 0:
+                        # EVERY MOVE LOSES. THE LONGEST LOSS MAY BE AN EARLIER MATERIAL-CHANGING MOVE.
+                        buckets.setdefault(longest_loss[predecessor] + 1, []).append(predecessor)
+        plies += 1
+        if verbose:
+            print(f'{material}: resolved up to {plies} plies')
+
+    file_path = path.join(directory, material + TABLEBASE_FILE_EXTENSION)
+    with open(file_path, 'wb') as writefile:
+        writefile.write(values)
+    return file_path
+
+
+if __name__ == '__main__':
+    # e.g. python -m simple_bot.tablebase simple_bot/tablebases KQK KRK KPK
+    if len(sys.argv) < 3:
+        print('Usage: python -m simple_bot.tablebase <directory> <material> [<material> ...]')
+        sys.exit(1)
+    for material_to_generate in sys.argv[2:]:
+        print(f'Wrote {generate_tablebase(material_to_generate, sys.argv[1], verbose=True)}')
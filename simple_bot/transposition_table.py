@@ -0,0 +1,159 @@
+import struct
+from multiprocessing.shared_memory import SharedMemory
+from typing import Tuple, Union
+
+from utils.board_functions import SQUARE_TO_INDEX, INDEX_TO_SQUARE
+
+PROMOTION_TO_CODE = {'': 0, 'q': 1, 'r': 2, 'b': 3, 'n': 4}
+CODE_TO_PROMOTION = {0: '', 1: 'q', 2: 'r', 3: 'b', 4: 'n'}
+
+HEADER_SIZE = 8  # ONE WORD AT THE START OF THE SEGMENT. NON-ZERO FIRST BYTE MEANS WORKERS SHOULD STOP SEARCHING.
+ENTRY = struct.Struct('<QQQ')  # (CHECK, SCORE BITS, META). CHECK = HASH ^ SCORE BITS ^ META
+DOUBLE = struct.Struct('<d')
+UINT64 = struct.Struct('<Q')
+VALID_ENTRY_FLAG = 1 << 24
+
+
+def pack_uci(uci: str) -> int:
+    """
+    Packs a UCI move into 15 bits: origin square (6), destination square (6), promotion piece (3). '0000' packs to 0.
+    :param uci: e.g. 'e7e8q'
+    :return:
+    """
+    if uci == '0000':
+        return 0
+    return SQUARE_TO_INDEX[uci[:2]] | (SQUARE_TO_INDEX[uci[2:4]] << 6) | (PROMOTION_TO_CODE[uci[4:]] << 12)
+
+
+def unpack_uci(packed_move: int) -> str:
+    if packed_move == 0:
+        return '0000'
+    return INDEX_TO_SQUARE[packed_move & 63] + INDEX_TO_SQUARE[(packed_move >> 6) & 63] + \
+        CODE_TO_PROMOTION[packed_move >> 12]
+
+
+class SharedTranspositionTable:
+    """
+    Transposition table stored as a packed array of fixed-size entries in a multiprocessing.shared_memory segment, so
+    that several search processes can read and write it without pickling anything.
+
+    Entries are written without locks. Each entry is three 64-bit words and the first word is the position hash XORed
+    with the other two, so an entry torn by a concurrent write fails the check on probing and is treated as a miss.
+
+    Pickling the table (e.g. passing it to a ProcessPoolExecutor task) only sends the segment name, and the receiving
+    process attaches to the same segment.
+    """
+
+    def __init__(self, n_entries: int = 2 ** 16, name: str = None):
+        """
+        :param n_entries: rounded up to a power of two.
+        :param name: name of an existing segment to attach to. Creates a new segment if None.
+        """
+        size = 1
+        while size < n_entries:
+            size *= 2
+        self.n_entries = size
+        self.owner = name is None
+        if self.owner:
+            # NEW SEGMENTS ARE ZERO-FILLED, I.E. EVERY SLOT STARTS EMPTY AND THE STOP FLAG IS CLEAR.
+            self.shared_memory = SharedMemory(create=True, size=HEADER_SIZE + size * ENTRY.size)
+        else:
+            self.shared_memory = SharedMemory(name=name)
+        self.buffer = self.shared_memory.buf
+
+    def __getstate__(self):
+        return {'n_entries': self.n_entries, 'name': self.shared_memory.name}
+
+    def __setstate__(self, state):
+        self.__init__(n_entries=state['n_entries'], name=state['name'])
+
+    def probe(self, position_hash: int) -> Union[Tuple[int, float, str], None]:
+        """
+        :param position_hash:
+        :return: (depth, score, uci) if the position is in the table, otherwise None.
+        """
+        offset = HEADER_SIZE + (position_hash & (self.n_entries - 1)) * ENTRY.size
+        check, score_bits, meta = ENTRY.unpack_from(self.buffer, offset)
+        if not meta & VALID_ENTRY_FLAG or check ^ score_bits ^ meta != position_hash:
+            return None
+        score = DOUBLE.unpack(UINT64.pack(score_bits))[0]
+        return (meta >> 16) & 255, score, unpack_uci(meta & 65535)
+
+    def store(self, position_hash: int, depth: int, score: float, uci: str) -> None:
+        """
+        Keeps an existing entry for the same position if it was searched deeper. Otherwise overwrites the slot.
+        :param position_hash:
+        :param depth:
+        :param score:
+        :param uci:
+        :return:
+        """
+        offset = HEADER_SIZE + (position_hash & (self.n_entries - 1)) * ENTRY.size
+        existing_entry = self.probe(position_hash)
+        if existing_entry is not None and existing_entry[0] > depth:
+            return
+        score_bits = UINT64.unpack(DOUBLE.pack(score))[0]
+        meta = VALID_ENTRY_FLAG | (min(depth, 255) << 16) | pack_uci(uci)
+        ENTRY.pack_into(self.buffer, offset, position_hash ^ score_bits ^ meta, score_bits, meta)
+
+    def request_stop(self) -> None:
+        self.buffer[0] = 1
+
+    def clear_stop(self) -> None:
+        self.buffer[0] = 0
+
+    def stop_requested(self) -> bool:
+        return self.buffer[0] != 0
+
+    def close(self) -> None:
+        """
+        Detaches from the segment. The process that created the table also frees it.
+        :return:
+        """
+        self.buffer = None
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
+
+
+class SharedStopFlag:
+    """
+    A single byte in a multiprocessing.shared_memory segment that tells searches in other processes to stop, as the
+    first byte of a SharedTranspositionTable does for Lazy SMP workers. Pickling only sends the segment name.
+    """
+
+    def __init__(self, name: str = None):
+        """
+        :param name: name of an existing segment to attach to. Creates a new, clear flag if None.
+        """
+        self.owner = name is None
+        if self.owner:
+            self.shared_memory = SharedMemory(create=True, size=1)
+        else:
+            self.shared_memory = SharedMemory(name=name)
+        self.buffer = self.shared_memory.buf
+
+    def __getstate__(self):
+        return {'name': self.shared_memory.name}
+
+    def __setstate__(self, state):
+        self.__init__(name=state['name'])
+
+    def request_stop(self) -> None:
+        self.buffer[0] = 1
+
+    def clear_stop(self) -> None:
+        self.buffer[0] = 0
+
+    def stop_requested(self) -> bool:
+        return self.buffer[0] != 0
+
+    def close(self) -> None:
+        """
+        Detaches from the segment. The process that created the flag also frees it.
+        :return:
+        """
+        self.buffer = None
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
@@ -5,7 +5,7 @@ from typing import Union
 
 def branch_from_position(position: Position, move: LegalMove) -> Position:
     new_position = position.copy()
-    new_position.process_legal_move(move)
+    new_position.process_legal_move(move, generate_notation=False)
     return new_position
 
 
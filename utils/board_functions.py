@@ -12,6 +12,13 @@ for f in files:
     for r in ranks:
         ALL_SQUARES.append(f'{f}{r}')
 
+# a1 = 0, b1 = 1, ..., h1 = 7, a2 = 8, ..., h8 = 63
+SQUARE_TO_INDEX = {}
+INDEX_TO_SQUARE = {}
+for sq in ALL_SQUARES:
+    SQUARE_TO_INDEX[sq] = (int(sq[1]) - 1) * 8 + 'abcdefgh'.index(sq[0])
+    INDEX_TO_SQUARE[SQUARE_TO_INDEX[sq]] = sq
+
 
 def square_color_int(square: str) -> int:
     """
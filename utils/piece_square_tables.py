@@ -0,0 +1,60 @@
+from typing import Dict, List
+from utils.board_functions import ALL_SQUARES, LETTER_TO_NUM, NUM_TO_LETTER
+
+# MATERIAL VALUE OF EACH PIECE TYPE, WITHOUT THE KING
+MATERIAL_VALUES = {'P': 1, 'N': 3, 'B': 3, 'R': 5, 'Q': 9}
+
+# SCORES FOR SQUARES CONTROLLED BY PAWNS
+CENTRAL_FILE_4TH_RANK = 0.15
+CENTRAL_FILE_5TH_RANK = 0.18
+CENTRAL_FILE_6TH_RANK = 0.22
+BISHOP_FILE_4TH_RANK = 0.13
+BISHOP_FILE_5TH_RANK = 0.15
+BISHOP_FILE_6TH_RANK = 0.17
+SEVENTH_RANK = 0.2
+EIGHTH_RANK = 0.23
+KNIGHT_FILE_5TH_RANK = 0.13
+KNIGHT_FILE_6TH_RANK = 0.16
+ALL_OTHERS = 0.1
+
+SEVENTH_RANK_SCORES = {}
+for f in 'abcdefgh':
+    SEVENTH_RANK_SCORES[f] = SEVENTH_RANK
+EIGHTH_RANK_SCORES = {}
+for f in 'abcdefgh':
+    EIGHTH_RANK_SCORES[f] = EIGHTH_RANK
+SIXTH_RANK_SCORES = {'a': ALL_OTHERS, 'b': KNIGHT_FILE_6TH_RANK, 'c': BISHOP_FILE_6TH_RANK, 'd': CENTRAL_FILE_6TH_RANK,
+                     'e': CENTRAL_FILE_6TH_RANK, 'f': BISHOP_FILE_6TH_RANK, 'g': KNIGHT_FILE_6TH_RANK, 'h': ALL_OTHERS}
+FIFTH_RANK_SCORES = {'a': ALL_OTHERS, 'b': KNIGHT_FILE_5TH_RANK, 'c': BISHOP_FILE_5TH_RANK, 'd': CENTRAL_FILE_5TH_RANK,
+                     'e': CENTRAL_FILE_5TH_RANK, 'f': BISHOP_FILE_5TH_RANK, 'g': KNIGHT_FILE_5TH_RANK, 'h': ALL_OTHERS}
+FOURTH_RANK_SCORES = {'a': ALL_OTHERS, 'b': ALL_OTHERS, 'c': BISHOP_FILE_4TH_RANK, 'd': CENTRAL_FILE_4TH_RANK,
+                      'e': CENTRAL_FILE_4TH_RANK, 'f': BISHOP_FILE_4TH_RANK, 'g': ALL_OTHERS, 'h': ALL_OTHERS}
+RANK_SCORES = {'4': FOURTH_RANK_SCORES, '5': FIFTH_RANK_SCORES, '6': SIXTH_RANK_SCORES, '7': SEVENTH_RANK_SCORES, '8': EIGHTH_RANK_SCORES}
+WHITE_PAWN_CONTROL_SCORES = {}
+BLACK_PAWN_CONTROL_SCORES = {}
+for square in ALL_SQUARES:
+    file = square[0]
+    rank = square[1]
+    if rank in RANK_SCORES:
+        WHITE_PAWN_CONTROL_SCORES[square] = RANK_SCORES[rank][file]
+    else:
+        WHITE_PAWN_CONTROL_SCORES[square] = ALL_OTHERS
+
+for square in WHITE_PAWN_CONTROL_SCORES:
+    rank = int(square[1])
+    black_rank = 9 - rank
+    mirrored_square = square[0] + str(black_rank)
+    BLACK_PAWN_CONTROL_SCORES[mirrored_square] = WHITE_PAWN_CONTROL_SCORES[square]
+
+# THE SAME SCORES IN THOUSANDTHS, SO THAT RUNNING TOTALS OF THEM AND THEIR HALVES ARE EXACT
+PAWN_CONTROL_MILLIS = {color: {square: round(scores[square] * 1000) for square in scores}
+                       for color, scores in (('w', WHITE_PAWN_CONTROL_SCORES), ('b', BLACK_PAWN_CONTROL_SCORES))}
+
+# SQUARES ATTACKED BY A PAWN OF EACH COLOR ON EACH SQUARE, AS GIVEN BY Position.scan_pawn_attacked_squares
+PAWN_ATTACKED_SQUARES: Dict[str, Dict[str, List[str]]] = {'w': {}, 'b': {}}
+for square in ALL_SQUARES:
+    file_num = LETTER_TO_NUM[square[0]]
+    neighboring_files = [NUM_TO_LETTER[f] for f in (file_num - 1, file_num + 1) if f in NUM_TO_LETTER]
+    rank = int(square[1])
+    PAWN_ATTACKED_SQUARES['w'][square] = [f'{f}{rank + 1}' for f in neighboring_files] if rank < 8 else []
+    PAWN_ATTACKED_SQUARES['b'][square] = [f'{f}{rank - 1}' for f in neighboring_files] if rank > 1 else []
@@ -0,0 +1,44 @@
+from random import Random
+
+# Fixed seed so that every process (and every run) agrees on the hash of a position. Hashes are stored in shared
+# transposition tables and in files, so these numbers must never change.
+_zobrist_random = Random(20240726)
+
+PIECE_SQUARE_KEYS = {}
+for _color in ('w', 'b'):
+    for _piece in ('P', 'N', 'B', 'R', 'Q', 'K'):
+        for _file in 'abcdefgh':
+            for _rank in '12345678':
+                PIECE_SQUARE_KEYS[(_color, _piece, f'{_file}{_rank}')] = _zobrist_random.getrandbits(64)
+BLACK_TO_MOVE_KEY = _zobrist_random.getrandbits(64)
+CASTLING_KEYS = {}
+for _right in ('K', 'Q', 'k', 'q'):
+    CASTLING_KEYS[_right] = _zobrist_random.getrandbits(64)
+EN_PASSANT_FILE_KEYS = {}
+for _file in 'abcdefgh':
+    EN_PASSANT_FILE_KEYS[_file] = _zobrist_random.getrandbits(64)
+
+
+def hash_pieces(color: str, all_piece_squares) -> int:
+    h = 0
+    for piece in all_piece_squares:
+        for square in all_piece_squares[piece]:
+            h ^= PIECE_SQUARE_KEYS[(color, piece, square)]
+    return h
+
+
+def hash_position_state(side_to_move: str, castling_rights: str, en_passant_square: str) -> int:
+    """
+    The part of the hash that does not depend on where the pieces are.
+    :param side_to_move: 'w' or 'b'
+    :param castling_rights: as in the FEN, e.g. 'KQk' or '-'
+    :param en_passant_square: e.g. 'e3' or '-'
+    :return:
+    """
+    h = BLACK_TO_MOVE_KEY if side_to_move == 'b' else 0
+    for right in castling_rights:
+        if right in CASTLING_KEYS:
+            h ^= CASTLING_KEYS[right]
+    if en_passant_square != '-':
+        h ^= EN_PASSANT_FILE_KEYS[en_passant_square[0]]
+    return h